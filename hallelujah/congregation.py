@@ -12,13 +12,14 @@
 #
 import json
 import os
-import socket
+from time import time
 from magpie.src.mTimer import mTimer
 from magpie.src.musage import MUsage
 from magpie.src.mzdatetime import MZdatetime
-from hallelujah.root import RootHJ
+from hallelujah.root import RootHJ, RootHShard
 from hallelujah.jah import Jah
 from hallelujah.hallelu import Hallelu
+from hallelujah.worker_pool import WorkerPool
 from multiprocessing import Process
 import argparse
 from magpie.src.mlogger import MLogger, mlogger
@@ -205,11 +206,39 @@ class Congregation(RootHJ):
      2. Congregation creates a Hallelu process.
      3. Hallelu and cmds are not yet connected?
     """
-
-    def __init__(self, port: int, processdir: str, connectaddr: (str, int)):
+    # Shards answer _usageReq_, _metricsReq_ and _statsReq_ for the peers the
+    # kernel hashes to them. The other commands share state across peers in
+    # this process, and are forwarded here: the cluster (_ConReq_,
+    # _ConCfm_), the worksheets and their journal (_sheetReq_, _cmdReq_,
+    # _cmdInd_, _sheetInd_, _schReq_), the gathers of a fanout
+    # (_fanoutReq_, _fanoutCfm_), and the process files and heartbeats
+    # (_JahReq_, _readyInd_, _keepaliveInd_, _STOP_).
+    shardClass = "hallelujah.congregation:CongregationShard"
+    # Retransmitted requests are answered from the response cache, they
+    # write the journal and spawn processes, or scatter a fanout.
+    cachedCmds = {"_ConReq_", "_sheetReq_", "_cmdReq_", "_cmdInd_",
+                  "_sheetInd_", "_fanoutReq_", "_schReq_"}
+    # Commands or sheets per _cmdRsp_ or _sheetRsp_, and the datagrams of
+    # mudp.maxPayload that their json fills, see _indRsp().
+    indPageMax: int = 128
+    indPageDatagrams: int = 32
+    # Seconds the entry Congregation of a fanout waits for the tree below
+    # it, each level down waits fanoutShrink of its parent, see _scatter().
+    fanoutSeconds: float = 5.0
+    fanoutShrink: float = 0.75
+    # Seconds the results of a fanout wait for the request of their next
+    # page, see _gatheredPage().
+    gatheredSeconds: float = 30.0
+    # Seconds without a _keepaliveInd_ before a Hallelu or Jah is stale.
+    heartbeatSeconds: float = 15.0
+
+    def __init__(self, port: int, processdir: str, connectaddr: (str, int), shards: int = 0, workers: int = 0):
+        """workers(>0) keeps that many pre-imported processes for Hallelu
+           and Jah, see WorkerPool."""
+        self.processdir = processdir  # For the shards, see shardArgs().
         super().__init__(cwd=os.getcwd(),
                          title="congregation",
-                         congregationPort=port, port=port)
+                         congregationPort=port, port=port, shards=shards)
         self.hosts = set()
         self.jah_count = 0
         self.usage = MUsage()
@@ -223,12 +252,29 @@ class Congregation(RootHJ):
             "_sheetReq_": self.sheetReq,
             "_cmdReq_": self.cmdReq,
             "_JahReq_": self.JahReq,
+            "_keepaliveInd_": self.keepaliveInd,
+            "_readyInd_": self.readyInd,
+            "_fanoutReq_": self.fanoutReq,
+            "_fanoutCfm_": self.fanoutCfm,
+            "_schReq_": self.schReq,
             "_STOP_": self.Stop
         })
         self.conreqTimer = mTimer(1)
         self.processTimers = mTimer(5)
         self.pingTimers = mTimer(10)
+        # Process file -> (time of the last _keepaliveInd_, port), see
+        # _isProcessRunning(). The process files are read when Congregation
+        # starts, and are otherwise for when it restarts.
+        self.heartbeats = {}
+        # Gather id -> the fanout waiting for the left and right children.
+        self.gathers = {}
+        self.gatherId = 0
+        # Gather id -> the results of a fanout that are paged.
+        self.gathered = {}
         self.processdir = processdir
+        # The process files of the Hallelu and Jah, see processFile().
+        self.halleludir = processdir
+        self.workers = WorkerPool(workers) if workers > 0 else None
         self.cluster = Cluster(self.processdir, connectaddr)
         p = os.path.join(processdir, ".worksheets")
         if not os.path.exists(p):
@@ -263,6 +309,13 @@ class Congregation(RootHJ):
         params["cluster"]["worksheet"] = self.ws
         self.sendCfm(req=cmd, title="_ConCfm_", params=params)
 
+    def _conReq(self, addr: (str, int)) -> None:
+        """ConReq, tick() retransmits it with the same request id."""
+        v = {"params": {"routing": True}, "addr": addr}
+        self.conreqTimer.start(k=1, v=v)
+        v["requestId"] = self.sendReq(
+            title="_ConReq_", params=v["params"], remoteAddr=addr)
+
     def ConCfm(self, key: MUDPKey, cmd: dict):
         """
         A new Congregation receiving the concfm.
@@ -271,12 +324,7 @@ class Congregation(RootHJ):
         p = cmd["params"]
         # Redirect request towards where the connection will be made.
         if p["routing"] is True:
-            self.conreqTimer.start(k=1, v={})
-            self.sendReq(
-                title="_ConReq_",
-                params={"routing": True},
-                remoteAddr=p["Congregation"]
-            )
+            self._conReq(p["Congregation"])
             return
         # Connection has been made.
         self.cluster.parents = p["cluster"]
@@ -335,72 +383,256 @@ class Congregation(RootHJ):
  {self.cluster.right}""")
         return (firstSeen, params)
 
+    def _indWalk(self, key: MUDPKey, cmd: dict) -> (bool, dict):
+        """_redirectingWalk(), or for the next page here, the redirection
+           that the first page had."""
+        page = cmd["params"].get("page")
+        if page is None:
+            return self._redirectingWalk(key, cmd)
+        return (True, page["next"])
+
+    def _indRsp(self, cmd: dict, title: str, name: str, items: any, redirectingParams: dict) -> None:
+        """
+        Send a page of the items, which are (uuid, item) and item is None
+        when it does not match the filters, in params[name], see _page().
+        When there are more items, the next _cmdInd_ or _sheetInd_ comes
+        back here with the page, otherwise the last page has the
+        redirection.
+        """
+        (found, last, more) = self._page(items)
+        if more:
+            self.sendCfm(req=cmd, title=title, params={
+                "filters": cmd["params"]["filters"],
+                "routing": False,
+                "Congregation": (self.host, self.publicPort),
+                name: found,
+                "page": {"after": last, "next": redirectingParams}
+            })
+            return
+        if found:
+            redirectingParams = dict(redirectingParams or {})
+            redirectingParams[name] = found
+        self.sendCfm(req=cmd, title=title, params=redirectingParams)
+
+    def _page(self, items: any) -> (list, any, bool):
+        """
+        The matching items of a page, the key of the last item read, and
+        True when there are more, from items of (key, item) and item is None
+        when it does not match. A page has up to indPageMax items, and up to
+        indPageDatagrams of json, or the one item that is larger.
+        """
+        budget = self.mudp.maxPayload * self.indPageDatagrams
+        found = []
+        size = 0
+        last = None
+        for k, item in items:
+            if item:
+                n = len(json.dumps(item))
+                if found and (len(found) >= self.indPageMax
+                              or size + n > budget):
+                    return (found, last, True)
+                size += n
+                found.append(item)
+            last = k
+        return (found, last, False)
+
+    def _pageNotFound(self, cmd: dict, title: str) -> None:
+        """The item that the page continues after was deleted since the
+           previous page."""
+        self.sendCfm(req=cmd, title=title, params={
+            "status": "page not found", "routing": False})
+
+    def _cmdItems(self, filters: dict, after: str) -> (str, dict):
+        for cmduuid in self.ws.cmdUuidsAfter(after):
+            yield (cmduuid, self.ws.findCmd(
+                filters.get("sheetuuid",None), cmduuid,
+                filters.get("feed",None)))
+
+    def _sheetItems(self, filters: dict, page: dict) -> (str, dict):
+        if "sheetUuid" in filters:
+            if not page:
+                yield (filters["sheetUuid"],
+                       self.ws.get(filters["sheetUuid"],None))
+            return
+        found = not page
+        for sheet in self.ws:
+            if found:
+                yield (sheet["uuid"], sheet)
+            else:
+                found = sheet["uuid"] == page["after"]
+
     def cmdInd(self, key: MUDPKey, cmd: dict):
-        """ Find ALL commands. """
-        (check, redirectingParams) = self._redirectingWalk(key, cmd)
-        if check: # Check this congregation for the cmd.
+        """ Find ALL commands, a page of them per _cmdRsp_. """
+        if self._fanout(cmd, "_cmdRsp_"):
+            return
+        (check, redirectingParams) = self._indWalk(key, cmd)
+        items = []
+        if check: # Check this congregation for the cmds.
             p = cmd["params"]
-            filters = p["filters"]
-            cmduuid = self.ws.nextCmdUuid(filters.get("cmduuid",None))
-            while cmduuid: # Check that the cmd is a match for the filtering.
-                cmd = self.ws.findCmd(
-                    filters.get("sheetuuid",None), cmduuid,
-                    filters.get("feed",None)
-                )
-                if cmd: # Got a cmd and route the next CmdInd back here.
-                    self.sendCfm(
-                        req=cmd, title="_cmdRsp_",
-                        params = {
-                            "filters": filters,
-                            "routing": False,
-                            "Congregation": self.cluster.connect,
-                            "cmd": self.ws.getCmdUuid(cmduuid)
-                        }
-                    )
-                    return
-                cmduuid = self.ws.nextCmdUuid(cmduuid)
-        self.sendCfm(req=cmd, title="_cmdRsp_", params=redirectingParams)
+            page = p.get("page")
+            if page and self.ws.getCmdUuidWS(page["after"]) is None:
+                self._pageNotFound(cmd, "_cmdRsp_")
+                return
+            items = self._cmdItems(p["filters"], page["after"] if page else None)
+        self._indRsp(cmd, "_cmdRsp_", "cmds", items, redirectingParams)
 
     def sheetInd(self, key: MUDPKey, cmd: dict):
-        """ Find ALL sheets. """
-        (check, redirectingParams) = self._redirectingWalk(key, cmd)
-        if check: # Check this congregation for the sheet.
+        """ Find ALL sheets, a page of them per _sheetRsp_. """
+        if self._fanout(cmd, "_sheetRsp_"):
+            return
+        (check, redirectingParams) = self._indWalk(key, cmd)
+        items = []
+        if check: # Check this congregation for the sheets.
             p = cmd["params"]
-            filters = p["filters"]
-            sheet = None
-            if "sheetUuid" in filters:
-                sheet = self.ws.get(filters["sheetUuid"],None)
-            elif p["sheetUuid"]:
-                search = True
-                for sheet in self.ws:
-                    if search:
-                        search = sheet["uuid"] != p["sheetUuid"]
-                    else:
-                        break
-            else:
-                for sheet in self.ws:
-                    break
-            if sheet: # Got a sheet and route the next SheetInd back here.
-                self.sendCfm(
-                    req=cmd, title="_sheetRsp_",
-                    params = {
-                        "filters": filters,
-                        "routing": False,
-                        "Congregation": self.cluster.connect,
-                        "sheet": sheet
-                    }
-                )
+            page = p.get("page")
+            if page and "sheetUuid" not in p["filters"] and not any(
+                    s["uuid"] == page["after"] for s in self.ws):
+                self._pageNotFound(cmd, "_sheetRsp_")
                 return
-        self.sendCfm(req=cmd, title="_sheetRsp_", params=redirectingParams)
+            items = self._sheetItems(p["filters"], p.get("page"))
+        self._indRsp(cmd, "_sheetRsp_", "sheets", items, redirectingParams)
 
-    def schReq(self, key: MUDPKey, cmd: dict):
-        """ Update schema in each Congregation. """
-        (updateHere, params) = self._redirectingWalk(key, cmd)
-        if updateHere:
-            p = cmd["params"]
-            self.ws.changeSchema(p["schema"])
+    def _fanout(self, cmd: dict, title: str) -> bool:
+        """
+        True when cmd has params "fanout" and is handled by scatter-gather,
+        rather than walking. The request is routed to the summit, and from
+        there it is sent to the left and the right at the same time, each
+        sending to its own left and right, and the results of the tree are
+        paged from there, see _scatter() and _gatheredPage().
+        """
+        p = cmd["params"]
+        if not p.get("fanout"):
+            return False
+        if "page" in p:
+            self._gatheredPage(cmd, title, p["page"]["gather"], p["page"]["at"])
+            return True
+        if p["routing"] and self.cluster.parent():
+            self.sendCfm(req=cmd, title=title, params={
+                "routing": True,
+                "Congregation": self.cluster.parent()
+            })
+            return True
+        self._scatter(cmd, title, cmd["cmd"], p, self.fanoutSeconds)
+        return True
+
+    def _fanoutHere(self, query: str, params: dict) -> (str, list):
+        """The name and the items of the results of query here."""
+        if query == "_cmdInd_":
+            return ("cmds", [
+                c for u, c in self._cmdItems(params["filters"], None) if c])
+        if query == "_sheetInd_":
+            return ("sheets", [
+                s for u, s in self._sheetItems(params["filters"], None) if s])
+        if query == "_schReq_":
+            self.ws.changeSchema(params["schema"])
             print(f"change schema={self.ws.schema}")
-        self.sendCfm(req=cmd, title="_schCfm_", params=params)
+            return (None, [])
+        raise Exception("Unexpected fanout " + str(query))
+
+    def _scatter(self, req: dict, title: str, query: str, params: dict, seconds: float) -> None:
+        """
+        Answer req with title once the left and the right have answered the
+        query, or seconds have passed, see tick(). The Congregations that
+        did not answer in time are listed in the response's "partial", their
+        results are missing.
+        """
+        (name, items) = self._fanoutHere(query, params)
+        gid = self.gatherId
+        self.gatherId += 1
+        g = {
+            "req": req, "title": title, "name": name, "items": items,
+            "waiting": {}, "partial": [], "until": time() + seconds
+        }
+        self.gathers[gid] = g
+        for branch, addr in (("left", self.cluster.left()),
+                             ("right", self.cluster.right())):
+            if addr:
+                g["waiting"][branch] = addr
+                self.sendReq("_fanoutReq_", {
+                    "query": query, "params": params, "gather": [gid, branch],
+                    "seconds": seconds * self.fanoutShrink
+                }, addr)
+        self._gathered(gid)
+
+    def _gathered(self, gid: int, expired: bool = False) -> None:
+        g = self.gathers[gid]
+        if g["waiting"] and not expired:
+            return
+        del self.gathers[gid]
+        g["partial"].extend(g["waiting"].values())
+        g["until"] = time() + self.gatheredSeconds
+        self.gathered[gid] = g
+        self._gatheredPage(g["req"], g["title"], gid, 0)
+
+    def _gatheredPage(self, req: dict, title: str, gid: int, at: int) -> None:
+        """
+        Answer req with the page of the results of the fanout from item at,
+        see _page(). A page that is followed by more has {"gather": gid,
+        "at": the next item} in "page", the request for it comes back here.
+        The last page has "partial".
+        """
+        g = self.gathered.get(gid)
+        params = {}
+        if title == "_fanoutCfm_":
+            params["gather"] = req["params"]["gather"]
+        else:
+            params["routing"] = False
+        if g is None:  # Expired, see gatheredSeconds.
+            params["status"] = "page not found"
+            self.sendCfm(req=req, title=title, params=params)
+            return
+        (found, last, more) = self._page(enumerate(g["items"][at:], at))
+        if g["name"]:
+            params[g["name"]] = found
+        if more:
+            params["page"] = {"gather": gid, "at": last + 1}
+            if title != "_fanoutCfm_":
+                params["Congregation"] = (self.host, self.publicPort)
+        else:
+            del self.gathered[gid]
+            params["partial"] = g["partial"]
+        self.sendCfm(req=req, title=title, params=params)
+
+    def fanoutReq(self, key: MUDPKey, cmd: dict) -> None:
+        """ The query for here and below from the parent, or the next page of
+            the results, see _scatter(). """
+        p = cmd["params"]
+        if "page" in p:
+            self._gatheredPage(cmd, "_fanoutCfm_", p["page"]["gather"],
+                               p["page"]["at"])
+            return
+        self._scatter(cmd, "_fanoutCfm_", p["query"], p["params"], p["seconds"])
+
+    def fanoutCfm(self, key: MUDPKey, cmd: dict) -> None:
+        """ Results from the left or the right, a page at a time, see
+            _scatter(). """
+        p = cmd["params"]
+        (gid, branch) = p["gather"]
+        g = self.gathers.get(gid)
+        if g is None or branch not in g["waiting"]:
+            return  # Too late, in partial.
+        if g["name"]:
+            g["items"].extend(p.get(g["name"]) or [])
+        if "page" in p:
+            self.sendReq("_fanoutReq_", {
+                "page": p["page"], "gather": [gid, branch]
+            }, g["waiting"][branch])
+            return
+        addr = g["waiting"].pop(branch)
+        if p.get("status"):  # Its results expired.
+            g["partial"].append(addr)
+        else:
+            g["partial"].extend(p["partial"])
+        self._gathered(gid)
+
+    def schReq(self, key: MUDPKey, cmd: dict):
+        """ Update schema in each Congregation, always by a fanout from the
+            summit, see _fanout(). The _schCfm_ lists the Congregations that
+            did not confirm the update in "partial". """
+        p = cmd["params"]
+        p["fanout"] = True
+        p.setdefault("routing", True)
+        self._fanout(cmd, "_schCfm_")
 
     def _redirectingReq(self, key: MUDPKey, cmd: dict, check) -> (bool, dict):
         """
@@ -471,10 +703,10 @@ class Congregation(RootHJ):
                 }
             )
             return
-        self.ProcessStop(title="h_", cmd=cmd)
+        self.ProcessStop(title="h", cmd=cmd)
         self.ProcessReq(
             "_cmdCfm_", params=p,
-            title="h_", cmd=cmd,
+            title="h", cmd=cmd,
             processType=Hallelu,
             processArgs=Hallelu.args(
                 os.getcwd(), p["cmdUuid"],
@@ -490,12 +722,7 @@ class Congregation(RootHJ):
             mlogger.debug(self.title+" start")
         # No parent but with a connection address, so try connecting.
         if not self.cluster.parent() and self.cluster.connect:
-            self.conreqTimer.start(k=1, v={})
-            self.sendReq(
-                title="_ConReq_",
-                params={"routing": True},
-                remoteAddr=self.cluster.connect
-            )
+            self._conReq(self.cluster.connect)
             return
         for fn in os.listdir(path=self.processdir):
             if (
@@ -506,6 +733,11 @@ class Congregation(RootHJ):
                 )
             ):
                 ffn = os.path.join(self.processdir, fn)
+                # Running processes have a heartbeat period to be heard
+                # from, rather than the age of their process file.
+                (c, port) = self.readProcessFile(ffn)
+                if port != 0:
+                    self.heartbeats[ffn] = (time(), port)
                 if self._isProcessRunning(ffn):
                     self.pingTimers.start(ffn)
                     if MLogger.isDebug():
@@ -516,7 +748,10 @@ class Congregation(RootHJ):
                         mlogger.debug(self.title+" "+fn +
                                       " Hallelu or Jah not running")
 
-    def usageReq(self, cmd: dict) -> None:
+    def shardArgs(self) -> list:
+        return [self.processdir]
+
+    def usageReq(self, key: MUDPKey, cmd: dict) -> None:
         self.sendCfm(req=cmd, title="_usageCfm_", params={
             "host": self.usage.host,
             "cpuUsage": self.usage.cpuUsage(),
@@ -525,47 +760,112 @@ class Congregation(RootHJ):
             "timestamp": MZdatetime().strftime()
         })
 
-    def Stop(self, cmd: dict) -> None:
-        raise Exception("Stopping")
+    def Stop(self, key: MUDPKey, cmd: dict) -> None:
+        """Stop polling, the idle workers are stopped, see poll()."""
+        if self.workers is not None:
+            self.workers.stop()
+        self.stop()
+
+    def poll(self) -> None:
+        """Idle workers are not daemons, they would keep the interpreter
+           from exiting however polling ends."""
+        try:
+            super().poll()
+        finally:
+            if self.workers is not None:
+                self.workers.stop()
 
     def JahReq(self, key: MUDPKey, cmd: dict) -> None:
         p = cmd["params"]
-        self.ProcessReq("_JahCfm_", "j_", cmd, Jah,
-                        Jah.args(os.getcwd(), p["cmdUuid"], self.port,
-                                 self.halleludir))
+        self.ProcessReq("_JahCfm_", params=p, title="j", cmd=cmd,
+                        processType=Jah,
+                        processArgs=Jah.args(os.getcwd(), p["cmdUuid"],
+                                             self.port, self.halleludir))
+
+    def keepaliveInd(self, key: MUDPKey, cmd: dict) -> None:
+        """A Hallelu or Jah is running, see RootHJC.keepalive()."""
+        p = cmd["params"]
+        fn = self.processFile(self.halleludir, p["title"], p["cmdUuid"])
+        self.heartbeats[fn] = (time(), p["port"])
+
+    def readyInd(self, key: MUDPKey, cmd: dict) -> None:
+        """A Hallelu or Jah has its port, see RootHJC.keepalive()."""
+        p = cmd["params"]
+        fn = self.processFile(self.halleludir, p["title"], p["cmdUuid"])
+        self.heartbeats[fn] = (time(), p["port"])
+        self._started(fn, p["port"])
+
+    def isExpiredProcessFile(self, fn: str) -> bool:
+        """Expired when the process has not sent a keepalive recently, or
+           when it has not sent any, by the age of the file."""
+        seen = self.heartbeats.get(fn)
+        if seen is None:
+            return super().isExpiredProcessFile(fn)
+        return seen[0] < time() - self.heartbeatSeconds
 
     def getTitle(self, fn: str) -> str:
         return fn[0:fn.index("_")]
 
     def ProcessStop(self, title: str, cmd: dict) -> bool:
         p = cmd["params"]
-        fn = os.path.join(self.halleludir,
-                          title + "_" + p["cmdUuid"] + ".json")
+        fn = self.processFile(self.halleludir, title, p["cmdUuid"])
+        self.heartbeats.pop(fn, None)
         return self.rmProcessFile(fn)
 
     def ProcessReq(self, cfm: str, params: dict, title: str, cmd: dict,
                    processType: any, processArgs: list) -> None:
         """
-        Create process file and start process, schedule a timer to check that
-        the process has started.
+        Create process file and start process, schedule a timer for when the
+        process does not report that it has started, see _started().
         """
         p = cmd["params"]
         uuid = p["cmdUuid"]
-        fn = os.path.join(self.halleludir, title + "_" + uuid + ".json")
-        if self.createProcessfile(fn, cmd):
+        fn = self.processFile(self.halleludir, title, uuid)
+        created = self.createProcessfile(fn, cmd)
+        self.processTimers.start(fn, {"msg": cfm, "params": params, "cmd": cmd})
+        if created:
             processArgs.append(MLogger.isDebug())
             if MLogger.isDebug():
                 mlogger.debug(self.title+" "+fn+" starting process")
-            p = Process(target=processType.child_main, args=processArgs)
-            p.start()
-        self.processTimers.start(fn, {"msg": cfm, "params": params})
+            if self.workers is None or not self.workers.assign(
+                    fn, processType.child_main, processArgs):
+                p = Process(target=processType.child_main, args=processArgs)
+                p.start()
+        else:  # Already running.
+            self._started(fn, self._isProcessRunning(fn))
+
+    def _started(self, fn: str, port: int, v: dict = None) -> bool:
+        """Send the Cfm for the start of the process, port zero when it failed
+           to start. Return False when the start was confirmed already."""
+        if v is None:
+            t = self.processTimers.getStop(fn)
+            if t is None:
+                return False
+            v = t[1]
+        if port != 0:
+            if MLogger.isDebug():
+                mlogger.debug(self.title+" "+fn +
+                              " successfully started on port "+str(port))
+            self.pingTimers.start(fn)
+        else:
+            if MLogger.isDebug():
+                mlogger.debug(
+                    self.title+" "+fn +
+                    ":removed; Zero port, taking too long to start")
+            self.heartbeats.pop(fn, None)
+            self.rmProcessFile(fn)
+        self.sendCfm(req=v["cmd"], title=v["msg"], params={
+            "ip": self.host,
+            "port": port
+        })
+        return True
 
     def tick(self) -> bool:
-        """Check if newly started processes have started by their port number
-           being in the process-file. Send Cfm with the port number when the
-           process started, and without a port number when process failed to
-           start. Also, check the running processes that they are still running
-           by the last modified timestamp being updated on their process-file.
+        """Answer the fanouts that waited long enough, and forget the results
+           whose next page was not requested, see _scatter(). Send
+           the Cfm without a port number for the processes that did not
+           report that they started, see _started(). Also, check that the
+           running processes are still running by their _keepaliveInd_.
            Delete stale process-file, and send _STOP_ request to that process.
            Processes are created again by whatever created them in the first
            place, catering for scenarios like the node dying or overload.
@@ -576,37 +876,30 @@ class Congregation(RootHJ):
                 mlogger.debug(self.title+" tick : conreq expired")
             self.sendReq(
                 title="_ConReq_",
-                params={"first": True},
-                remoteAddr=self.cluster.connect
+                params=v["params"],
+                remoteAddr=v["addr"],
+                requestId=v["requestId"]
             )
-        for fn, expired, cfm in self.processTimers.walk():
-            if MLogger.isDebug():
-                mlogger.debug(self.title+" tick : "+fn+" "+str(expired) +
-                              " "+str(cfm))
+        if self.workers is not None:
+            # A worker reports the port through its pipe too, and a failure
+            # to start.
+            for fn, port in self.workers.poll().items():
+                didSomething = self._started(fn, port) or didSomething
+            if self.workers.fill():
+                didSomething = True
+        t = time()
+        for gid, g in list(self.gathers.items()):
+            if g["until"] < t:
+                didSomething = True
+                self._gathered(gid, expired=True)
+        for gid, g in list(self.gathered.items()):
+            if g["until"] < t:
+                del self.gathered[gid]
+        for fn, v in self.processTimers.expired():
             didSomething = True
+            # The process file has the port when the _readyInd_ was lost.
             (cmd, port) = self.readProcessFile(fn)
-            if port != 0:
-                if MLogger.isDebug():
-                    mlogger.debug(self.title+" "+fn +
-                                  " successfully started on port "+str(port))
-                self.processTimers.stop(fn)
-                self.pingTimers.start(fn)
-                if cfm:
-                    self.sendCfm(req=cmd, title=cfm, params={
-                        "ip": self.host,
-                        "port": port
-                    })
-            elif expired:
-                if MLogger.isDebug():
-                    mlogger.debug(
-                        self.title+" "+fn +
-                        ":removed; Zero port, taking too long to start")
-                self.rmProcessFile(fn)
-                if cfm:
-                    self.sendCfm(req=cmd, title=cfm, params={
-                        "ip": self.host,
-                        "port": 0
-                    })
+            self._started(fn, port, v)
         for fn, v in self.pingTimers.expired():
             didSomething = True
             if self._isProcessRunning(fn):
@@ -615,26 +908,23 @@ class Congregation(RootHJ):
 
     def _isProcessRunning(self, fn: str) -> int:
         """ Return port number when process is running, otherwise return 0. """
+        seen = self.heartbeats.get(fn)
+        if seen is not None and not self.isExpiredProcessFile(fn):
+            return seen[1]
+        self.heartbeats.pop(fn, None)
         if not os.path.exists(fn):
             return 0
         (cmd, port) = self.readProcessFile(fn)
-        if not self.isExpiredProcessFile(fn):
-            return port
+        if seen is None and not self.isExpiredProcessFile(fn):
+            return port  # Starting, see processTimers.
         if port == 0:
             if MLogger.isDebug():
                 mlogger.debug(self.title+" "+fn +
                               " stale and without a port, removing")
         else:
-            addr = (self.host, port)
-            try:
-                s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-                s.bind(addr)
-                if MLogger.isDebug():
-                    mlogger.debug(self.title+" "+fn +
-                                  " stale, port in use, sending stop")
-                self.sendReq("_STOP_", {}, addr)
-            except Exception:
-                pass
+            if MLogger.isDebug():
+                mlogger.debug(self.title+" "+fn+" stale, sending stop")
+            self.sendReq("_STOP_", {}, (self.host, port))
         if MLogger.isDebug():
             mlogger.debug(self.title+" "+fn+" stale removing")
         os.remove(fn)
@@ -649,6 +939,11 @@ class Congregation(RootHJ):
         parser.add_argument('--port', help="Port number, default is 59990")
         parser.add_argument('-c', '--connect', help="""IP:port used when first
  connecting to the database""")
+        parser.add_argument('-s', '--shards', help="""Number of processes
+ reading the port, default is one""", type=int, default=0)
+        parser.add_argument('-w', '--workers', help="""Number of pre-imported
+ processes waiting to run a Hallelu or Jah, default is none""", type=int,
+                            default=0)
         parser.add_argument('-d', '--debug', help="debug", action="store_true")
         args = parser.parse_args()
         if not args.port:
@@ -658,9 +953,25 @@ class Congregation(RootHJ):
         if args.debug:
             MLogger.init("DEBUG")
         h = Congregation(port=args.port, processdir=args.processdir,
-                         connectaddr=args.connect)
+                         connectaddr=args.connect, shards=args.shards,
+                         workers=args.workers)
         h.poll()
 
 
+
+class CongregationShard(RootHShard):
+    """
+ CongregationShard: One of the shards of a Congregation, see
+ Congregation.shardClass.
+    """
+    def __init__(self, title: str, congregationPort: int, host: str, port: int, primaryAddr: (str, int), processdir: str):
+        super().__init__(title, congregationPort, host, port, primaryAddr)
+        self.usage = MUsage()
+        self.halleludir = processdir
+        self.processCmd["_usageReq_"] = self.usageReq
+
+    usageReq = Congregation.usageReq
+
+
 if __name__ == "__main__":
     Congregation.main()
@@ -12,6 +12,7 @@
 #
 import os
 from hallelujah.root import RootHJC
+from magpie.src.mlogger import MLogger
 
 
 class Hallelu(RootHJC):
@@ -21,7 +22,7 @@ class Hallelu(RootHJC):
  data streams.
     """
     def __init__(self, cwd: str, uuid: str, halleludir: str, congregationPort: int = 0):
-        super().__init__(cwd=os.getcwd(), uuid=uuid, halleludir=halleludir, title="Hallelu", port=0, congregationPort=congregationPort)
+        super().__init__(cwd=os.getcwd(), uuid=uuid, halleludir=halleludir, title="h", port=0, congregationPort=congregationPort)
         self.processCmd.update({
             "_cmdReq_": self.cmdreq,
             "_streamReq_": self.streamreq,
@@ -65,9 +66,18 @@ class Hallelu(RootHJC):
         })
 
     @staticmethod
-    def child_main(cwd: str, uuid: str, congregationPort: int, halleludir: str):
+    def args(cwd: str, uuid: str, congregationPort: int, halleludir: str):
+        return [cwd, uuid, congregationPort, halleludir]
+
+    @staticmethod
+    def child_main(cwd: str, uuid: str, congregationPort: int, halleludir: str, debug: bool=False):
+        if debug:
+            MLogger.init("DEBUG")
         h = Hallelu(cwd, uuid, halleludir, congregationPort)
-        h.poll()
+        try:
+            h.poll()
+        finally:
+            h.mudp.shutdown()
 
 if __name__ == "__main__":
     raise Exception("Hallelu is started by congregation under instruction from Hallelujah")
\ No newline at end of file
@@ -10,10 +10,8 @@
 # 
 # See the GNU General Public License, <https://www.gnu.org/licenses/>.
 #
+import importlib
 from hallelujah.root import RootHJC
-from hallelujah.cmds.files import Files
-from hallelujah.cmds.test import Test
-from hallelujah.cmds.loadf import Loadf
 from magpie.src.mlogger import MLogger
 
 class Jah(RootHJC):
@@ -22,12 +20,24 @@ class Jah(RootHJC):
  There are one or more Jah per Hallelu (command).
  Jah is a partition of data and/or processing.
     """
+    # Command name -> "module:class". The module is imported when a process
+    # file names the command, see cmdType(), e.g. a files command does not
+    # import Loadf's pandas and discovery.
     cmds = {
-        "test": Test,
-        "files": Files,
-        "Loadf": Loadf,
+        "test": "hallelujah.cmds.test:Test",
+        "files": "hallelujah.cmds.files:Files",
+        "Loadf": "hallelujah.cmds.loadf:Loadf",
     }
 
+    @classmethod
+    def cmdType(cls, name: str) -> type:
+        """The class of the command, None when name is not a command."""
+        t = cls.cmds.get(name)
+        if isinstance(t, str):
+            (module, attr) = t.split(":")
+            t = getattr(importlib.import_module(module), attr)
+        return t
+
     @staticmethod
     def args(cwd: str, uuid:str, congregationPort: int, halleludir: str):
         return [cwd, uuid, congregationPort, halleludir]
@@ -40,9 +50,10 @@ class Jah(RootHJC):
             "_streamTimeoutReq_": self.streamtimeoutreq,
             "_dataReq_": self.datareq
         })
-        if self.cmdname not in self.cmdTypes:
+        cmdType = self.cmdType(self.cmdname)
+        if cmdType is None:
             raise Exception("not a recognized cmd type "+self.cmdname)
-        self.op = self.cmdTypes[self.cmdname](self.cmd)
+        self.op = cmdType(self.cmd)
 
     def streamreq(self, cmd: dict) -> None:
         self.sendCfm(req=cmd,title="_streamCfm_", params={
@@ -73,4 +84,7 @@ class Jah(RootHJC):
         if debug:
             MLogger.init("DEBUG")
         j = Jah(cwd, uuid, congregationPort, halleludir)
-        j.poll()
+        try:
+            j.poll()
+        finally:
+            j.mudp.shutdown()
@@ -10,15 +10,132 @@
 # 
 # See the GNU General Public License, <https://www.gnu.org/licenses/>.
 #
+import asyncio
+import importlib
+import ipaddress
 import json
+import marshal
+import multiprocessing
 import os
+import signal
+import sys
+import traceback
+from collections import deque
+from itertools import chain
 from magpie.src.mTimer import mTimer
 from magpie.src.mudp import MUDP, MUDPBuildMsg, MUDPKey
-from time import time, sleep
+from magpie.src.mudpaio import MUDPAsync
+from time import perf_counter, time
 import socket
-from pathlib import Path
-import sys
 from magpie.src.mlogger import MLogger, mlogger
+from magpie.src.mmetrics import MMetrics
+
+
+class RootHCodec():
+    """
+ RootHCodec: Messages as JSON, which every peer decodes. A codec encodes a
+ cmd, which is a dict, to bytes, and decodes the bytes to the cmd again.
+ RootH sends with the first of its codecs that the peer decodes, see codecs.
+    """
+    name = "json"
+
+    def encode(self, cmd: dict) -> bytes:
+        return json.dumps(cmd).encode('utf-8')
+
+    def decode(self, content: bytes) -> dict:
+        return json.loads(content)
+
+    def accepts(self, content: bytes) -> bool:
+        return True  # The fallback.
+
+
+class RootHMarshalCodec(RootHCodec):
+    """
+ RootHMarshalCodec: Messages in the marshal format, version 4, after a
+ marker byte. Values are tagged and length prefixed, and a repeated string
+ is sent as a reference to its first occurrence. Content is from the network,
+ so a decoded cmd is checked to have JSON's types, as RootHCodec would decode
+ it: tuples are lists, and keys are str. Other types are rejected, such as
+ code, bytes and sets, and so is a list or dict that appears twice, as JSON
+ has no references; see _json(). The format may change between Python
+ versions, so the name and the header have the interpreter's major.minor,
+ and a peer on another version is answered in JSON.
+    """
+    marker = 0xB1  # Never the first byte of JSON, or of UTF-8.
+    header = bytes((marker,) + tuple(sys.version_info[:2]))
+    name = "marshal4-%d.%d" % tuple(sys.version_info[:2])
+    scalars = frozenset((str, int, float, bool, type(None)))
+    containers = frozenset((dict, list, tuple))
+    types = scalars | containers
+    strs = frozenset((str,))
+
+    def encode(self, cmd: dict) -> bytes:
+        return self.header + marshal.dumps(cmd, 4)
+
+    def decode(self, content: bytes) -> dict:
+        cmd = marshal.loads(memoryview(content)[len(self.header):])
+        if type(cmd) is not dict:
+            raise Exception("RootHMarshalCodec not a cmd " + str(type(cmd)))
+        return self._json(cmd)
+
+    # cmd with JSON's types, converted in place. The values are checked a
+    # level of the tree at a time, so the type checks run in C. The check
+    # costs more than marshal.loads(), e.g. a page of 128 commands decodes in
+    # up to twice json.loads()'s time, but encodes in a tenth of
+    # json.dumps()'s, so the round trip is still the cheaper. Without it, a
+    # datagram that decodes to a cycle or to code would reach the handlers.
+    def _json(self, cmd: dict) -> dict:
+        containers = self.containers
+        level = [cmd]
+        seen = {id(cmd)}
+        kept = []  # Converted tuples, their ids are not reused meanwhile.
+        while True:
+            values = self._values(level)
+            types = set(map(type, values))
+            if types <= self.scalars:
+                return cmd
+            if not types <= self.types:
+                raise Exception("RootHMarshalCodec not JSON " + ", ".join(
+                    t.__name__ for t in types - self.types))
+            children = [v for v in values if type(v) in containers]
+            ids = set(map(id, children))
+            if len(ids) != len(children) or not seen.isdisjoint(ids):
+                raise Exception("RootHMarshalCodec not JSON, a reference")
+            seen |= ids
+            if tuple in types:
+                kept.extend(children)
+                for c in level:
+                    for k, v in (c.items() if type(c) is dict else enumerate(c)):
+                        if type(v) is tuple:
+                            c[k] = list(v)
+                children = [
+                    v for v in self._values(level) if type(v) in containers]
+            level = children
+
+    # Values of the dicts and lists in level, with the dicts' keys as str.
+    def _values(self, level: list) -> list:
+        dicts = [c for c in level if type(c) is dict]
+        if len(dicts) == len(level):
+            values = []
+        else:
+            values = list(chain.from_iterable(
+                [c for c in level if type(c) is not dict]))
+        if dicts:
+            if not self.strs.issuperset(map(type, chain.from_iterable(dicts))):
+                for c in dicts:
+                    for k in [k for k in c if type(k) is not str]:
+                        c[self._key(k)] = c.pop(k)
+            values.extend(chain.from_iterable(map(dict.values, dicts)))
+        return values
+
+    # A key as json.dumps() writes it, e.g. 1 is "1" and None is "null".
+    def _key(self, k: any) -> str:
+        if type(k) not in self.scalars:
+            raise Exception("RootHMarshalCodec not JSON key " + type(k).__name__)
+        return json.dumps(k)
+
+    def accepts(self, content: bytes) -> bool:
+        return content[:len(self.header)] == self.header
 
 
 class RootH():
@@ -26,28 +143,169 @@ class RootH():
  RootH: Root for a process that is communicating in the database.
  Default behaviour is to allocate a port.
     """
-    def __init__(self, title: str, congregationPort: int, congregationHost: str="", port: int = 0):
+    # Message vocabulary for the compression dictionary, see zdict(). Strings
+    # used more often are later, zlib finds them at a shorter distance.
+    vocabulary = [
+        '"inputSchema": ', '"inputFeed": ', '"outputFeed": ',
+        '"outputStatsFeed": ', '"filters": ', '"schema": ', '"sheets": ',
+        '"worksheet": ', '"archive": ', '"cluster": ', '"feed": ',
+        '"port": ', '"path": ', '"name": ', '"addr": ', '"status": ',
+        '"msgtype": ', '"TrackAttempts": ', '"sheetUuid": ', '"cmdUuid": ',
+        '"uuid": ', '"__request_id__": ', '"__remote_address__": ',
+        '"cmd": "_metricsReq_", ', '"cmd": "_metricsCfm_", ',
+        '"cmd": "_STOP_", ', '"cmd": "_usageReq_", ', '"cmd": "_usageCfm_", ',
+        '"cmd": "_JahReq_", ', '"cmd": "_JahCfm_", ',
+        '"cmd": "_schCfm_", ', '"cmd": "_dataReq_", ', '"cmd": "_dataCfm_", ',
+        '"cmd": "_streamReq_", ', '"cmd": "_streamCfm_", ',
+        '"cmd": "_streamCanReq_", ', '"cmd": "_streamCanCfm_", ',
+        '"cmd": "_streamTimeoutReq_", ', '"cmd": "_streamTimeoutCfm_", ',
+        '"cmd": "_sheetReq_", ', '"cmd": "_sheetCfm_", ',
+        '"cmd": "_sheetInd_", ', '"cmd": "_sheetRsp_", ',
+        '"cmd": "_cmdReq_", ', '"cmd": "_cmdCfm_", ', '"cmd": "_cmdInd_", ',
+        '"cmd": "_cmdRsp_", ', '"cmd": "_ConReq_", ', '"cmd": "_ConCfm_", ',
+        '"Congregation": ', '"routing": ', '"params": {', '{"cmd": '
+    ]
+
+    @staticmethod
+    def zdict() -> bytes:
+        """Preset dictionary for compressing messages, processes with a
+           different dictionary send to each other without compression."""
+        return "".join(RootH.vocabulary).encode('utf-8')
+
+    # The "module:class" of the shards, a RootHShard that has the handlers
+    # of the commands whose state is per peer or per process. The kernel
+    # hashes a peer to one shard, which handles the peer's commands. Other
+    # commands share state across peers, and are forwarded to the primary
+    # process, see RootHShard.
+    shardClass: str = "hallelujah.root:RootHShard"
+    # The commands of RootH that a shard handles too.
+    shardCmds = {"_metricsReq_", "_statsReq_"}
+    # Time the handlers, decoding and tick(), see statsReq().
+    profile: bool = False
+    # Codecs in the order of preference, the last is JSON, which every peer
+    # decodes. A request in JSON lists the sender's codecs in __codecs__, and
+    # a message in another codec shows that the sender decodes it, see
+    # encode() and _decode().
+    codecs = [RootHMarshalCodec(), RootHCodec()]
+    # MUDP, or MUDPAsync for RootHAsync.
+    mudpClass = MUDP
+    # Datagrams in flight to a peer that ACKs before waiting for the ACK,
+    # see MUDPPacer. Zero does not pace.
+    window: int = 32
+    # Requests that are answered from the response cache when they arrive
+    # again from the same originator with the same request id, i.e. a
+    # retransmission, rather than running the handler again, see dispatch().
+    cachedCmds = set()
+    # Seconds a request's responses are cached, and the most requests cached.
+    responseSeconds: float = 30.0
+    responsesMax: int = 4096
+    # Message classes in the order they are served, with (weight, queueMax),
+    # see poll(). Each round handles up to weight of a class's queued
+    # commands, and then reads again, so a control command waits for at most
+    # a round rather than for the bulk that arrived before it. Reading stops
+    # while a class has queueMax commands queued.
+    msgClasses = {
+        "control": (16, 256),
+        "default": (4, 1024),
+        "bulk": (1, 1024)
+    }
+    # The class of a command, other commands are "default". A class keeps
+    # arrival order, commands whose order matters, e.g. a _sheetRsp_ and the
+    # _sheetCfm_ that ends it, are in the same class.
+    cmdClasses = {
+        "_STOP_": "control", "_metricsReq_": "control",
+        "_statsReq_": "control", "_keepaliveInd_": "control",
+        "_readyInd_": "control",
+        "_usageReq_": "control", "_usageCfm_": "control",
+        "_cmdInd_": "bulk", "_sheetInd_": "bulk",
+        "_sheetRsp_": "bulk", "_sheetCfm_": "bulk",
+        "_cmdRsp_": "bulk", "_cmdCfm_": "bulk",
+        "_fanoutReq_": "bulk", "_fanoutCfm_": "bulk"
+    }
+
+    def __init__(self, title: str, congregationPort: int, congregationHost: str="", port: int = 0, shards: int = 0, reusePort: bool = False):
+        """
+        shards(>1) starts that many RootHShard processes, each reading its own
+        SO_REUSEPORT socket on port; this process binds a private port and
+        handles the commands that the shards forward.
+        """
+        self.title = title
         if congregationHost:
             self.host = congregationHost
         else:
             self.host = socket.gethostname()
         self.congregation_addr = (self.host, congregationPort)
+        self.publicPort = port
+        self.shards = []
+        if shards > 1:
+            port = 0
         self.s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if reusePort:
+            self.s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self.socket_timeout = 5.0
         self.s.settimeout(self.socket_timeout)
         try:
             self.s.bind((self.host, port))
         except:
             if MLogger.isError():
-                mlogger.error(self.title+" address in use " + str(self.host)+":"+str(self.port))
+                mlogger.error(self.title+" address in use " + str(self.host)+":"+str(port))
             raise
         self.port = self.s.getsockname()[1]
         self.localAddress = (self.host, self.port)
-        self.title = title
+        if shards <= 1:
+            self.publicPort = self.port  # E.g. port zero.
+        if shards > 1:
+            self.startShards(shards)
         self._stop = False
-        self.mudp = MUDP(socket=self.s, skipBad=False)
+        # Lost datagrams are NACKed and resent, rather than losing the message,
+        # with peers that negotiate retransmit.
+        self.mudp = self.mudpClass(
+            socket=self.s, skipBad=False, text=False, zdict=RootH.zdict(),
+            retransmit=True, window=self.window, shm=True, pmtu=True)
         self.processCmd = {}
         self.processCmd[""] = self.commandDoNothing
+        self.processCmd["_metricsReq_"] = self.metricsReq
+        self.processCmd["_statsReq_"] = self.statsReq
+        # Histograms of microseconds, by cmd, and "decode" and "tick".
+        self.stats = MMetrics() if self.profile else None
+        # (originator, request id) -> (expiry, [(title, params)...]), in the
+        # order of expiry.
+        self.responses = {}
+        self.responseHits = 0
+        # Peer address -> codec, see encode(), and names -> ip addresses.
+        self.peerCodecs = {}
+        self.resolved = {}
+        # Class -> deque of (key, cmd), see poll().
+        self.queues = {c: deque() for c in self.msgClasses}
+
+    def startShards(self, shards: int) -> None:
+        """Shards are spawned before this process starts its reader thread,
+           and have bound the port when this returns."""
+        ctx = multiprocessing.get_context("spawn")
+        ready = ctx.Queue()
+        for i in range(shards):
+            p = ctx.Process(
+                target=RootHShard.run, daemon=True,
+                args=(self.shardClass, self.title+"-shard"+str(i),
+                      self.congregation_addr[1], self.host, self.publicPort,
+                      self.localAddress, MLogger.isDebug(), ready,
+                      self.shardArgs()))
+            p.start()
+            self.shards.append(p)
+        for p in self.shards:
+            ready.get(timeout=30)
+
+    def shardArgs(self) -> list:
+        """Arguments for the shardClass after those of RootHShard, the shards
+           are started before the constructor of a subclass returns."""
+        return []
+
+    def stopShards(self) -> None:
+        for p in self.shards:
+            p.terminate()
+        for p in self.shards:
+            p.join()
+        self.shards = []
 
     def stop(self) -> None:
         print("stop")
@@ -56,6 +314,53 @@ class RootH():
     def commandDoNothing(self, cmd: dict) -> None:
         pass
 
+    def metricsReq(self, key: MUDPKey, cmd: dict) -> None:
+        """Transport metrics, see MUDP.metrics()."""
+        self.sendCfm(req=cmd, title="_metricsCfm_", params={
+            "title": self.title,
+            "addr": self.localAddress,
+            "mudp": self.mudp.metrics(),
+            "responseCache": {
+                "size": len(self.responses),
+                "hits": self.responseHits
+            },
+            "queues": {c: len(q) for c, q in self.queues.items()}
+        })
+
+    def statsReq(self, key: MUDPKey, cmd: dict) -> None:
+        """Handler latency, in microseconds. params "profile" turns timing
+           on or off, and "reset" clears the histograms."""
+        p = cmd.get("params") or {}
+        if p.get("reset") and self.stats is not None:
+            self.stats = MMetrics()
+        if "profile" in p:
+            if not p["profile"]:
+                self.stats = None
+            elif self.stats is None:
+                self.stats = MMetrics()
+        self.sendCfm(req=cmd, title="_statsCfm_", params={
+            "title": self.title,
+            "addr": self.localAddress,
+            "profile": self.stats is not None,
+            "stats": self.stats.snapshot()["histograms"]
+                if self.stats is not None else {}
+        })
+
+    # The stats that were on when started, a handler may turn them off.
+    @staticmethod
+    def _time(stats: MMetrics, name: str, started: float) -> None:
+        stats.histogram(name).add(int((perf_counter() - started) * 1e6))
+
+    def timedTick(self) -> bool:
+        """tick(), timed when profiling."""
+        stats = self.stats
+        if stats is None:
+            return self.tick()
+        started = perf_counter()
+        r = self.tick()
+        self._time(stats, "tick", started)
+        return r
+
     def poll(self) -> None:
         if MLogger.isDebug():
             mlogger.debug(self.title+" start " + str(self.host)+":"+str(self.port))
@@ -66,67 +371,388 @@ class RootH():
                 didSomething = False
                 if MLogger.isDebug():
                     mlogger.debug(self.title+" waiting")
-            for (key, content, eom) in self.mudp.recv():
+            if self.read():
                 didSomething = True
-                cmd = json.loads(content)
-                if MLogger.isDebug():
-                    mlogger.debug("Poll:"+str(cmd))
-                if "__remote_address__" not in cmd:
-                    # The remote_address is the originator and is stored in
-                    # the command, so the response is sent to the originator.
-                    cmd["__remote_address__"] = key.getAddr()
-                if "__request_id__" not in cmd:
-                    # The request id is stored in the command, so the response
-                    # is to the original request id.
-                    cmd["__request_id__"] = key.getRequestId()
-                n = self.processCmd.get(cmd["cmd"],self.processCmd.get("_", None))
-                if n == None:
-                    raise Exception("Unexpected message " + str(cmd))
-                if MLogger.isDebug():
-                    mlogger.debug(self.title+" recv "+str(key)+" "+str(cmd))
-                n(key,cmd)
-            if not didSomething and not self.tick():
-                sleep(0.1)
+            if self.serve():
+                didSomething = True
+            if not didSomething and not self.timedTick():
+                self.mudp.wait(0.1)  # Wakes up when content arrives.
         if MLogger.isDebug():
             mlogger.debug(self.title+" stopped")
         self._stop = False
 
+    def read(self) -> bool:
+        """Queue the commands that have arrived by class, see msgClasses.
+           Return True when a command was queued."""
+        queued = False
+        for c, q in self.queues.items():
+            if len(q) >= self.msgClasses[c][1]:
+                return False  # Serve before reading more.
+            if q:
+                queued = True
+        # Queued commands are served without waiting for more to arrive.
+        for (key, content, eom) in self.mudp.recv(
+                timeout=0.0 if queued else 0.03):
+            cmd = self.decode(key, content)
+            if cmd is not None:
+                c = self.cmdClasses.get(cmd["cmd"], "default")
+                q = self.queues[c]
+                q.append((key, cmd))
+                queued = True
+                if len(q) >= self.msgClasses[c][1]:
+                    break  # The rest is left in MUDP, see MUDP.recv().
+        return queued
+
+    def serve(self) -> bool:
+        """Handle a round of the queued commands, up to each class's weight.
+           Return True when a command was handled."""
+        served = False
+        for c, q in self.queues.items():
+            for i in range(min(len(q), self.msgClasses[c][0])):
+                (key, cmd) = q.popleft()
+                self.handle(key, cmd)
+                served = True
+        return served
+
+    def dispatch(self, key: MUDPKey, content: bytes) -> any:
+        """Call the processCmd handler for content, return what it returns."""
+        cmd = self.decode(key, content)
+        if cmd is None:
+            return None
+        return self.handle(key, cmd)
+
+    def decode(self, key: MUDPKey, content: bytes) -> dict:
+        """The cmd in content, with its originator and request id, or None."""
+        if content is None:  # Lost content, the sender retransmits.
+            if MLogger.isDebug():
+                mlogger.debug(self.title+" lost content from "+str(key))
+            return None
+        if self.stats is None:
+            cmd = self._decode(key, content)
+        else:
+            started = perf_counter()
+            cmd = self._decode(key, content)
+            self._time(self.stats, "decode", started)
+        if MLogger.isDebug():
+            mlogger.debug("Poll:"+str(cmd))
+        if "__remote_address__" not in cmd:
+            # The remote_address is the originator and is stored in
+            # the command, so the response is sent to the originator.
+            cmd["__remote_address__"] = key.getAddr()
+        else:
+            # Tuple is a list in json format, convert back to tuple.
+            ra = cmd["__remote_address__"]
+            cmd["__remote_address__"] = (ra[0], ra[1])
+        if "__request_id__" not in cmd:
+            # The request id is stored in the command, so the response
+            # is to the original request id.
+            cmd["__request_id__"] = key.getRequestId()
+        return cmd
+
+    # Decode with the codec that accepts content, and learn the codec to
+    # send to the peer with.
+    def _decode(self, key: MUDPKey, content: bytes) -> dict:
+        for codec in self.codecs:
+            if codec.accepts(content):
+                break
+        cmd = codec.decode(content)
+        if codec is not self.codecs[-1]:
+            self.peerCodecs[key.getAddr()] = codec
+        elif "__codecs__" in cmd:
+            names = cmd.pop("__codecs__")
+            self.peerCodecs[key.getAddr()] = next(
+                c for c in self.codecs if c.name in names or c is codec)
+        return cmd
+
+    def encode(self, remoteAddr: (str, int), cmd: dict, request: bool = False) -> bytes:
+        """cmd in the codec that the peer decodes, JSON until it is known,
+           and then a request has this process's codecs in __codecs__."""
+        peer = self.resolved.get(remoteAddr)
+        if peer is None:
+            try:
+                peer = (socket.gethostbyname(remoteAddr[0]), remoteAddr[1])
+            except Exception:
+                peer = tuple(remoteAddr)
+            self.resolved[remoteAddr] = peer
+        codec = self.peerCodecs.get(peer)
+        if codec is None:
+            codec = self.codecs[-1]
+            if request:
+                cmd["__codecs__"] = [c.name for c in self.codecs]
+        return codec.encode(cmd)
+
+    def handle(self, key: MUDPKey, cmd: dict) -> any:
+        """Call the processCmd handler for cmd, return what it returns."""
+        n = self.processCmd.get(cmd["cmd"],self.processCmd.get("_", None))
+        if n == None:
+            raise Exception("Unexpected message " + str(cmd))
+        if MLogger.isDebug():
+            mlogger.debug(self.title+" recv "+str(key)+" "+str(cmd))
+        if cmd["cmd"] in self.cachedCmds and self._replay(cmd):
+            return None
+        stats = self.stats
+        if stats is None:
+            return n(key,cmd)
+        # A coroutine handler, see RootHAsync, is timed to its creation only.
+        started = perf_counter()
+        r = n(key,cmd)
+        self._time(stats, cmd["cmd"], started)
+        return r
+
+    def _replay(self, cmd: dict) -> bool:
+        """True when cmd is a retransmission, its cached responses are sent
+           again; a request that is yet to be answered is answered later."""
+        k = (tuple(cmd["__remote_address__"]), cmd["__request_id__"])
+        t = time()
+        r = self.responses.get(k)
+        if r is not None and r[0] > t:
+            self.responseHits += 1
+            if MLogger.isDebug():
+                mlogger.debug(self.title+" replay "+str(k))
+            for title, params in r[1]:
+                self._sendCfm(cmd, title, params)
+            return True
+        self.responses.pop(k, None)
+        while self.responses:
+            oldest = next(iter(self.responses))
+            if (self.responses[oldest][0] > t
+                    and len(self.responses) < self.responsesMax):
+                break
+            del self.responses[oldest]
+        self.responses[k] = (t + self.responseSeconds, [])
+        return False
+
     def tick(self) -> bool:
         """Placeholder for any periodic work. Return True when work was done. """
         return False
 
-    def sendReq(self, title: str, params: dict, remoteAddr: (str,int)) -> None:
+    def sendReq(self, title: str, params: dict, remoteAddr: (str,int), requestId: int = -1) -> int:
+        """Return the request id. A retransmission passes the request id of
+           the request it repeats, see cachedCmds."""
         if MLogger.isDebug():
             mlogger.debug(self.title+" sendReq "+title+" to "+str(remoteAddr))
-        self.mudp.send(
-            content=json.dumps({"cmd": title, "params": params}),
-            eom=True,
-            msg=MUDPBuildMsg(MUDPKey(addr=remoteAddr))
-        )
+        return self._send(remoteAddr, {"cmd": title, "params": params},
+                          requestId=requestId, request=True)
 
     def sendCfm(self, req:dict, title: str, params: dict) -> None:
+        if req.get("cmd") in self.cachedCmds:
+            r = self.responses.get(
+                (tuple(req["__remote_address__"]), req["__request_id__"]))
+            if r is not None:
+                r[1].append((title, params))
+        self._sendCfm(req, title, params)
+
+    def _sendCfm(self, req:dict, title: str, params: dict) -> None:
         remoteAddr = req["__remote_address__"]
         requestId = req["__request_id__"]
         if MLogger.isDebug():
             mlogger.debug(f"{self.title} sendCfm {title} to {remoteAddr}:{requestId} params {params}")
+        if req.get("__shard__"):
+            # Request came through a shard, the shard sends the response
+            # from the port where the request arrived.
+            self._send((self.host, self.publicPort), {
+                "cmd": "_shardRelay_", "params": {
+                    "addr": remoteAddr, "requestId": requestId,
+                    "msg": {"cmd": title, "params": params}}})
+            return
+        self._send(tuple(remoteAddr), {"cmd": title, "params": params},
+                   requestId=requestId)
+
+    def _send(self, remoteAddr: (str, int), cmd: dict, requestId: int = -1, request: bool = False) -> int:
+        """Send cmd as one message, and return its request id."""
+        msg = MUDPBuildMsg(MUDPKey(addr=remoteAddr, requestId=requestId))
+        self.mudp.send(
+            content=self.encode(remoteAddr, cmd, request=request),
+            eom=True,
+            msg=msg
+        )
+        return msg.getRemoteKey().getRequestId()
+
+
+class RootHAsync(RootH):
+    """
+ RootHAsync: RootH on an asyncio event loop, see MUDPAsync. A processCmd
+ handler is a function, or a coroutine function; a coroutine runs as a task
+ so a slow handler does not hold up the commands that follow it. Timers are
+ loop.call_later(), see callLater(), and tick() is called every tickSeconds.
+ A host name is resolved with loop.getaddrinfo() before the first message to
+ it, see _send(), rather than blocking the loop in gethostbyname().
+    """
+    mudpClass = MUDPAsync
+    # MUDPAsync does not pace, the wait for ACK would hold up the loop.
+    window: int = 0
+    tickSeconds: float = 0.1
+
+    def __init__(self, title: str, congregationPort: int, congregationHost: str="", port: int = 0):
+        super().__init__(title, congregationPort=congregationPort,
+                         congregationHost=congregationHost, port=port)
+        self.loop = None
+        self.tasks = set()
+        self.ticker = None
+
+    def poll(self) -> None:
+        asyncio.run(self.pollAsync())
+
+    async def pollAsync(self) -> None:
+        self.loop = asyncio.get_running_loop()
+        await self.mudp.start()
+        if MLogger.isDebug():
+            mlogger.debug(self.title+" start " + str(self.host)+":"+str(self.port))
+        self._run(self.processCmd[""]({}))  # Run the start cmd.
+        self._tick()
+        while not self._stop:
+            async for (key, content, eom) in self.mudp.recv(timeout=1.0):
+                self._run(self.dispatch(key, content))
+        self.ticker.cancel()
+        for task in list(self.tasks):
+            task.cancel()
+        if self.tasks:
+            await asyncio.wait(self.tasks)
+        self.mudp.shutdown()  # The transport ends with the loop.
+        if MLogger.isDebug():
+            mlogger.debug(self.title+" stopped")
+        self._stop = False
+
+    def stop(self) -> None:
+        super().stop()
+        if self.loop is not None and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.mudp.wakeup)
+
+    def callLater(self, seconds: float, callback: any, *args) -> asyncio.TimerHandle:
+        """Call callback(*args) in seconds, cancel() the handle to stop."""
+        return self.loop.call_later(seconds, callback, *args)
+
+    # A handler's coroutine runs as a task.
+    def _run(self, r: any) -> None:
+        if asyncio.iscoroutine(r):
+            task = self.loop.create_task(r)
+            self.tasks.add(task)
+            task.add_done_callback(self._done)
+
+    def _done(self, task: asyncio.Task) -> None:
+        self.tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            if MLogger.isError():
+                mlogger.error(self.title+" handler failed " + "".join(
+                    traceback.format_exception(task.exception())))
+
+    def _tick(self) -> None:
+        self.timedTick()
+        self.ticker = self.loop.call_later(self.tickSeconds, self._tick)
+
+    def _send(self, remoteAddr: (str, int), cmd: dict, requestId: int = -1, request: bool = False) -> int:
+        host = remoteAddr[0]
+        if self.loop is None or not host or remoteAddr in self.resolved:
+            return super()._send(remoteAddr, cmd, requestId, request)
+        try:
+            ipaddress.ip_address(host)
+            return super()._send(remoteAddr, cmd, requestId, request)
+        except ValueError:
+            pass
+        if requestId == -1:  # The request id is returned before sending.
+            requestId = MUDPKey.requestId
+            MUDPKey.requestId = (requestId + 1) & 0xffff
+        self._run(self._resolveSend(remoteAddr, cmd, requestId, request))
+        return requestId
+
+    async def _resolveSend(self, remoteAddr: (str, int), cmd: dict, requestId: int, request: bool) -> None:
+        try:
+            info = await self.loop.getaddrinfo(
+                remoteAddr[0], remoteAddr[1], family=socket.AF_INET,
+                type=socket.SOCK_DGRAM)
+            peer = (info[0][4][0], remoteAddr[1])
+        except OSError:
+            peer = tuple(remoteAddr)
+        # For encode(), and for MUDP's peer address.
+        self.resolved[remoteAddr] = peer
+        self.mudp.resolved[remoteAddr] = peer
+        super()._send(remoteAddr, cmd, requestId, request)
+
+
+class RootHShard(RootH):
+    """
+ RootHShard: One of the processes reading a SO_REUSEPORT port for a sharded
+ RootH. The kernel hashes each peer to one shard, and the shards decode MUDP
+ and handle commands in parallel. A shard handles the commands in shardCmds,
+ and those of the handlers that a subclass adds, see RootH.shardClass. It
+ forwards other commands to the primary process with the originator's
+ address and request id, so the primary's response goes to the originator.
+ The primary's responses come back through a shard as _shardRelay_, and are
+ sent from the shared port, where the originator expects the response.
+    """
+    def __init__(self, title: str, congregationPort: int, host: str, port: int, primaryAddr: (str, int)):
+        super().__init__(title, congregationPort=congregationPort,
+                         congregationHost=host, port=port, reusePort=True)
+        self.primaryAddr = (socket.gethostbyname(primaryAddr[0]), primaryAddr[1])
+        self.parent = os.getppid()
+        self.processCmd = {
+            k: v for k, v in self.processCmd.items()
+            if k == "" or k in self.shardCmds}
+        self.processCmd["_shardRelay_"] = self.relay
+        self.processCmd["_"] = self.forward
+
+    @staticmethod
+    def run(shardClass: str, title: str, congregationPort: int, host: str, port: int, primaryAddr: (str, int), debug: bool, ready: any, args: list) -> None:
+        if debug:
+            MLogger.init("DEBUG")
+        (module, attr) = shardClass.split(":")
+        cls = getattr(importlib.import_module(module), attr)
+        h = cls(title, congregationPort, host, port, primaryAddr, *args)
+        # stopShards() terminates, the shard then releases its rings and
+        # doorbell.
+        signal.signal(signal.SIGTERM, lambda signum, frame: h.stop())
+        ready.put(title)
+        try:
+            h.poll()
+        finally:
+            h.mudp.shutdown()
+
+    def forward(self, key: MUDPKey, cmd: dict) -> None:
+        cmd["__shard__"] = True
         self.mudp.send(
-            content=json.dumps({"cmd": title, "params": params}),
+            content=self.encode(self.primaryAddr, cmd, request=True),
             eom=True,
-            msg=MUDPBuildMsg(MUDPKey(addr=remoteAddr,
-            requestId=requestId))
+            msg=MUDPBuildMsg(MUDPKey(addr=self.primaryAddr))
         )
 
+    def relay(self, key: MUDPKey, cmd: dict) -> None:
+        if key.getAddr() != self.primaryAddr:
+            if MLogger.isError():
+                mlogger.error(self.title+" relay not from primary "+str(key))
+            return
+        p = cmd["params"]
+        addr = (p["addr"][0], p["addr"][1])
+        self.mudp.send(
+            content=self.encode(addr, p["msg"]),
+            eom=True,
+            msg=MUDPBuildMsg(MUDPKey(addr=addr,
+            requestId=p["requestId"]))
+        )
+
+    def tick(self) -> bool:
+        """Stop when the primary process has gone."""
+        if os.getppid() != self.parent:
+            self.stop()
+        return False
+
 
 class RootHJ(RootH):
     """
  RootHJ: Root for database components managed by Congregation.
- Touches the ProcessFile, the last modified time being an indication to
- Congregation that this process is alive.
+ A process file holds the cmd of a Hallelu or Jah, and then its port, see
+ processFile(). The process sends _keepaliveInd_ to Congregation while it
+ is alive, a file without recent keepalives is stale.
     """
-    def __init__(self, cwd: str, title: str, congregationPort: int, port: int = 0):
-        super().__init__(title, port=port, congregationPort=congregationPort)
+    def __init__(self, cwd: str, title: str, congregationPort: int, port: int = 0, shards: int = 0):
+        super().__init__(title, port=port, congregationPort=congregationPort, shards=shards)
         os.chdir(cwd)
 
+    @staticmethod
+    def processFile(halleludir: str, title: str, uuid: str) -> str:
+        """The process file of the process with title, e.g. "j" for Jah, for
+           the command uuid."""
+        return os.path.join(halleludir, title + "_" + uuid + ".json")
+
     def readProcessFile(self, fn: str) -> (dict, int):
         if not os.path.exists(fn):
             return (None, 0)
@@ -198,11 +824,17 @@ class RootHJC(RootHJ):
   RootHJC: Root for Hallelu and Jah; those with a command. Reads command from
   file.
     """
+    # Called with the port once it is in the process file, when the process
+    # runs in a WorkerPool worker.
+    started = None
+    # Seconds between _keepaliveInd_, see Congregation.keepaliveInd().
+    keepaliveSeconds: int = 5
+
     def __init__(self, cwd: str, uuid: str, halleludir: str, title: str, congregationPort: int, port: int = 0):
         super().__init__(cwd, title, port=port, congregationPort=congregationPort)
         self.halleludir = halleludir
         self.id = uuid
-        self.fn = os.path.join(self.halleludir,title+self.id+".json")
+        self.fn = self.processFile(self.halleludir, title, self.id)
         (self.cmd,port) = self.readProcessFile(self.fn)
         if self.cmd is None:
             raise Exception("process file does not exist "+self.fn)
@@ -224,19 +856,38 @@ class RootHJC(RootHJ):
             raise Exception("process file has different cmd "+self.fn)
         if self.port != port:
             raise Exception("process file has different port "+self.fn)
-        self.keepaliveTimer = mTimer(5)
+        if RootHJC.started is not None:
+            RootHJC.started(self.port)
+        self.processCmd["_STOP_"] = self.stopReq
+        self.keepaliveTimer = mTimer(self.keepaliveSeconds)
+        self.keepalive("_readyInd_")
+
+    def stopReq(self, key: MUDPKey, cmd: dict) -> None:
+        """Congregation removed the process file."""
+        self.stop()
+
+    def keepalive(self, title: str = "_keepaliveInd_") -> None:
+        """The first is _readyInd_, Congregation confirms the start of this
+           process when it arrives."""
         self.keepaliveTimer.start(self.fn)
+        try:
+            self.sendReq(title, {
+                "title": self.title, "cmdUuid": self.id, "port": self.port
+            }, self.congregation_addr)
+        except OSError as e:  # E.g. Congregation's host does not resolve.
+            if MLogger.isError():
+                mlogger.error(self.title+" keepalive "+str(e))
 
     def tick(self) -> bool:
-        """Update the last modified time for the file associated with this process.
-           Exit when file has been removed by Congregation and that occurs when
-           file is stale and has not been updated here, and when processing should
-           stop"""
-        if not os.path.exists(self.fn):
-            sys.exit()
+        """Send _keepaliveInd_ to Congregation, which stops this process with
+           _STOP_ when the keepalives stop arriving, and removes the process
+           file. Stop when the file has been removed, in case the _STOP_ was
+           lost."""
         didSomething = super().tick()
         for fn,v in self.keepaliveTimer.expired():
             didSomething = True
-            Path(fn).touch()
-            self.keepaliveTimer.start(fn)
+            if not os.path.exists(self.fn):
+                self.stop()
+                break
+            self.keepalive()
         return didSomething
@@ -0,0 +1,316 @@
+# This file is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This file is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# See the GNU General Public License, <https://www.gnu.org/licenses/>.
+#
+import json
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+import types
+import unittest
+from magpie.src.mTimer import mTimer
+from magpie.src.mudp import MUDP, MUDPBuildMsg, MUDPKey
+
+# MUsage reads the host with psutil, and MZdatetime parses with dateutil,
+# neither is used here.
+for m in ("psutil", "dateutil", "dateutil.parser"):
+    if m not in sys.modules:
+        try:
+            __import__(m)
+        except ImportError:
+            sys.modules[m] = types.ModuleType(m)
+if not hasattr(sys.modules["dateutil"], "parser"):
+    sys.modules["dateutil"].parser = sys.modules["dateutil.parser"]
+import hallelujah.congregation  # noqa: E402
+from hallelujah.congregation import Congregation  # noqa: E402
+from hallelujah.hallelu import Hallelu  # noqa: E402
+
+
+class Starting(Congregation):
+    """Starts a Hallelu for _startReq_, as _cmdReq_ does once the
+       worksheets have the command."""
+    def __init__(self, processdir: str):
+        super().__init__(port=0, processdir=processdir, connectaddr=None)
+        self.processCmd["_startReq_"] = self.startReq
+        # The Cfm is from the _readyInd_, rather than the timeout.
+        self.processTimers = mTimer(600)
+
+    def startReq(self, key: MUDPKey, cmd: dict) -> None:
+        p = cmd["params"]
+        self.ProcessReq(
+            "_startCfm_", params=p, title="h", cmd=cmd, processType=Hallelu,
+            processArgs=Hallelu.args(
+                os.getcwd(), p["cmdUuid"], self.port, self.halleludir))
+
+
+class Paging(Congregation):
+    """Keeps the responses rather than sending them."""
+    indPageMax = 3
+
+    def __init__(self, processdir: str):
+        super().__init__(port=0, processdir=processdir, connectaddr=None)
+        self.sent = []
+
+    def sendCfm(self, req: dict, title: str, params: dict) -> None:
+        self.sent.append((title, params))
+
+
+class Tree(Congregation):
+    """Has items for the fanout of _cmdInd_, rather than commands."""
+    indPageMax = 2
+    fanoutSeconds = 1.0
+
+    def __init__(self, processdir: str, items: list):
+        super().__init__(port=0, processdir=processdir, connectaddr=None)
+        self.items = items
+
+    def _fanoutHere(self, query: str, params: dict) -> (str, list):
+        if query != "_cmdInd_":
+            return super()._fanoutHere(query, params)
+        return ("cmds", list(self.items))
+
+
+class TestCongregation(unittest.TestCase):
+
+    def setUp(self):
+        self.usage = hallelujah.congregation.MUsage
+        hallelujah.congregation.MUsage = lambda: None
+        self.clientS = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.clientS.settimeout(5)
+        self.clientS.bind(("", 0))
+        self.client = MUDP(self.clientS, skipBad=False)
+
+    def tearDown(self):
+        hallelujah.congregation.MUsage = self.usage
+        self.client.shutdown()
+        self.clientS.close()
+
+    def send(self, h: Congregation, title: str, params: dict) -> MUDPKey:
+        return self.client.send(
+            json.dumps({"cmd": title, "params": params}), True,
+            MUDPBuildMsg(MUDPKey((h.host, h.port))), demux=True)
+
+    def wait(self, f: any, seconds: float = 60.0) -> any:
+        until = time.time() + seconds
+        while time.time() < until:
+            r = f()
+            if r:
+                return r
+            time.sleep(0.05)
+        self.fail("timed out")
+
+    def test_stopWorkers(self):
+        h = Congregation(port=0, processdir=tempfile.mkdtemp(),
+                         connectaddr=None, workers=1)
+        t = threading.Thread(target=h.poll)
+        t.start()
+        try:
+            (p, conn) = self.wait(lambda: h.workers.idle and h.workers.idle[0])
+            self.send(h, "_STOP_", {})
+            t.join(10.0)
+            self.assertFalse(t.is_alive())
+            p.join(10.0)
+            self.assertFalse(p.is_alive())
+            self.assertFalse(h.workers.idle)
+        finally:
+            h.stop()
+            t.join()
+            h.mudp.shutdown()
+            h.s.close()
+
+    def tree(self) -> list:
+        """The summit, its left, and its right."""
+        tree = [Tree(tempfile.mkdtemp(), [{"uuid": n + str(i)} for i in range(3)])
+                for n in ("s", "l", "r")]
+        (summit, left, right) = tree
+        summit.cluster.leftCongregationAddress = (left.host, left.port)
+        summit.cluster.rightCongregationAddress = (right.host, right.port)
+        left.cluster.parents = right.cluster.parents = [(summit.host, summit.port)]
+        return tree
+
+    def pull(self, h: Congregation, page: dict = None) -> dict:
+        params = {"filters": {}, "routing": page is None, "fanout": True}
+        if page is not None:
+            params["page"] = page
+        key = self.send(h, "_cmdInd_", params)
+        rsp = list(self.client.recvRequestId(key, timeout=10.0))
+        self.assertEqual(len(rsp), 1)
+        return json.loads(rsp[0][0])["params"]
+
+    def test_fanout(self):
+        tree = self.tree()
+        threads = [threading.Thread(target=h.poll) for h in tree]
+        for t in threads:
+            t.start()
+        try:
+            # The left and the right page their results to the summit, which
+            # pages them to here.
+            p = self.pull(tree[0])
+            found = list(p["cmds"])
+            while "page" in p:
+                self.assertEqual(p["Congregation"], [tree[0].host, tree[0].port])
+                self.assertEqual(len(p["cmds"]), Tree.indPageMax)
+                p = self.pull(tree[0], p["page"])
+                found += p["cmds"]
+            self.assertEqual(sorted(c["uuid"] for c in found), sorted(
+                c["uuid"] for h in tree for c in h.items))
+            self.assertEqual(p["partial"], [])
+            self.assertFalse(tree[0].gathered)
+        finally:
+            for h, t in zip(tree, threads):
+                h.stop()
+                t.join()
+            for h in tree:
+                h.mudp.shutdown()
+                h.s.close()
+
+    def test_fanoutPartial(self):
+        tree = self.tree()
+        # The right does not answer.
+        threads = [threading.Thread(target=h.poll) for h in tree[0:2]]
+        for t in threads:
+            t.start()
+        try:
+            started = time.time()
+            p = self.pull(tree[0])
+            self.assertGreaterEqual(time.time() - started, Tree.fanoutSeconds)
+            found = list(p["cmds"])
+            while "page" in p:
+                p = self.pull(tree[0], p["page"])
+                found += p["cmds"]
+            self.assertEqual(sorted(c["uuid"] for c in found), sorted(
+                c["uuid"] for h in tree[0:2] for c in h.items))
+            self.assertEqual(p["partial"], [[tree[2].host, tree[2].port]])
+            # Results whose next page is not requested expire.
+            tree[0].gatheredSeconds = 0.0
+            p = self.pull(tree[0])
+            self.assertIn("page", p)
+            self.wait(lambda: not tree[0].gathered, 10.0)
+            self.assertEqual(self.pull(tree[0], p["page"])["status"],
+                             "page not found")
+        finally:
+            for h, t in zip(tree, threads):
+                h.stop()
+                t.join()
+            for h in tree:
+                h.mudp.shutdown()
+                h.s.close()
+
+    def push(self, h: Congregation, schema: dict) -> dict:
+        key = self.send(h, "_schReq_", {"schema": schema})
+        rsp = list(self.client.recvRequestId(key, timeout=10.0))
+        self.assertEqual(len(rsp), 1)
+        cmd = json.loads(rsp[0][0])
+        self.assertEqual(cmd["cmd"], "_schCfm_")
+        return cmd["params"]
+
+    def test_schema(self):
+        tree = self.tree()
+        threads = [threading.Thread(target=h.poll) for h in tree]
+        for t in threads:
+            t.start()
+        try:
+            # Sent to the left, it is routed to the summit, which pushes it
+            # to every Congregation.
+            p = self.push(tree[1], {"a": 1})
+            self.assertEqual(p["routing"], True)
+            self.assertEqual(p["Congregation"], [tree[0].host, tree[0].port])
+            self.assertEqual(self.push(tree[0], {"a": 1}),
+                             {"routing": False, "partial": []})
+            self.assertEqual([h.ws.schema for h in tree], [{"a": 1}] * 3)
+            # The right is gone, the others are updated.
+            tree[2].stop()
+            threads[2].join()
+            self.assertEqual(self.push(tree[0], {"b": 2}), {
+                "routing": False, "partial": [[tree[2].host, tree[2].port]]})
+            self.assertEqual([h.ws.schema for h in tree],
+                             [{"b": 2}, {"b": 2}, {"a": 1}])
+        finally:
+            for h, t in zip(tree, threads):
+                h.stop()
+                t.join()
+            for h in tree:
+                h.mudp.shutdown()
+                h.s.close()
+
+    def test_ready(self):
+        d = tempfile.mkdtemp()
+        h = Starting(d)
+        t = threading.Thread(target=h.poll)
+        t.start()
+        port = 0
+        try:
+            key = self.send(h, "_startReq_", {"cmdUuid": "1"})
+            rsp = list(self.client.recvRequestId(key, timeout=30.0))
+            self.assertEqual(len(rsp), 1)
+            cmd = json.loads(rsp[0][0])
+            self.assertEqual(cmd["cmd"], "_startCfm_")
+            port = cmd["params"]["port"]
+            fn = Hallelu.processFile(d, "h", "1")
+            self.assertEqual(h.readProcessFile(fn)[1], port)
+            self.assertNotEqual(port, 0)
+            self.assertEqual(h.heartbeats[fn][1], port)
+            self.assertNotIn(fn, h.processTimers.timers)
+        finally:
+            if port:
+                self.client.send(
+                    json.dumps({"cmd": "_STOP_", "params": {}}), True,
+                    MUDPBuildMsg(MUDPKey((h.host, port))))
+            h.stop()
+            t.join()
+            h.mudp.shutdown()
+            h.s.close()
+
+    def test_pages(self):
+        h = Paging(tempfile.mkdtemp())
+        try:
+            cmd = {"cmd": "_cmdInd_", "params": {"filters": {}}}
+            nxt = {"routing": False, "Congregation": ("left", 1)}
+            items = [(str(i), {"uuid": str(i)} if i % 2 else None)
+                     for i in range(10)]
+            # By count, the page continues after the last item it read.
+            h._indRsp(cmd, "_cmdRsp_", "cmds", iter(items), nxt)
+            (title, p) = h.sent.pop()
+            self.assertEqual(title, "_cmdRsp_")
+            self.assertEqual([c["uuid"] for c in p["cmds"]], ["1", "3", "5"])
+            self.assertEqual(p["page"], {"after": "6", "next": nxt})
+            self.assertEqual(p["Congregation"], (h.host, h.port))
+            # The last page has the redirection.
+            h._indRsp(cmd, "_cmdRsp_", "cmds", iter(items[7:]), nxt)
+            (title, p) = h.sent.pop()
+            self.assertEqual(p, dict(nxt, cmds=[{"uuid": "7"}, {"uuid": "9"}]))
+            # By size, a larger item is alone on its page.
+            big = "x" * (h.mudp.maxPayload * h.indPageDatagrams)
+            items = [("a", {"uuid": "a"}), ("b", {"uuid": "b", "big": big}),
+                     ("c", {"uuid": "c"})]
+            h._indRsp(cmd, "_cmdRsp_", "cmds", iter(items), nxt)
+            self.assertEqual(h.sent.pop()[1]["page"]["after"], "a")
+            h._indRsp(cmd, "_cmdRsp_", "cmds", iter(items[1:]), nxt)
+            self.assertEqual(h.sent.pop()[1]["page"]["after"], "b")
+            # The page continues after a command that was deleted since.
+            h.cmdInd(None, {"cmd": "_cmdInd_", "params": {
+                "filters": {}, "page": {"after": "gone", "next": nxt}}})
+            self.assertEqual(h.sent.pop(), ("_cmdRsp_", {
+                "status": "page not found", "routing": False}))
+            h.sheetInd(None, {"cmd": "_sheetInd_", "params": {
+                "filters": {}, "page": {"after": "gone", "next": nxt}}})
+            self.assertEqual(h.sent.pop(), ("_sheetRsp_", {
+                "status": "page not found", "routing": False}))
+        finally:
+            h.mudp.shutdown()
+            h.s.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
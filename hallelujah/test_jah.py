@@ -0,0 +1,106 @@
+# This file is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This file is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# See the GNU General Public License, <https://www.gnu.org/licenses/>.
+#
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+from hallelujah.jah import Jah
+from hallelujah.worker_pool import WorkerPool
+
+
+class Registered(Jah):
+    cmds = {"decoder": "json:JSONDecoder", "encoder": json.JSONEncoder}
+
+
+class Lazy(Jah):
+    cmds = {"scheduler": "sched:scheduler"}
+
+
+def startJah(cwd: str, uuid: str, halleludir: str, out: str) -> None:
+    """Writes the worker's modules before and after the Jah starts."""
+    before = list(sys.modules)
+    j = Lazy(cwd, uuid, 0, halleludir)
+    j.mudp.shutdown()
+    j.s.close()
+    with open(out, "w") as f:
+        json.dump([before, list(sys.modules)], f)
+
+
+class TestJah(unittest.TestCase):
+    # Microseconds to import hallelujah.jah, pandas alone is several times
+    # this.
+    importBudget = 1000000
+
+    def test_cmdType(self):
+        self.assertIs(Registered.cmdType("decoder"), json.JSONDecoder)
+        self.assertIs(Registered.cmdType("encoder"), json.JSONEncoder)
+        self.assertIsNone(Registered.cmdType("files"))
+
+    def test_importTime(self):
+        # A new interpreter, as this one has imported the modules already.
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        r = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c",
+             "import sys, hallelujah.jah; print(' '.join(sys.modules))"],
+            cwd=root, capture_output=True, text=True, check=True)
+        modules = r.stdout.split()
+        for m in ("pandas", "discovery", "hallelujah.cmds"):
+            self.assertNotIn(m, modules)
+        # import time: self [us] | cumulative | imported package
+        us = [int(line.split("|")[1]) for line in r.stderr.splitlines()
+              if line.endswith(" hallelujah.jah")]
+        self.assertEqual(len(us), 1)
+        self.assertLess(us[0], self.importBudget)
+
+    def ready(self, pool: WorkerPool) -> float:
+        """Seconds until the pool's worker is idle."""
+        started = time.time()
+        pool.fill()
+        while not pool.idle:
+            self.assertLess(time.time() - started, 60)
+            pool.poll()
+            time.sleep(0.01)
+        return time.time() - started
+
+    def test_worker(self):
+        # A worker's preload is within the budget of an interpreter that
+        # preloads nothing.
+        bare = WorkerPool(1, preload=[])
+        pool = WorkerPool(1)
+        d = tempfile.mkdtemp()
+        out = os.path.join(d, "modules.json")
+        with open(Jah.processFile(d, "j", "1"), "w") as f:
+            f.write(json.dumps({"cmd": "scheduler"}) + "\n")
+        try:
+            base = self.ready(bare)
+            bare.stop()
+            self.assertLess(self.ready(pool) - base, self.importBudget / 1e6)
+            self.assertTrue(pool.assign("j", startJah, [d, "1", d, out]))
+            until = time.time() + 60
+            while not os.path.exists(out) and time.time() < until:
+                pool.poll()
+                time.sleep(0.05)
+            with open(out, "r") as f:
+                (before, after) = json.load(f)
+        finally:
+            bare.stop()
+            pool.stop()
+        for m in ("pandas", "discovery", "hallelujah.cmds.loadf"):
+            self.assertNotIn(m, after)
+        # The process file names the command, which the worker imports for it.
+        self.assertIn("hallelujah.jah", before)
+        self.assertNotIn("sched", before)
+        self.assertIn("sched", after)
@@ -0,0 +1,474 @@
+# This file is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This file is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# See the GNU General Public License, <https://www.gnu.org/licenses/>.
+#
+import asyncio
+import json
+import marshal
+import os
+import socket
+import tempfile
+import threading
+import time
+import unittest
+from copy import copy
+from hallelujah.root import RootH, RootHAsync, RootHJC, RootHMarshalCodec, RootHShard
+from magpie.src.mudp import MUDP, MUDPBuildMsg, MUDPFrame, MUDPKey
+
+
+class Echo(RootH):
+    # Echoes in the shard of the peer, counts in the primary.
+    shardClass = "hallelujah.test_root:EchoShard"
+
+    def __init__(self, port: int, shards: int):
+        super().__init__("echo", congregationPort=port, congregationHost="127.0.0.1", port=port, shards=shards)
+        self.processCmd["_echoReq_"] = self.echoReq
+        self.processCmd["_countReq_"] = self.countReq
+        self.echoed = 0
+
+    def echoReq(self, key: MUDPKey, cmd: dict) -> None:
+        self.echoed += 1
+        self.sendCfm(cmd, "_echoCfm_", cmd["params"])
+
+    def countReq(self, key: MUDPKey, cmd: dict) -> None:
+        self.sendCfm(cmd, "_countCfm_", {"echoed": self.echoed})
+
+
+class EchoShard(RootHShard):
+    def __init__(self, title: str, congregationPort: int, host: str, port: int, primaryAddr: (str, int)):
+        super().__init__(title, congregationPort, host, port, primaryAddr)
+        self.processCmd["_echoReq_"] = self.echoReq
+
+    def echoReq(self, key: MUDPKey, cmd: dict) -> None:
+        self.sendCfm(cmd, "_echoCfm_", dict(cmd["params"], title=self.title))
+
+
+class CachedEcho(Echo):
+    cachedCmds = {"_echoReq_"}
+
+
+class Prioritized(Echo):
+    cmdClasses = dict(RootH.cmdClasses, _bulkReq_="bulk")
+
+    def __init__(self, port: int):
+        super().__init__(port, shards=0)
+        self.processCmd["_bulkReq_"] = self.bulkReq
+        self.handled = []
+
+    def echoReq(self, key: MUDPKey, cmd: dict) -> None:
+        self.handled.append("_echoReq_")
+        super().echoReq(key, cmd)
+
+    def bulkReq(self, key: MUDPKey, cmd: dict) -> None:
+        self.handled.append("_bulkReq_")
+
+
+
+class Bounded(Prioritized):
+    msgClasses = dict(RootH.msgClasses, bulk=(1, 5))
+
+    def __init__(self, port: int):
+        super().__init__(port)
+        self.longest = 0
+
+    def read(self) -> bool:
+        r = super().read()
+        self.longest = max(self.longest, len(self.queues["bulk"]))
+        return r
+
+
+class AsyncEcho(RootHAsync):
+    def __init__(self, port: int):
+        super().__init__("echo", congregationPort=port, congregationHost="127.0.0.1", port=port)
+        self.processCmd["_echoReq_"] = self.echoReq
+        self.processCmd["_slowReq_"] = self.slowReq
+        self.processCmd["_nameReq_"] = self.nameReq
+        self.sent = None
+
+    def echoReq(self, key: MUDPKey, cmd: dict) -> None:
+        self.sendCfm(cmd, "_echoCfm_", cmd["params"])
+
+    def nameReq(self, key: MUDPKey, cmd: dict) -> None:
+        # To the requester by name, resolved on the loop.
+        self.sent = self.sendReq("_nameInd_", cmd["params"], ("localhost", key.getAddr()[1]))
+
+    async def slowReq(self, key: MUDPKey, cmd: dict) -> None:
+        await asyncio.sleep(1.0)
+        self.sendCfm(cmd, "_slowCfm_", cmd["params"])
+
+
+class TestRootH(unittest.TestCase):
+
+    def setUp(self):
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        s.bind(("127.0.0.1", 0))
+        self.port = s.getsockname()[1]
+        s.close()
+        self.clientS = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.clientS.settimeout(5)
+        self.clientS.bind(("127.0.0.1", 0))
+        self.client = MUDP(self.clientS, skipBad=False)
+
+    def tearDown(self):
+        self.client.shutdown()
+        self.clientS.close()
+
+    def send(self, title: str, params: dict) -> MUDPKey:
+        return self.client.send(
+            json.dumps({"cmd": title, "params": params}), True,
+            MUDPBuildMsg(MUDPKey(("127.0.0.1", self.port))), demux=True)
+
+    def request(self, title: str, params: dict, key: MUDPKey = None) -> dict:
+        if key is None:
+            key = self.send(title, params)
+        rsp = list(self.client.recvRequestId(key, timeout=10.0))
+        self.assertEqual(len(rsp), 1)
+        return json.loads(rsp[0][0])
+
+    def test_shards(self):
+        h = Echo(self.port, shards=2)
+        t = threading.Thread(target=h.poll)
+        t.start()
+        try:
+            self.assertNotEqual(h.port, self.port)
+            # Handled by the shard of this peer.
+            rsp = self.request("_echoReq_", {"n": 1})
+            self.assertEqual(rsp["cmd"], "_echoCfm_")
+            self.assertEqual(rsp["params"]["n"], 1)
+            self.assertIn("echo-shard", rsp["params"]["title"])
+            # Forwarded to the primary, and relayed back through a shard.
+            rsp = self.request("_countReq_", {})
+            self.assertEqual(rsp, {"cmd": "_countCfm_", "params": {"echoed": 0}})
+            rsp = self.request("_metricsReq_", {})
+            self.assertEqual(rsp["cmd"], "_metricsCfm_")
+            self.assertIn("-shard", rsp["params"]["title"])
+        finally:
+            h.stop()
+            t.join()
+            h.stopShards()
+            h.mudp.shutdown()
+            h.s.close()
+
+    def test_shardsShm(self):
+        h = Echo(self.port, shards=3)
+        t = threading.Thread(target=h.poll)
+        t.start()
+        clients = []
+        try:
+            addr = ("127.0.0.1", self.port)
+            # Clients on other ports are spread over the shards, each shard
+            # has its own doorbell on the shared port.
+            for i in range(4):
+                s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                s.bind(("127.0.0.1", 0))
+                clients.append((s, MUDP(s, skipBad=False, shm=True)))
+            for s, client in clients:
+                client.peerCaps(addr)
+                until = time.time() + 5.0
+                while not client.peerCaps(addr) and time.time() < until:
+                    time.sleep(0.01)
+                self.assertTrue(client.peerCaps(addr) & MUDPFrame.CAP_SHM)
+            for n in range(6):
+                for s, client in clients:
+                    key = client.send(
+                        json.dumps({"cmd": "_echoReq_", "params": {"n": n}}), True,
+                        MUDPBuildMsg(MUDPKey(addr)), demux=True)
+                    rsp = list(client.recvRequestId(key, timeout=5.0))
+                    self.assertEqual(len(rsp), 1)
+                    cmd = json.loads(rsp[0][0])
+                    self.assertEqual(cmd["cmd"], "_echoCfm_")
+                    self.assertEqual(cmd["params"]["n"], n)
+                    self.assertIn("echo-shard", cmd["params"]["title"])
+            self.assertEqual(h.echoed, 0)
+            for s, client in clients:
+                self.assertIn(addr, client.doorbells)
+                self.assertGreater(client.sendMetrics.peers[addr]["shmSent"], 0)
+        finally:
+            for s, client in clients:
+                client.shutdown()
+                s.close()
+            h.stop()
+            t.join()
+            h.stopShards()
+            h.mudp.shutdown()
+            h.s.close()
+
+    def test_cache(self):
+        h = CachedEcho(self.port, shards=0)
+        t = threading.Thread(target=h.poll)
+        t.start()
+        try:
+            # A retransmission has the request id of the request it repeats.
+            key = MUDPKey(("127.0.0.1", self.port), requestId=7)
+            for i in range(3):
+                self.client.send(
+                    json.dumps({"cmd": "_echoReq_", "params": {"n": 1}}),
+                    True, MUDPBuildMsg(copy(key)), demux=True)
+                rsp = self.request("_echoReq_", {}, key=key)
+                self.assertEqual(rsp, {"cmd": "_echoCfm_", "params": {"n": 1}})
+            self.assertEqual(h.echoed, 1)
+            self.assertEqual(h.responseHits, 2)
+            self.request("_echoReq_", {"n": 2})
+            # A peer on another version is answered in JSON.
+            key = self.client.send(
+                json.dumps({"cmd": "_echoReq_", "params": {"n": 3},
+                            "__codecs__": ["marshal4-2.7", "json"]}), True,
+                MUDPBuildMsg(MUDPKey(("127.0.0.1", self.port))), demux=True)
+            rsp = list(self.client.recvRequestId(key, timeout=10.0))
+            self.assertEqual(json.loads(rsp[0][0]),
+                             {"cmd": "_echoCfm_", "params": {"n": 3}})
+            self.assertEqual(h.echoed, 3)
+        finally:
+            h.stop()
+            t.join()
+            h.mudp.shutdown()
+            h.s.close()
+
+    def test_retransmit(self):
+        h = Echo(self.port, shards=0)
+        h.mudp.reader.skip = 3  # Loses the third datagram, and NACKs for it.
+        self.client.shutdown()
+        self.client = MUDP(self.clientS, skipBad=False, maxPayload=100, retransmit=True)
+        t = threading.Thread(target=h.poll)
+        t.start()
+        try:
+            addr = ("127.0.0.1", self.port)
+            self.client.peerCaps(addr)
+            until = time.time() + 5.0
+            while not self.client.peerCaps(addr) and time.time() < until:
+                time.sleep(0.01)
+            self.assertTrue(self.client.peerCaps(addr) & MUDPFrame.CAP_NACK)
+            rsp = self.request("_echoReq_", {"n": "x" * 1000})
+            self.assertEqual(rsp, {"cmd": "_echoCfm_", "params": {"n": "x" * 1000}})
+            self.assertGreater(h.mudp.reader.nackCount, 0)
+            self.assertEqual(self.client.reader.retransmits.retransmitted, 1)
+        finally:
+            h.stop()
+            t.join()
+            h.mudp.shutdown()
+            h.s.close()
+
+    def test_codecs(self):
+        codec = RootHMarshalCodec()
+        cmd = {"cmd": "_echoReq_", "params": {"a": [1, -2.5, None, True, "x"]},
+               "__remote_address__": ("127.0.0.1", 1)}
+        b = codec.encode(cmd)
+        self.assertTrue(codec.accepts(b))
+        self.assertFalse(codec.accepts(json.dumps(cmd).encode('utf-8')))
+        self.assertEqual(codec.decode(b), json.loads(json.dumps(cmd)))
+        # As JSON decodes it.
+        cmd = {"cmd": "_echoReq_", "params": {1: (1, (2, 3)), None: [{2.5: True}]}}
+        self.assertEqual(codec.decode(codec.encode(cmd)), json.loads(json.dumps(cmd)))
+        for params in [{"a": b"x"}, {"a": [{1, 2}]}, {(1, 2): 1}, {"a": 1j}]:
+            with self.assertRaises(Exception):
+                codec.decode(codec.encode({"cmd": "_echoReq_", "params": params}))
+        l = [1]
+        with self.assertRaises(Exception):  # JSON has no references.
+            codec.decode(codec.encode({"cmd": "_echoReq_", "params": {"a": l, "b": l}}))
+        with self.assertRaises(Exception):
+            codec.decode(codec.header + marshal.dumps(compile("1", "", "eval")))
+        # Marshal from another interpreter version is not decoded as marshal.
+        self.assertFalse(codec.accepts(bytes((codec.marker, 2, 7)) + b[3:]))
+        self.client.shutdown()
+        self.client = MUDP(self.clientS, skipBad=False, text=False)
+        h = Echo(self.port, shards=0)
+        t = threading.Thread(target=h.poll)
+        t.start()
+        try:
+            # A peer that lists this interpreter's marshal is answered in it.
+            key = self.client.send(
+                json.dumps({"cmd": "_echoReq_", "params": {"n": 1},
+                            "__codecs__": [codec.name, "json"]}), True,
+                MUDPBuildMsg(MUDPKey(("127.0.0.1", self.port))), demux=True)
+            rsp = list(self.client.recvRequestId(key, timeout=10.0))
+            self.assertEqual(len(rsp), 1)
+            self.assertEqual(codec.decode(rsp[0][0]),
+                             {"cmd": "_echoCfm_", "params": {"n": 1}})
+            # And a request in marshal has the marshal answer.
+            key = self.client.send(
+                codec.encode({"cmd": "_echoReq_", "params": {"n": 2}}), True,
+                MUDPBuildMsg(MUDPKey(("127.0.0.1", self.port))), demux=True)
+            rsp = list(self.client.recvRequestId(key, timeout=10.0))
+            self.assertEqual(codec.decode(rsp[0][0]),
+                             {"cmd": "_echoCfm_", "params": {"n": 2}})
+            # A peer on another version is answered in JSON.
+            key = self.client.send(
+                json.dumps({"cmd": "_echoReq_", "params": {"n": 3},
+                            "__codecs__": ["marshal4-2.7", "json"]}), True,
+                MUDPBuildMsg(MUDPKey(("127.0.0.1", self.port))), demux=True)
+            rsp = list(self.client.recvRequestId(key, timeout=10.0))
+            self.assertEqual(json.loads(rsp[0][0]),
+                             {"cmd": "_echoCfm_", "params": {"n": 3}})
+            self.assertEqual(h.echoed, 3)
+        finally:
+            h.stop()
+            t.join()
+            h.mudp.shutdown()
+            h.s.close()
+
+    def test_stats(self):
+        h = Echo(self.port, shards=0)
+        t = threading.Thread(target=h.poll)
+        t.start()
+        try:
+            rsp = self.request("_statsReq_", {})
+            self.assertEqual(rsp["params"]["profile"], False)
+            self.assertEqual(rsp["params"]["stats"], {})
+            self.request("_statsReq_", {"profile": True})
+            self.request("_echoReq_", {"n": 1})
+            self.request("_echoReq_", {"n": 2})
+            stats = self.request("_statsReq_", {})["params"]["stats"]
+            self.assertEqual(stats["_echoReq_"]["count"], 2)
+            self.assertGreaterEqual(stats["decode"]["count"], 3)
+            rsp = self.request("_statsReq_", {"reset": True})
+            self.assertNotIn("_echoReq_", rsp["params"]["stats"])
+            self.request("_statsReq_", {"profile": False})
+            self.assertIsNone(h.stats)
+        finally:
+            h.stop()
+            t.join()
+            h.mudp.shutdown()
+            h.s.close()
+
+    def test_priority(self):
+        h = Prioritized(self.port)
+        for i in range(40):
+            self.send("_bulkReq_", {"n": i})
+        key = self.send("_echoReq_", {"n": 1})
+        time.sleep(0.5)  # Arrived before poll starts.
+        t = threading.Thread(target=h.poll)
+        t.start()
+        try:
+            rsp = self.request("_echoReq_", {}, key=key)
+            self.assertEqual(rsp, {"cmd": "_echoCfm_", "params": {"n": 1}})
+            # The default class is served before bulk, in arrival order.
+            self.assertEqual(h.handled[0], "_echoReq_")
+            until = time.time() + 5.0
+            while len(h.handled) < 41 and time.time() < until:
+                time.sleep(0.01)
+            self.assertEqual(h.handled.count("_bulkReq_"), 40)
+        finally:
+            h.stop()
+            t.join()
+            h.mudp.shutdown()
+            h.s.close()
+
+    def test_queueMax(self):
+        h = Bounded(self.port)
+        for i in range(40):
+            self.send("_bulkReq_", {"n": i})
+        time.sleep(0.5)  # Arrived before poll starts.
+        t = threading.Thread(target=h.poll)
+        t.start()
+        try:
+            until = time.time() + 5.0
+            while len(h.handled) < 40 and time.time() < until:
+                time.sleep(0.01)
+            # Reading stopped at queueMax, and the rest was read later.
+            self.assertEqual(h.handled.count("_bulkReq_"), 40)
+            self.assertEqual(h.longest, 5)
+        finally:
+            h.stop()
+            t.join()
+            h.mudp.shutdown()
+            h.s.close()
+
+    def test_keepalive(self):
+        # RootHJC sends to Congregation on this host's name.
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        s.bind(("", 0))
+        congregation = MUDP(s, skipBad=False)
+        d = tempfile.mkdtemp()
+        fn = os.path.join(d, "t_1.json")
+        with open(fn, "w") as f:
+            f.write(json.dumps({"cmd": "test"}) + "\n")
+        h = RootHJC(os.getcwd(), "1", d, "t", congregationPort=s.getsockname()[1])
+        t = threading.Thread(target=h.poll)
+        t.start()
+        try:
+            rsp = []
+            until = time.time() + 10.0
+            while not rsp and time.time() < until:
+                rsp = list(congregation.recv(timeout=1.0))
+            cmd = json.loads(rsp[0][1])
+            self.assertEqual(cmd["cmd"], "_readyInd_")
+            self.assertEqual(cmd["params"],
+                             {"title": "t", "cmdUuid": "1", "port": h.port})
+            h.keepaliveTimer.timers[fn] = (0, None)  # Due.
+            rsp = []
+            until = time.time() + 10.0
+            while not rsp and time.time() < until:
+                rsp = list(congregation.recv(timeout=1.0))
+            cmd = json.loads(rsp[0][1])
+            self.assertEqual(cmd["cmd"], "_keepaliveInd_")
+            self.assertEqual(cmd["params"],
+                             {"title": "t", "cmdUuid": "1", "port": h.port})
+            # Stale, Congregation stops the process.
+            congregation.send(
+                json.dumps({"cmd": "_STOP_", "params": {}}), True,
+                MUDPBuildMsg(MUDPKey((h.host, h.port))))
+            t.join(10.0)
+            self.assertFalse(t.is_alive())
+        finally:
+            h.stop()
+            t.join()
+            h.mudp.shutdown()
+            h.s.close()
+            congregation.shutdown()
+            s.close()
+
+    def test_keepaliveRemoved(self):
+        # The process file was removed and the _STOP_ lost.
+        d = tempfile.mkdtemp()
+        fn = os.path.join(d, "t_1.json")
+        with open(fn, "w") as f:
+            f.write(json.dumps({"cmd": "test"}) + "\n")
+        h = RootHJC(os.getcwd(), "1", d, "t", congregationPort=self.port)
+        t = threading.Thread(target=h.poll)
+        t.start()
+        try:
+            os.remove(fn)
+            h.keepaliveTimer.timers[fn] = (0, None)  # Due.
+            t.join(10.0)
+            self.assertFalse(t.is_alive())
+        finally:
+            h.stop()
+            t.join()
+            h.mudp.shutdown()
+            h.s.close()
+
+    def test_async(self):
+        h = AsyncEcho(self.port)
+        t = threading.Thread(target=h.poll)
+        t.start()
+        try:
+            slow = self.send("_slowReq_", {"n": 1})
+            started = time.time()
+            # The slow handler awaits, and does not hold up the echo.
+            rsp = self.request("_echoReq_", {"n": 2})
+            self.assertEqual(rsp, {"cmd": "_echoCfm_", "params": {"n": 2}})
+            self.assertLess(time.time() - started, 0.9)
+            rsp = self.request("_slowReq_", {}, key=slow)
+            self.assertEqual(rsp, {"cmd": "_slowCfm_", "params": {"n": 1}})
+            self.send("_nameReq_", {"n": 3})
+            got = []
+            until = time.time() + 5.0
+            while not got and time.time() < until:
+                got = list(self.client.recv(timeout=1.0))
+            cmd = json.loads(got[0][1])
+            self.assertEqual((cmd["cmd"], cmd["params"]), ("_nameInd_", {"n": 3}))
+            self.assertEqual(got[0][0].getRequestId(), h.sent)
+            port = self.clientS.getsockname()[1]
+            self.assertEqual(h.resolved[("localhost", port)], ("127.0.0.1", port))
+        finally:
+            h.stop()
+            t.join()
+            h.s.close()
@@ -0,0 +1,65 @@
+# This file is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This file is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# See the GNU General Public License, <https://www.gnu.org/licenses/>.
+#
+import json
+import os
+import tempfile
+import time
+import unittest
+from hallelujah.root import RootHJC
+from hallelujah.worker_pool import WorkerPool
+
+
+def startRoot(cwd: str, uuid: str, halleludir: str) -> None:
+    h = RootHJC(cwd, uuid, halleludir, "t", congregationPort=0)
+    h.mudp.shutdown()
+    h.s.close()
+
+
+def failRoot() -> None:
+    raise Exception("failed to start")
+
+
+class TestWorkerPool(unittest.TestCase):
+
+    def wait(self, pool: WorkerPool, f: any) -> any:
+        until = time.time() + 60
+        while time.time() < until:
+            r = f(pool)
+            if r:
+                return r
+            pool.fill()
+            time.sleep(0.05)
+        self.fail("timed out")
+
+    def test_assign(self):
+        pool = WorkerPool(1, preload=["json"])
+        d = tempfile.mkdtemp()
+        fn = os.path.join(d, "t_1.json")
+        with open(fn, "w") as f:
+            f.write(json.dumps({"cmd": "test"}) + "\n")
+        try:
+            self.assertFalse(pool.assign(fn, startRoot, [d, "1", d]))
+            self.wait(pool, lambda p: p.poll() == {} and p.idle)
+            self.assertTrue(pool.assign(fn, startRoot, [d, "1", d]))
+            started = self.wait(pool, lambda p: p.poll())
+            with open(fn, "r") as f:
+                f.readline()
+                port = json.loads(f.readline())["port"]
+            self.assertEqual(started, {fn: port})
+            self.assertNotEqual(port, 0)
+            # The pool fills again, and a failure reports port zero.
+            self.wait(pool, lambda p: p.poll() == {} and p.idle)
+            self.assertTrue(pool.assign("failed", failRoot, []))
+            self.assertEqual(self.wait(pool, lambda p: p.poll()), {"failed": 0})
+        finally:
+            pool.stop()
@@ -0,0 +1,146 @@
+# This file is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This file is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# See the GNU General Public License, <https://www.gnu.org/licenses/>.
+#
+# A worker is a spawned interpreter that has imported the modules of Hallelu
+# and Jah, but not those of every command, and waits on its pipe. Congregation
+# assigns a process to a worker, which then becomes that Hallelu or Jah, and
+# reports the port from RootHJC through the pipe, see RootHJC.started.
+# The pool is filled again a worker at a time, so redeploying many commands
+# does not start many interpreters at once.
+import importlib
+import multiprocessing
+import os
+import traceback
+from collections import deque
+from multiprocessing.connection import wait
+from hallelujah.root import RootHJC
+from magpie.src.mlogger import MLogger, mlogger
+
+
+class WorkerPool():
+    """
+ WorkerPool: size workers waiting for assign(), see poll() for the ports of
+ the processes that started.
+    """
+    # Jah imports its command when the process file names it, see
+    # Jah.cmdType(), a worker has imported the light ones already. Loadf
+    # imports pandas, so only a worker assigned a Loadf process imports it.
+    preload = [
+        "hallelujah.hallelu", "hallelujah.jah", "hallelujah.cmds.files",
+        "hallelujah.cmds.test"
+    ]
+
+    def __init__(self, size: int, preload: list = None):
+        self.size = size
+        if preload is not None:
+            self.preload = preload
+        self.ctx = multiprocessing.get_context("spawn")
+        self.warming = {}  # conn -> process, until the worker is ready.
+        self.idle = deque()  # (process, conn)
+        self.assigned = {}  # conn -> (process, name)
+
+    def fill(self) -> bool:
+        """Start a worker when the pool is short. Return True when started."""
+        if self.warming or len(self.idle) >= self.size:
+            return False
+        (conn, child) = self.ctx.Pipe()
+        p = self.ctx.Process(
+            target=WorkerPool.run, args=(child, self.preload, MLogger.isDebug()))
+        p.start()
+        child.close()
+        self.warming[conn] = p
+        return True
+
+    def assign(self, name: str, target: any, args: list) -> bool:
+        """Run target(*args) in an idle worker, False when none is idle. The
+           target is picklable, e.g. Jah.child_main."""
+        while self.idle:
+            (p, conn) = self.idle.popleft()
+            try:
+                conn.send((target, args))
+            except (BrokenPipeError, EOFError, OSError):
+                conn.close()
+                continue
+            self.assigned[conn] = (p, name)
+            if MLogger.isDebug():
+                mlogger.debug(f"WorkerPool {p.pid} assigned {name}")
+            return True
+        return False
+
+    def poll(self) -> dict:
+        """Return name -> port of the assigned processes that reported, port
+           zero when the process failed to start."""
+        started = {}
+        conns = list(self.warming) + list(self.assigned)
+        for conn in wait(conns, timeout=0) if conns else []:
+            try:
+                msg = conn.recv()
+            except (EOFError, OSError):
+                msg = ("failed", "exited")
+            if conn in self.warming:
+                p = self.warming.pop(conn)
+                if msg[0] == "ready":
+                    self.idle.append((p, conn))
+                else:
+                    conn.close()
+                continue
+            (p, name) = self.assigned.pop(conn)
+            conn.close()
+            started[name] = msg[1] if msg[0] == "port" else 0
+            if MLogger.isDebug():
+                mlogger.debug(f"WorkerPool {p.pid} {name} {msg}")
+        return started
+
+    def stop(self) -> None:
+        """Stop the workers that are not assigned, assigned processes run on."""
+        for conn, p in list(self.warming.items()):
+            conn.close()
+            p.terminate()
+        for p, conn in self.idle:
+            conn.close()
+            p.terminate()
+        for conn, (p, name) in self.assigned.items():
+            conn.close()
+        self.warming = {}
+        self.idle = deque()
+        self.assigned = {}
+
+    @staticmethod
+    def run(conn: any, preload: list, debug: bool) -> None:
+        if debug:
+            MLogger.init("DEBUG")
+        for m in preload:
+            try:
+                importlib.import_module(m)
+            except Exception:
+                # The assigned process imports what it needs, or fails.
+                if MLogger.isError():
+                    mlogger.error(f"WorkerPool {os.getpid()} preload {m} "
+                                  + traceback.format_exc())
+        conn.send(("ready", os.getpid()))
+        try:
+            (target, args) = conn.recv()
+        except EOFError:
+            return  # The pool stopped, or Congregation exited.
+
+        def started(port: int) -> None:
+            RootHJC.started = None
+            conn.send(("port", port))
+            conn.close()
+        RootHJC.started = started
+        try:
+            target(*args)
+        except Exception:
+            if RootHJC.started is not None:  # Before the port was reported.
+                RootHJC.started = None
+                conn.send(("failed", traceback.format_exc()))
+            raise
@@ -30,6 +30,16 @@ class WorksheetManager(RootH,threading.Thread):
  the latest changes from the database, or push the local changes into the
  database.
     """
+    # Pull with one scatter-gather over the Congregations, rather than a walk
+    # from one to the next, see Congregation._fanout().
+    fanout: bool = True
+    # Seconds before a request is retransmitted, longer than the
+    # Congregation's fanoutSeconds so a retransmission does not scatter
+    # again, and the attempts to where it was sent before starting again
+    # from the local congregation.
+    cmdSeconds: int = 8
+    cmdAttempts: int = 3
+
     def __init__(self, congregationPort: int, worksheetdir: str, 
                  congregationHost: str=""):
         try:
@@ -48,7 +58,9 @@ class WorksheetManager(RootH,threading.Thread):
                 "_cmdRsp_": self.__cmdRsp,
                 "_cmdCfm_": self.__cmdCfm
             })
-            self.cmdTimer = mTimer(3)
+            self.cmdTimer = mTimer(self.cmdSeconds)
+            # Congregations missing from the last pull, see __continueReq().
+            self.partial = []
             self.filters={}
             p=os.path.join(worksheetdir,".dbversion")
             shutil.rmtree(p,ignore_errors=True)
@@ -56,9 +68,9 @@ class WorksheetManager(RootH,threading.Thread):
             self.worksheets.copySchema(p)
             self.dbworksheets = MWorksheets(p)
             self.dbworksheets_state = None
+            self.error = None
             self.start()  # Start the thread, see self.run()
             self.pull()
-            self.error = None
         except:
             self.stop = True
             raise
@@ -78,36 +90,44 @@ class WorksheetManager(RootH,threading.Thread):
             "params": {
                 "filters": self.filters,
                 "sheetUuid": None,
-                "routing": True
+                "routing": True,
+                "fanout": self.fanout
             },
             "addr":self.congregation_addr
         }
         self.cmdTimer.start(k=1,v=v)
-        self.sendReq(
+        v["sent"] = (v["addr"], self.sendReq(
             title=v["msgtype"],
             params=v["params"],
             remoteAddr=v["addr"]
-        )
+        ))
         while self.dbworksheets_state == "pulling":
             time.sleep(1)
+        if self.dbworksheets_state == "failed":
+            self.dbworksheets_state = None
+            return self.error
         self.dbworksheets_state = "pulling"
         v={
             "msgtype": "_cmdInd_",
             "params": {
                 "filters": self.filters,
                 "cmdUuid": None,
-                "routing": True
+                "routing": True,
+                "fanout": self.fanout
             },
             "addr":self.congregation_addr
         }
         self.cmdTimer.start(k=1,v=v)
-        self.sendReq(
+        v["sent"] = (v["addr"], self.sendReq(
             title=v["msgtype"],
             params=v["params"],
             remoteAddr=v["addr"]
-        )
+        ))
         while self.dbworksheets_state == "pulling":
             time.sleep(1)
+        if self.dbworksheets_state == "failed":
+            self.dbworksheets_state = None
+            return self.error
         error = self.worksheets.pull(self.dbworksheets.dir)
         self.dbworksheets_state = None
         return error
@@ -116,56 +136,69 @@ class WorksheetManager(RootH,threading.Thread):
         """ Stop or continue requesting worksheet from database. """
         # Get params from timer before stopping it.
         p = cmd["params"]
-        v = self.cmdTimer.get(1)
-        self.cmdTimer.stop(1)
+        t = self.cmdTimer.getStop(1)
+        if t is None:  # A duplicate response.
+            return
+        v = t[1]
         if status and status not in ["deleted", "created", "updated"]:
             self.dbworksheets.save(self.dbworksheets.dir)
+            self.error = status
             self.dbworksheets_state = "failed"
             return
         # No more redirections means this is the last response.
-        if "Congregation" not in cmd:
+        if not p or "Congregation" not in p:
+            self.partial = (p or {}).get("partial", [])
+            if self.partial and MLogger.isError():
+                mlogger.error(f"{self.title} pull is missing {self.partial}")
             self.dbworksheets.save(self.dbworksheets.dir)
             self.dbworksheets_state = "built"
             return
-        # More redirections, copy the routing indicator and address from the response.
+        # More redirections, copy the routing indicator and address from the
+        # response, and the page when there are more here.
         v["params"]["routing"] = p["routing"]
+        if "page" in p:
+            v["params"]["page"] = p["page"]
+        else:
+            v["params"].pop("page", None)
         if status:
             v["params"]["status"] = status
         v["addr"] = p["Congregation"]
+        v["attempts"] = 0
         self.cmdTimer.start(k=1,v=v)
-        self.sendReq(
+        v["sent"] = (v["addr"], self.sendReq(
             title=v["msgtype"],
             params=v["params"],
             remoteAddr=v["addr"]
-        )
+        ))
 
     def __sheetRsp(self, key: MUDPKey, cmd: dict) -> None:
-        """ Build worksheet from sheet in sheetRsp. """
+        """ Build worksheet from the page of sheets in sheetRsp. """
         p = cmd["params"]
-        status=None
-        if p:
-            s = p["sheet"]
-            if s:
-                oldName = self.dbworksheets.getSheetName(s["uuid"])
-                status = self.dbworksheets.updateSheet(
-                    s["uuid"],oldName,s["name"])
+        status = (p or {}).get("status")  # E.g. page not found.
+        for s in (p or {}).get("sheets", []):
+            oldName = self.dbworksheets.getSheetName(s["uuid"])
+            status = self.dbworksheets.updateSheet(
+                s["uuid"],oldName,s["name"])
+            if status and status not in ["deleted", "created", "updated"]:
+                break
         self.__continueReq(cmd,status)
 
     def __cmdRsp(self, key: MUDPKey, cmd: dict) -> None:
-        """ Build worksheet from cmds in cmdRsp. """
+        """ Build worksheet from the page of cmds in cmdRsp. """
         p = cmd["params"]
-        status=None
-        if p:
-            c = p["cmd"]
-            if c:
-                oldCmd = self.dbworksheets.getCmdUuid(c["uuid"])
-                if oldCmd:
-                    (oldparams, oldselected,
-                     olddescription) = self.dbworksheets.paramsCmd(cmd=oldCmd,at=None)
-                (params, selected,
-                 description) = self.dbworksheets.paramsCmd(cmd=c,at=None)
-                status = self.dbworksheets.updateCmd(
-                    c["uuid"], c["cmd"], oldselected, selected, changelog=False)
+        status = (p or {}).get("status")  # E.g. page not found.
+        for c in (p or {}).get("cmds", []):
+            oldselected = None
+            oldCmd = self.dbworksheets.getCmdUuid(c["uuid"])
+            if oldCmd:
+                (oldparams, oldselected,
+                 olddescription) = self.dbworksheets.paramsCmd(cmd=oldCmd,at=None)
+            (params, selected,
+             description) = self.dbworksheets.paramsCmd(cmd=c,at=None)
+            status = self.dbworksheets.updateCmd(
+                c["uuid"], c["cmd"], oldselected, selected, changelog=False)
+            if status and status not in ["deleted", "created", "updated"]:
+                break
         self.__continueReq(cmd,status)
 
     def push(self, change:MJournalChange) -> str:
@@ -182,11 +215,11 @@ class WorksheetManager(RootH,threading.Thread):
             }
             self.dbworksheets_state = "pushing"
             self.cmdTimer.start(k=1,v=v)
-            self.sendReq(
+            v["sent"] = (v["addr"], self.sendReq(
                 title=v["msgtype"],
                 params=v["params"],
                 remoteAddr=v["addr"]
-            )
+            ))
             while self.dbworksheets_state == "pushing":
                 time.sleep(1)
             if self.dbworksheets_state == "failed":
@@ -204,12 +237,13 @@ class WorksheetManager(RootH,threading.Thread):
         p = cmd["params"]
         if "Congregation" in p: # Redirect request.
             v["params"]["routing"] = p["routing"]
+            v["attempts"] = 0
             self.cmdTimer.start(k=1,v=v)
-            self.sendReq(
+            v["sent"] = (p["Congregation"], self.sendReq(
                 title=v["msgtype"],
                 params=v["params"],
                 remoteAddr=p["Congregation"]
-            )
+            ))
         else:
             if p["status"] in ["deleted", "created", "updated"]:
                 self.dbworksheets_state = "pushed"
@@ -218,18 +252,30 @@ class WorksheetManager(RootH,threading.Thread):
                 self.error = p["status"]
                 
     def tick(self) -> bool:
-        """ Handle timeout with retransmit to the local congregation. """
+        """ Handle timeout with retransmit to where the request was sent, with
+            the same request id, so the congregation answers it from its
+            cache, or later when it is still answering. After cmdAttempts,
+            retransmit to the local congregation. """
         didSomething = super().tick()
         for k, v in self.cmdTimer.expired():
             didSomething = True
             v["first"] = True
-            v["addr"] = self.congregation_addr
+            (v["addr"], requestId) = v["sent"]
+            v["attempts"] = v.get("attempts", 0) + 1
+            if v["attempts"] > self.cmdAttempts:
+                v["attempts"] = 0
+                if tuple(v["addr"]) != tuple(self.congregation_addr):
+                    v["addr"] = self.congregation_addr
+                    requestId = -1
+                    v["params"]["routing"] = True
+                    v["params"].pop("page", None)  # A page of another congregation.
             self.cmdTimer.start(k=k,v=v)
-            self.sendReq(
+            v["sent"] = (v["addr"], self.sendReq(
                 title=v["msgtype"],
                 params=v["params"],
-                remoteAddr=v["addr"]
-            )
+                remoteAddr=v["addr"],
+                requestId=requestId
+            ))
         return didSomething
 
     def run(self) -> None:
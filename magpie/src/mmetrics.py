@@ -0,0 +1,151 @@
+# This file is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This file is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# See the GNU General Public License, <https://www.gnu.org/licenses/>.
+#
+# MMetrics holds counters, counters per peer, and histograms. A snapshot is
+# a dict that is serializable as json.
+# Each MMetrics is updated by one thread, the snapshot is taken by any
+# thread; the snapshot copies dicts and lists, which the GIL makes atomic,
+# so there are no locks.
+import os
+
+
+class MHistogram():
+    """
+    MHistogram counts values, which are integers, in buckets of powers of two.
+    Bucket n counts the values that are less than 2**n and at least 2**(n-1),
+    bucket zero counts values below one.
+    """
+    buckets: int = 40
+
+    def __init__(self):
+        self.counts = [0] * self.buckets
+        self.count = 0
+        self.sum = 0
+        self.max = 0
+
+    def add(self, v: int) -> None:
+        if v < 0:
+            v = 0
+        b = min(int(v).bit_length(), self.buckets - 1)
+        self.counts[b] += 1
+        self.count += 1
+        self.sum += v
+        if v > self.max:
+            self.max = v
+
+    # Upper bound of the bucket with the p'th percentile, 0 < p <= 100.
+    def percentile(self, p: float, counts: list = None) -> int:
+        if counts is None:
+            counts = self.counts
+        total = sum(counts)
+        if not total:
+            return 0
+        n = total * p / 100
+        seen = 0
+        for b, c in enumerate(counts):
+            seen += c
+            if seen >= n:
+                return (1 << b) - 1
+        return (1 << (len(counts) - 1)) - 1
+
+    def snapshot(self) -> dict:
+        counts = list(self.counts)
+        last = max((b for b, c in enumerate(counts) if c), default=-1)
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "max": self.max,
+            "p50": self.percentile(50, counts),
+            "p99": self.percentile(99, counts),
+            "buckets": counts[:last + 1]
+        }
+
+
+class MMetrics():
+    """
+    MMetrics: counters by name, counters by peer and name, and histograms by
+    name.
+    """
+    def __init__(self):
+        self.counters = {}
+        self.peers = {}
+        self.histograms = {}
+
+    def count(self, name: str, n: int = 1) -> None:
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def countPeer(self, peer: any, name: str, n: int = 1) -> None:
+        p = self.peers.get(peer)
+        if p is None:
+            p = {}
+            self.peers[peer] = p
+        p[name] = p.get(name, 0) + n
+
+    def histogram(self, name: str) -> MHistogram:
+        h = self.histograms.get(name)
+        if h is None:
+            h = MHistogram()
+            self.histograms[name] = h
+        return h
+
+    def snapshot(self) -> dict:
+        return {
+            "counters": dict(self.counters),
+            "peers": {
+                MMetrics.peerName(k): dict(v)
+                for k, v in list(self.peers.items())},
+            "histograms": {
+                k: h.snapshot() for k, h in list(self.histograms.items())}
+        }
+
+    @staticmethod
+    def peerName(peer: any) -> str:
+        if isinstance(peer, tuple):
+            return ":".join(str(i) for i in peer[:2])
+        return str(peer)
+
+    @staticmethod
+    def merge(a: dict, b: dict) -> dict:
+        """ Sum of two snapshots, histograms are not merged, b's are added. """
+        counters = dict(a["counters"])
+        for k, v in b["counters"].items():
+            counters[k] = counters.get(k, 0) + v
+        peers = {k: dict(v) for k, v in a["peers"].items()}
+        for k, v in b["peers"].items():
+            p = peers.setdefault(k, {})
+            for n, c in v.items():
+                p[n] = p.get(n, 0) + c
+        histograms = dict(a["histograms"])
+        histograms.update(b["histograms"])
+        return {"counters": counters, "peers": peers, "histograms": histograms}
+
+    @staticmethod
+    def udpDrops(port: int) -> int:
+        """
+        Datagrams dropped by the kernel, for the UDP sockets bound to port,
+        typically because the socket's receive buffer was full. None when
+        /proc/net/udp is not available, i.e. not Linux.
+        """
+        drops = None
+        for fn in ("/proc/net/udp", "/proc/net/udp6"):
+            if not os.path.exists(fn):
+                continue
+            with open(fn, "r") as f:
+                f.readline()  # Header.
+                for line in f:
+                    cols = line.split()
+                    if len(cols) < 13:
+                        continue
+                    if int(cols[1].split(":")[1], 16) != port:
+                        continue
+                    drops = (drops or 0) + int(cols[12])
+        return drops
@@ -10,13 +10,25 @@
 # 
 # See the GNU General Public License, <https://www.gnu.org/licenses/>.
 #
+import os
+import errno
 import socket
 import select
+import stat
+import struct
 import traceback
 import threading
+import heapq
+import gc
+from collections import deque
 from time import sleep
 import random
 import time
+import zlib
+import tempfile
+import ipaddress
+from multiprocessing import shared_memory, resource_tracker
+from magpie.src.mmetrics import MMetrics
 
 
 # MUDPKey : Msgs are keyed by ip, port, and rid.
@@ -48,19 +60,30 @@ class MUDPKey():
      <request id>O<content id>b<chunkid><first chunk>
      <request id>O<content id>c<chunkid><next chunk>
      <request id>O<content id>f<chunkid><last chunk>
+    The above is the ascii format, ids and lengths are hex digits. There is
+    also a binary format (see MUDPFrame) with the same labels and ids, where
+    ids and lengths are struct packed. The binary format is negotiated per
+    peer, and ascii is used until the peer confirms it reads binary.
     
     The Client API - see examples in main()
     Notes about binding addresses in particular IPv6:
     '' is ENYADDR, 0 causes bind to select a random port.
     IPv6 requires socket.bind((host, port, flowinfo, scope_id))
+
+    A key hashes, and compares equal, as its tuple (ip, port, rid), so the
+    reader finds a message by the tuple without creating a key for each
+    datagram.
     """
+    __slots__ = ("requesting", "_key", "_hash")
     requestId: int = int(random.random()*0xffff)
     def __init__(self, addr: (str, int), requestId: int=-1):
         self.requesting = (requestId == -1)
         self._key = addr + (requestId,)
+        self._hash = hash(self._key)
 
     def setRequestId(self, key: 'MUDPKey'):
         self._key = (self._key[0], self._key[1], key.getRequestId())
+        self._hash = hash(self._key)
 
     def isRequesting(self) -> bool:
         return self.requesting
@@ -68,6 +91,7 @@ class MUDPKey():
     def nextRequestId(self) -> 'MUDPKey':
         if self.requesting: # Get a new RID.
             self._key = (self._key[0], self._key[1], MUDPKey.requestId)
+            self._hash = hash(self._key)
             # print("MUDPKey new RID %x"%MUDPKey.requestId,flush=True)
             MUDPKey.requestId = (MUDPKey.requestId + 1) & 0xffff
 
@@ -83,11 +107,11 @@ class MUDPKey():
     def getRequestId(self) -> int:
         return self._key[2]
 
-    # for: if key == key2:
+    # for: if key == key2:, and key == (ip, port, rid)
     def __eq__(self, other: 'MUDPKey') -> bool:
-        if other is None:
-            return False
-        return self._key == other._key
+        if other.__class__ is MUDPKey:
+            return self._key == other._key
+        return self._key == other
     
     # for: printf(key)
     def __str__(self) -> str:
@@ -95,13 +119,527 @@ class MUDPKey():
     
     # for: hash(key)
     def __hash__(self) -> int:
-        return hash(self._key)
+        return self._hash
     
     # for: copy()
     def __copy__(self) -> 'MUDPKey':
         return MUDPKey(self.getAddr(), self.getRequestId())
 
 
+# MUDPFrame is the binary framing. Each datagram starts with a fixed header,
+#  <magic:B><version:B><type:B><flags:B><request id:H>
+# The magic byte is never a hex digit, so a reader tells binary frames from
+# ascii frames by the first byte. DATA frames carry the records described in
+# the MUDPKey comments, labels are one byte, content and chunk ids are one
+# byte (B), and chunk length is two bytes (H).
+# Negotiation: a sender sends HELLO with its capabilities to a new peer, and
+# continues sending ascii. A peer that reads binary replies with HELLOACK and
+# its capabilities. Both sides use the capabilities they have in common.
+# Old peers fail to parse HELLO, and never reply, so they stay on ascii.
+# Retransmission (CAP_NACK): DATA frames have FLAG_SEQ and a datagram
+# sequence number after the header, <seq:H>, zero for the first datagram of
+# the message. The receiver puts datagrams in sequence, and sends NACK with
+# the missing sequence numbers, <count:B><seq:H>..., the sender resends only
+# those datagrams from its retransmit buffer.
+# Pacing (CAP_WINDOW): the receiver sends ACK, <seq:H>, with the next
+# sequence number it is waiting for, see MUDPPacer.
+# Compression (CAP_ZLIB): HELLO has the id of the preset dictionary after
+# the capabilities, <dict id:I>, and peers with different dictionaries do not
+# compress. A compressed content has FLAG_ZLIB set in its content label, the
+# chunks of the content are a zlib stream using the preset dictionary.
+# Shared memory (CAP_SHM): for a peer on the same host, the sender creates a
+# MUDPRing and sends SHM with the ring's name, <name>, the peer attaches and
+# replies SHMACK with the name and the name of its doorbell, <name>\0<name>.
+# Messages that start after SHMACK are written to the ring rather than the
+# socket, and the peer is woken by a byte written to its doorbell, a FIFO
+# named for the peer's reader, see MUDPFrame.doorbell(); readers of
+# SO_REUSEPORT shards share a port. Messages on the ring may overtake
+# messages still in the socket.
+# Path MTU (CAP_PMTU): the sender sends a round of PROBE frames, one for each
+# of probeSizes, from a socket with the don't fragment bit set. A PROBE is padded to its
+# size, <size:H><padding>, and its request id is the round. The peer replies
+# PROBEACK, <size:H>, with the bytes it received, and the sender uses the
+# largest size acked in the round as its payload to the peer, see
+# MUDP._payload().
+class MUDPFrame():
+    MAGIC: int = 0xB1
+    VERSION: int = 1
+    # Frame types.
+    DATA: int = 0
+    HELLO: int = 1
+    HELLOACK: int = 2
+    NACK: int = 3
+    ACK: int = 4
+    SHM: int = 5
+    SHMACK: int = 6
+    PROBE: int = 7
+    PROBEACK: int = 8
+    # Capabilities.
+    CAP_BINARY: int = 0x0001
+    CAP_NACK: int = 0x0002
+    CAP_WINDOW: int = 0x0004
+    CAP_ZLIB: int = 0x0008
+    CAP_SHM: int = 0x0010
+    CAP_PMTU: int = 0x0020
+    # Flags.
+    FLAG_SEQ: int = 0x01
+    # Content label flag.
+    FLAG_ZLIB: int = 0x80
+    # HELLO is sent this number of times before giving up on a peer.
+    helloAttempts: int = 3
+    header = struct.Struct("!BBBBH")
+    caps = struct.Struct("!H")
+    dictId = struct.Struct("!I")
+    length = struct.Struct("!H")
+    idlabel = struct.Struct("!BB")
+    chunk = struct.Struct("!BH")
+    seq = struct.Struct("!H")
+    # Most sequence numbers in one NACK.
+    maxNack: int = 64
+    # Largest datagram, the reader's buffer.
+    maxDatagram: int = 65535
+    # Probed datagram sizes: IPv6 and IPv4 maximums (loopback), jumbo
+    # ethernet, ethernet, and the IPv6 minimum MTU, less IP and UDP headers.
+    probeSizes: tuple = (65527, 65507, 8972, 1472, 1232)
+
+    @staticmethod
+    def isBinary(data: bytes) -> bool:
+        return len(data) > 0 and data[0] == MUDPFrame.MAGIC
+
+    @staticmethod
+    def pack(frameType: int, requestId: int, flags: int = 0) -> bytes:
+        return MUDPFrame.header.pack(
+            MUDPFrame.MAGIC, MUDPFrame.VERSION, frameType, flags, requestId)
+
+    @staticmethod
+    def hello(frameType: int, caps: int, dictId: int = 0) -> bytes:
+        return (MUDPFrame.pack(frameType, 0) + MUDPFrame.caps.pack(caps)
+                + MUDPFrame.dictId.pack(dictId))
+
+    @staticmethod
+    def peerCaps(data: bytes) -> int:
+        return MUDPFrame.caps.unpack_from(data, MUDPFrame.header.size)[0]
+
+    # Zero for a HELLO without dictionary id.
+    @staticmethod
+    def peerDictId(data: bytes) -> int:
+        i = MUDPFrame.header.size + MUDPFrame.caps.size
+        if len(data) < i + MUDPFrame.dictId.size:
+            return 0
+        return MUDPFrame.dictId.unpack_from(data, i)[0]
+
+    # SHM with the name of the ring, and SHMACK with the name of the ring
+    # and of the doorbell of the peer that attached.
+    @staticmethod
+    def shm(frameType: int, name: str, doorbell: str = "") -> bytes:
+        b = MUDPFrame.pack(frameType, 0) + name.encode('utf-8')
+        if doorbell:
+            b += b"\0" + doorbell.encode('utf-8')
+        return b
+
+    # (ring, doorbell) names, doorbell is None for SHM. None when a name
+    # is not one of MUDP's, which are opened from /dev/shm and the temp dir.
+    @staticmethod
+    def shmNames(data: bytes) -> (str, str):
+        names = bytes(data[MUDPFrame.header.size:]).decode('utf-8').split("\0")
+        for name in names:
+            if not name.startswith("mudp-") or os.path.basename(name) != name:
+                return None
+        return (names[0], names[1] if len(names) > 1 else None)
+
+    # PROBE, padded to size, or PROBEACK, for round.
+    @staticmethod
+    def probe(frameType: int, round: int, size: int) -> bytes:
+        b = MUDPFrame.pack(frameType, round) + MUDPFrame.length.pack(size)
+        if frameType == MUDPFrame.PROBE:
+            b += bytes(size - len(b))
+        return b
+
+    @staticmethod
+    def probeSize(data: bytes) -> int:
+        return MUDPFrame.length.unpack_from(data, MUDPFrame.header.size)[0]
+
+    # Path of the FIFO that wakes the reader named name, see MUDPReader.
+    @staticmethod
+    def doorbell(name: str) -> str:
+        return os.path.join(tempfile.gettempdir(), name + ".fifo")
+
+    # Id of a preset dictionary, as found in the zlib stream.
+    @staticmethod
+    def zdictId(zdict: bytes) -> int:
+        if zdict is None:
+            return 0
+        return zlib.adler32(zdict)
+
+    @staticmethod
+    def getSeq(data: bytes) -> int:
+        return MUDPFrame.seq.unpack_from(data, MUDPFrame.header.size)[0]
+
+    @staticmethod
+    def nack(requestId: int, seqs: list) -> bytes:
+        seqs = seqs[:MUDPFrame.maxNack]
+        return (MUDPFrame.pack(MUDPFrame.NACK, requestId)
+                + bytes((len(seqs),))
+                + struct.pack("!%dH" % len(seqs), *seqs))
+
+    @staticmethod
+    def nackSeqs(data: bytes) -> tuple:
+        i = MUDPFrame.header.size
+        return struct.unpack_from("!%dH" % data[i], data, i + 1)
+
+    # ACK has the next sequence number the receiver is waiting for.
+    @staticmethod
+    def ack(requestId: int, seq: int) -> bytes:
+        return MUDPFrame.pack(MUDPFrame.ACK, requestId) + MUDPFrame.seq.pack(seq)
+
+
+# MUDPRetransmit holds the datagrams sent with FLAG_SEQ, by peer and request
+# id, for resending when the peer sends NACK. A request's datagrams are
+# forgotten after expiredSeconds, or when the request id is reused for a new
+# message (sequence zero). The sender adds, the reader thread resends.
+class MUDPRetransmit():
+    expiredSeconds: int = 10
+    # Most datagrams held for one request.
+    maxFrames: int = 1024
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # (peer, request id) -> (expiration, {seq: datagram})
+        self.requests = {}
+        self.retransmitted = 0
+
+    def add(self, peer: (str, int), requestId: int, frame: bytes) -> None:
+        seq = MUDPFrame.getSeq(frame)
+        t = time.time()
+        k = (peer, requestId)
+        with self.lock:
+            r = self.requests.get(k)
+            if r is None or seq == 0:
+                self.requests.pop(k, None)
+                r = (t + self.expiredSeconds, {})
+                self.requests[k] = r
+            if len(r[1]) < self.maxFrames:
+                r[1][seq] = frame
+            self._expire(t)
+
+    def get(self, peer: (str, int), requestId: int, seqs: tuple) -> list:
+        with self.lock:
+            r = self.requests.get((peer, requestId))
+            if r is None:
+                return []
+            frames = [r[1][seq] for seq in seqs if seq in r[1]]
+        self.retransmitted += len(frames)
+        return frames
+
+    def _expire(self, t: float) -> None:
+        expired = []
+        for k, r in self.requests.items():
+            if r[0] > t: # Dict maintains order of insert.
+                break
+            expired.append(k)
+        for k in expired:
+            del self.requests[k]
+
+    def __len__(self) -> int:
+        return len(self.requests)
+
+
+# MUDPWindow is the sending state of one message, see MUDPPacer. Datagrams
+# are counted from zero, without the wrap of the sequence number.
+class MUDPWindow():
+    def __init__(self, cwnd: float, ssthresh: float, srtt: float):
+        self.cwnd = cwnd
+        self.ssthresh = ssthresh
+        self.srtt = srtt
+        self.sent = 0
+        self.acked = 0
+        # Datagram -> time sent, for round trip time.
+        self.sentAt = {}
+        self.nextSend = 0.0
+        self.decreased = 0.0
+        # Consecutive waits for ACK that timed out.
+        self.stalls = 0
+        self.finished = False
+        self.expiration = time.time() + MUDPPacer.expiredSeconds
+
+    def inflight(self) -> int:
+        return self.sent - self.acked
+
+
+# MUDPPacer schedules datagrams sent with FLAG_SEQ to peers that ACK
+# (CAP_WINDOW). Each remote MUDPKey has a window of datagrams in flight;
+# the sender waits for ACK when the window is full. The window grows by one
+# datagram per ACKed datagram (slow start) until ssthresh, and then by one
+# datagram per window; it halves when the peer NACKs datagrams that were
+# sent, or ACK does not arrive within ackSeconds. Datagrams are spaced at
+# srtt/cwnd seconds so the window is not sent as one burst. A new message
+# starts with the window that the previous message to the peer ended with.
+# The sender waits, the reader thread ACKs.
+class MUDPPacer():
+    expiredSeconds: int = 10
+    # Window limits in datagrams.
+    minWindow: int = 8
+    maxWindow: int = 256
+    # Seconds to wait for ACK, before assuming loss.
+    ackSeconds: float = 0.2
+    # Without ACK after this many waits, the message is sent without pacing.
+    maxStalls: int = 3
+    # Gaps smaller than this are not slept, sleep has too coarse a grain.
+    minPace: float = 0.001
+    # Round trip time until it is measured.
+    initialRtt: float = 0.01
+
+    def __init__(self, window: int):
+        self.window = max(window, self.minWindow)
+        self.cond = threading.Condition()
+        # (peer, request id) -> MUDPWindow
+        self.windows = {}
+        # peer -> (cwnd, ssthresh, srtt) of the last message.
+        self.learned = {}
+        self.acks = 0
+        self.losses = 0
+        self.waits = 0
+
+    # Sender waits until datagram can be sent to peer. The first datagram of
+    # a message (seq zero) starts a new window.
+    def wait(self, peer: (str, int), requestId: int, seq: int) -> None:
+        k = (peer, requestId)
+        t = time.time()
+        with self.cond:
+            w = self.windows.get(k)
+            if w is None or seq == 0:
+                self._forget(k)
+                self._expire(t)
+                (cwnd, ssthresh, srtt) = self.learned.get(
+                    peer, (self.window, self.maxWindow, self.initialRtt))
+                w = MUDPWindow(cwnd, ssthresh, srtt)
+                self.windows[k] = w
+            while w.stalls < self.maxStalls and w.inflight() >= int(w.cwnd):
+                self.waits += 1
+                if not self.cond.wait(self.ackSeconds) and w.inflight() >= int(w.cwnd):
+                    w.stalls += 1
+                    self._decrease(w, time.time())
+                    w.acked = w.sent  # Assume lost, NACK recovers.
+            t = time.time()
+            if w.nextSend < t - w.srtt:  # Idle, no credit for a burst.
+                w.nextSend = t
+            delay = w.nextSend - t
+            w.nextSend += w.srtt / w.cwnd
+            w.sentAt[w.sent] = t + max(delay, 0.0)
+            w.sent += 1
+        if delay > self.minPace:
+            sleep(delay)
+
+    # Sender has sent the last datagram of the message.
+    def finish(self, peer: (str, int), requestId: int) -> None:
+        k = (peer, requestId)
+        with self.cond:
+            w = self.windows.get(k)
+            if w is not None:
+                w.finished = True
+                if w.inflight() <= 0:
+                    self._forget(k)
+
+    # Reader received ACK, seq is the next datagram that the peer wants.
+    def ack(self, peer: (str, int), requestId: int, seq: int) -> None:
+        t = time.time()
+        k = (peer, requestId)
+        with self.cond:
+            w = self.windows.get(k)
+            if w is None:
+                return
+            n = (seq - w.acked) & 0xffff
+            if n == 0 or n > w.inflight():
+                return  # Duplicate, or older than a timeout.
+            self.acks += 1
+            w.acked += n
+            w.stalls = 0
+            sentAt = w.sentAt.get(w.acked - 1)
+            if sentAt is not None and t > sentAt:
+                w.srtt = 0.875 * w.srtt + 0.125 * (t - sentAt)
+            for i in [i for i in w.sentAt if i < w.acked]:
+                del w.sentAt[i]
+            if w.cwnd < w.ssthresh:
+                w.cwnd += n
+            else:
+                w.cwnd += n / w.cwnd
+            w.cwnd = min(w.cwnd, self.maxWindow)
+            if w.finished and w.inflight() <= 0:
+                self._forget(k)
+            self.cond.notify_all()
+
+    # Reader received NACK for datagrams that were sent.
+    def loss(self, peer: (str, int), requestId: int) -> None:
+        with self.cond:
+            w = self.windows.get((peer, requestId))
+            if w is not None:
+                self._decrease(w, time.time())
+
+    # Halve the window, at most once per round trip.
+    def _decrease(self, w: MUDPWindow, t: float) -> None:
+        if w.decreased + w.srtt > t:
+            return
+        self.losses += 1
+        w.decreased = t
+        w.ssthresh = max(w.cwnd / 2, self.minWindow)
+        w.cwnd = w.ssthresh
+
+    def _forget(self, k: tuple) -> None:
+        w = self.windows.pop(k, None)
+        if w is not None:
+            self.learned[k[0]] = (w.cwnd, w.ssthresh, w.srtt)
+
+    def _expire(self, t: float) -> None:
+        expired = []
+        for k, w in self.windows.items():
+            if w.expiration > t: # Dict maintains order of insert.
+                break
+            expired.append(k)
+        for k in expired:
+            self._forget(k)
+
+    def __len__(self) -> int:
+        return len(self.windows)
+
+
+# MUDPRing is a single producer, single consumer ring of datagrams in shared
+# memory, for peers on the same host (CAP_SHM). The producer creates the
+# ring, the consumer attaches by name. head is advanced by the producer and
+# tail by the consumer, each on its own cache line; both count bytes from
+# the start and never wrap, the position in the ring is the count modulo
+# the size. A record is <len:I><datagram> padded to 8 bytes; a record that
+# does not fit before the end of the ring is preceded by a wrap record.
+# The producer's pid, and a flag that the producer sets on close, are next
+# to head, so the consumer releases rings of producers that have gone; and
+# the producer's resource tracker, which unlinks the ring if the producer
+# does not.
+class MUDPRing():
+    counter = struct.Struct("Q")
+    record = struct.Struct("I")
+    HEAD: int = 0
+    PID: int = 8
+    CLOSED: int = 16
+    TRACKER: int = 24
+    TAIL: int = 64
+    DATA: int = 128
+    WRAP: int = 0xffffffff
+    size: int = 1 << 22
+    # Rings created by this process.
+    created = set()
+
+    def __init__(self, name: str, create: bool):
+        self.name = name
+        self.create = create
+        if create:
+            self.shm = shared_memory.SharedMemory(
+                name=name, create=True, size=self.DATA + self.size)
+            self.counter.pack_into(self.shm.buf, self.HEAD, 0)
+            self.counter.pack_into(self.shm.buf, self.PID, os.getpid())
+            self.counter.pack_into(self.shm.buf, self.CLOSED, 0)
+            self.counter.pack_into(self.shm.buf, self.TRACKER, self.tracker())
+            self.counter.pack_into(self.shm.buf, self.TAIL, 0)
+            MUDPRing.created.add(name)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+            # The producer unlinks the ring, not the consumer's resource
+            # tracker at exit; the tracker has one entry per name, and a
+            # producer in a parent or child process shares the tracker.
+            tracker = self.counter.unpack_from(self.shm.buf, self.TRACKER)[0]
+            if name not in MUDPRing.created and tracker != self.tracker():
+                resource_tracker.unregister(self.shm._name, "shared_memory")
+        self.buf = self.shm.buf
+        self.ringSize = len(self.buf) - self.DATA
+
+    def _get(self, offset: int) -> int:
+        return self.counter.unpack_from(self.buf, offset)[0]
+
+    # This process's resource tracker, the inode of the pipe to it, which
+    # child processes inherit.
+    @staticmethod
+    def tracker() -> int:
+        fd = getattr(resource_tracker._resource_tracker, "_fd", None)
+        if fd is None:
+            return 0
+        try:
+            return os.fstat(fd).st_ino
+        except OSError:
+            return 0
+
+    # Producer adds datagram, False when the ring is full.
+    def put(self, b: bytes) -> bool:
+        n = len(b)
+        need = (self.record.size + n + 7) & ~7
+        head = self._get(self.HEAD)
+        tail = self._get(self.TAIL)
+        pos = head % self.ringSize
+        skip = 0
+        if pos + need > self.ringSize:
+            skip = self.ringSize - pos  # Wrap to the start.
+        if head + skip + need - tail > self.ringSize:
+            return False
+        if skip:
+            self.record.pack_into(self.buf, self.DATA + pos, self.WRAP)
+            head += skip
+            pos = 0
+        i = self.DATA + pos
+        self.record.pack_into(self.buf, i, n)
+        self.buf[i + self.record.size:i + self.record.size + n] = b
+        self.counter.pack_into(self.buf, self.HEAD, head + need)
+        return True
+
+    # Consumer's next datagram, a view of the ring that is valid until
+    # pop(), or None when the ring is empty.
+    def peek(self) -> memoryview:
+        head = self._get(self.HEAD)
+        tail = self._get(self.TAIL)
+        if tail == head:
+            return None
+        pos = tail % self.ringSize
+        n = self.record.unpack_from(self.buf, self.DATA + pos)[0]
+        if n == self.WRAP:
+            tail += self.ringSize - pos
+            self.counter.pack_into(self.buf, self.TAIL, tail)
+            if tail == head:
+                return None
+            pos = 0
+            n = self.record.unpack_from(self.buf, self.DATA)[0]
+        i = self.DATA + pos + self.record.size
+        self.popped = tail + ((self.record.size + n + 7) & ~7)
+        return self.buf[i:i + n]
+
+    def pop(self) -> None:
+        self.counter.pack_into(self.buf, self.TAIL, self.popped)
+
+    # Consumer: True when the producer has closed the ring, or has exited.
+    def isClosed(self) -> bool:
+        if self._get(self.CLOSED):
+            return True
+        pid = self._get(self.PID)
+        if pid > 0:
+            try:
+                os.kill(pid, 0)
+            except ProcessLookupError:
+                return True
+            except PermissionError:
+                pass  # Another user's process.
+        return False
+
+    def close(self) -> None:
+        if self.create and self.buf is not None:
+            self.counter.pack_into(self.buf, self.CLOSED, 1)
+        self.buf = None
+        try:
+            self.shm.close()
+        except BufferError:
+            pass  # A view is still held, the mapping goes with the process.
+        if self.create:
+            MUDPRing.created.discard(self.name)
+            try:
+                self.shm.unlink()
+            except FileNotFoundError:
+                pass
+
+
 # MUDPDecodeMsg assembles chunks into content, holds partial
 # content while it waits for the remaining chunk(s), and yields the content.
 # Content id and Chunk id are used to detect missing chunks and chunks
@@ -109,21 +647,63 @@ class MUDPKey():
 # A timestamp is used to measure the period in between content, and the
 # message is expired when this period is too large.
 class MUDPDecodeMsg():
+    __slots__ = (
+        "requestId", "remotekey", "contentId", "chunkId", "chunks",
+        "expiration", "i", "l", "data", "binary", "skippingContent",
+        "skipBad", "eom", "zdict", "compressed", "nextSeq", "pending",
+        "nacks", "ahead", "gaps", "progress", "acked", "started",
+        "chunkCount", "error")
     expiredSeconds : int = 10
-    def __init__(self, requestId: int, skipBad: bool):
+    # Largest content decompressed, a bigger content is bad content.
+    maxDecompressed: int = 1 << 26
+    # Labels as found in the datagram (bytes), see MUDPKey comments.
+    contentLabels = frozenset(b"OBCF")
+    firstContentLabels = frozenset(b"OB")
+    lastContentLabels = frozenset(b"OF")
+    chunkLabels = frozenset(b"obcf")
+    firstChunkLabels = frozenset(b"ob")
+    nextChunkLabels = frozenset(b"cf")
+    lastChunkLabels = frozenset(b"of")
+
+    def __init__(self, requestId: int, skipBad: bool, zdict: bytes = None, remotekey: MUDPKey = None):
         self.requestId = requestId
         if self.requestId is None:
             raise Exception("No request id.")
+        # Key of the message, created once rather than for each datagram.
+        self.remotekey = remotekey
         self.contentId = 0
         self.chunkId= 0
-        self.content = ""
-        self.expiration = time.time() + self.expiredSeconds
+        # Chunks of the content, joined at the last chunk.
+        self.chunks = []
+        t = time.time()
+        self.expiration = t + self.expiredSeconds
         self.i = 0
         self.l = 0
-        self.txt = None
+        self.data = None
+        self.binary = False
         self.skippingContent = False
         self.skipBad = skipBad
         self.eom = False
+        # Preset dictionary, and True when the content is compressed.
+        self.zdict = zdict
+        self.compressed = False
+        # Retransmission, see MUDPFrame. Next sequence number to decode,
+        # datagrams received ahead of sequence, and NACKs without progress.
+        self.nextSeq = 0
+        self.pending = {}
+        self.nacks = 0
+        # Sequence after the furthest datagram received, and the gaps
+        # opened by datagrams received beyond it.
+        self.ahead = 0
+        self.gaps = 0
+        self.progress = t
+        # Next sequence number in the last ACK, see MUDPPacer.
+        self.acked = 0
+        # Metrics, when the message started, chunks decoded, and the reason
+        # for the last lost content, see MUDPReader.metrics.
+        self.started = t
+        self.chunkCount = 0
+        self.error = None
 
     def __str__(self) -> str:
         s="Decode msg "
@@ -135,90 +715,125 @@ class MUDPDecodeMsg():
         return s
 
     def _decodeHex(self, size: int) -> int:
+        nxtI = self.i + size
         try:
-            nxtI = self.i + size
-            ret = int(self.txt[self.i:nxtI],16)
+            ret = int(bytes(self.data[self.i:nxtI]),16)
             self.i = nxtI
             return ret
         except Exception as e:
-            raise Exception(str(e)+"; at "+str(self.i)+":"+str(nxtI)+"="+self.txt[self.i:nxtI]+" l="+str(self.l)+"\nin "+self.txt)
+            raise Exception(str(e)+"; at "+str(self.i)+":"+str(nxtI)+"="+str(bytes(self.data[self.i:nxtI]))+" l="+str(self.l)+"\nin "+str(bytes(self.data)))
+
+    def _decodeByte(self) -> int:
+        if self.i >= self.l:
+            self.error = "truncated"
+            raise Exception("Truncated message. Check MTU settings on servers!")
+        ret = self.data[self.i]
+        self.i += 1
+        return ret
+
+    def _decodeId(self) -> int:
+        if self.binary:
+            return self._decodeByte()
+        return self._decodeHex(2)
+
+    def _decodeLen(self) -> int:
+        if self.binary:
+            nxtI = self.i + MUDPFrame.length.size
+            if nxtI > self.l:
+                self.error = "truncated"
+                raise Exception("Truncated message. Check MTU settings on servers!")
+            ret = MUDPFrame.length.unpack_from(self.data, self.i)[0]
+            self.i = nxtI
+            return ret
+        return self._decodeHex(4)
 
-    def _decodeStr(self, size: int) -> str:
+    def _decodeBytes(self, size: int) -> bytes:
         nxtI = self.i + size
         if nxtI > self.l:
-            print("Check MTU "+self.txt)
+            print("Check MTU "+str(bytes(self.data)))
+            self.error = "truncated"
             raise Exception("Truncated message. Check MTU settings on servers!")
-        ret = self.txt[self.i:nxtI]
+        ret = self.data[self.i:nxtI]
         self.i = nxtI
         return ret
 
     def _decodeRemaining(self) -> int:
         return self.l - self.i
 
-    def decode(self, txt: str) -> (str, bool):
-        self.timer = 10
-        self.txt = txt
-        self.i = 4  # RID decoded priorly.
-        self.l = len(txt)
+    # data is the datagram, start is the index after the request id which
+    # was decoded priorly, binary(True) when data is a MUDPFrame.
+    def decode(self, data: bytes, start: int, binary: bool) -> (bytes, bool):
+        self.data = data
+        self.binary = binary
+        self.i = start
+        self.l = len(data)
         if self.skippingContent:
             # Reset ids, but only for a first packet i.e. O or B.
-            label = self._decodeStr(1)
-            if label not in ["O", "B"]:
+            label = self._decodeByte()
+            if binary:
+                label &= ~MUDPFrame.FLAG_ZLIB
+            if label not in self.firstContentLabels:
                 return
-            self.contentId = self._decodeHex(2)
-            label = self._decodeStr(1)
-            if label not in ["o", "b"]:
+            self.contentId = self._decodeId()
+            label = self._decodeByte()
+            if label not in self.firstChunkLabels:
                 return
-            self.chunkId = self._decodeHex(2)
-            self.i = 4
+            self.chunkId = self._decodeId()
+            self.i = start
             self.skippingContent = False
             # print("Was skipping content, restarting content at: " + str(self.contentId) + "," + str(self.chunkId))
         while self._decodeRemaining() > 0:
-            label = self._decodeStr(1)
-            # print("Decode label:"+label)
-            if label in ["O", "B", "C", "F"]:
+            label = self._decodeByte()
+            # print("Decode label:"+chr(label))
+            compressed = binary and (label & MUDPFrame.FLAG_ZLIB) != 0
+            if compressed:
+                label &= ~MUDPFrame.FLAG_ZLIB
+            if label in self.contentLabels:
                 self.chunkId = 0
-                self.content = ""
-                contentId = self._decodeHex(2)
+                self.chunks.clear()
+                self.compressed = compressed
+                contentId = self._decodeId()
                 if self.contentId != contentId:
+                    self.error = "badContentId"
                     if self.skipBad:
                         # print("Starting skipping Bad contentId got " + str(contentId)+" expect "+str(self.contentId))
                         self.skippingContent = True
                         return
                     else:
-                        # print(self.txt + " " + str(self.i))
                         # raise Exception("Bad contentId got " + str(contentId)+" expect "+str(self.contentId))
                         yield None, True
                         return
-                if label in ["O", "F"]:
+                if label in self.lastContentLabels:
                     self.eom = True
-            elif label in ["o", "b", "c", "f"]:
-                if label in ["c", "f"]:
-                    if len(self.content) == 0:
+            elif label in self.chunkLabels:
+                if label in self.nextChunkLabels:
+                    if not self.chunks:
                         # Missing prior chunk.
+                        self.error = "missingChunk"
                         if self.skipBad:
                             self.skippingContent = True
                             return
                         else:
                             yield None, True
                             return
-                if label == "f":
-                    contentId = self._decodeHex(2)
+                if label == 0x66:  # f
+                    contentId = self._decodeId()
                     if self.contentId != contentId:
+                        self.error = "badContentId"
                         if self.skipBad:
                             # print("Dropping content, Bad contentId in last chunk got " + str(contentId)+" expect "+str(self.contentId))
                             self.skippingContent = True
                             return
                         else:
-                            # print(self.txt + " " + str(self.i))
                             # raise Exception("Bad contentId in last chunk, got " + str(contentId)+" expect "+str(self.contentId))
                             yield None, True
                             return
                     self.contentId = ( self.contentId + 1 ) & 0xff
-                elif label == "o":
+                elif label == 0x6f:  # o
                     self.contentId = ( self.contentId + 1 ) & 0xff
-                chunkId = self._decodeHex(2)
+                chunkId = self._decodeId()
                 if self.chunkId != chunkId:
+                    self.error = "badChunkId"
                     if self.skipBad:
                         # print("Starting skipping Bad chunkId " + str(chunkId) + " want " + str(self.chunkId))
                         self.skippingContent = True
@@ -228,51 +843,172 @@ class MUDPDecodeMsg():
                         yield None, True
                         return
                 self.chunkId = ( self.chunkId + 1 ) & 0xff
-                chunkLen = self._decodeHex(4)
-                self.content += self._decodeStr(chunkLen)
-                if label in ["o", "f"]:
+                self.chunkCount += 1
+                chunkLen = self._decodeLen()
+                # A copy, data is a view of the reader's buffer.
+                chunk = bytes(self._decodeBytes(chunkLen))
+                if label in self.lastChunkLabels:
                     self.expiration = time.time() + self.expiredSeconds
-                    yield self.content, self.eom
-                    self.content = ""
+                    if self.chunks:
+                        self.chunks.append(chunk)
+                        content = b"".join(self.chunks)
+                        self.chunks.clear()
+                    else:  # Only chunk.
+                        content = chunk
+                    if self.compressed:
+                        content = self._decompress(content)
+                        if content is None:
+                            self.error = "badCompression"
+                            if self.skipBad:
+                                continue
+                            yield None, True
+                            return
+                    yield content, self.eom
+                else:
+                    self.chunks.append(chunk)
             else:
+                self.error = "badLabel"
                 if self.skipBad:
                     return
                 else:
                     yield None, True
                     return
 
+    # Return decompressed content, or None when it does not decompress.
+    def _decompress(self, content: bytes) -> bytes:
+        try:
+            if not self.zdict:
+                d = zlib.decompressobj()
+            else:
+                d = zlib.decompressobj(zdict=self.zdict)
+            ret = d.decompress(content, self.maxDecompressed)
+            if d.unconsumed_tail or not d.eof:
+                return None
+            return ret
+        except zlib.error:
+            return None
+
+    # Return datagrams that are ready to decode, in sequence. A datagram
+    # ahead of sequence is held until the missing datagrams arrive.
+    def order(self, seq: int, data: memoryview) -> list:
+        if ((seq - self.ahead) & 0xffff) < 0x8000:  # Beyond the furthest.
+            if seq != self.ahead:
+                self.gaps += 1
+            self.ahead = (seq + 1) & 0xffff
+        if seq == self.nextSeq:
+            ready = [data]
+            self.nextSeq = (seq + 1) & 0xffff
+            while self.nextSeq in self.pending:
+                ready.append(self.pending.pop(self.nextSeq))
+                self.nextSeq = (self.nextSeq + 1) & 0xffff
+            self.nacks = 0
+            self.progress = time.time()
+            return ready
+        if ((seq - self.nextSeq) & 0xffff) < 0x8000:  # Ahead of sequence.
+            if seq not in self.pending and len(self.pending) < MUDPRetransmit.maxFrames:
+                self.pending[seq] = bytes(data)
+        return []  # Ahead, or a duplicate.
+
+    # Sequence numbers of missing datagrams. Without a gap, the datagrams
+    # that may follow the last one received, in case the tail was lost.
+    def missing(self) -> list:
+        if not self.pending:
+            return [(self.nextSeq + i) & 0xffff for i in range(4)]
+        last = max(self.pending, key=lambda seq: (seq - self.nextSeq) & 0xffff)
+        seqs = []
+        seq = self.nextSeq
+        while seq != last and len(seqs) < MUDPFrame.maxNack:
+            if seq not in self.pending:
+                seqs.append(seq)
+            seq = (seq + 1) & 0xffff
+        return seqs
+
+    # Give up on retransmission, return the datagrams held ahead of sequence
+    # for decoding, decoding detects the gap as loss.
+    def flush(self) -> list:
+        seqs = sorted(self.pending, key=lambda seq: (seq - self.nextSeq) & 0xffff)
+        ready = [self.pending[seq] for seq in seqs]
+        if seqs:
+            self.nextSeq = (seqs[-1] + 1) & 0xffff
+        self.pending = {}
+        return ready
+
     def isExpired(self, t : float) -> bool:
-        return self.expiration >= t
+        return self.expiration <= t
 
 
 # A dictionary of Messages being received. get() keys by IP Address and
 # Request Id. All messages can expire.
+# Expiry uses a min-heap of (expiration, n, key, decodeMsg), one entry per
+# message. The expiration in the heap is the message's expiration when it
+# was pushed; a message that has since progressed is pushed again with its
+# new expiration when its entry reaches the top, and entries for deleted
+# messages are dropped when they reach the top. getAllTimeout() costs the
+# number of expired entries, rather than the number of messages. The heap is
+# rebuilt when deleted messages are most of it, so their memory is not held
+# until they would have expired.
+# Most messages are a single datagram, and are deleted as they are created.
+# A new message is pushed when the next message is created, or by
+# getAllTimeout(), rather than when created, so these never reach the heap.
 class MUDPDecodeMsgs():
-    def __init__(self, skipBad: bool):
+    def __init__(self, skipBad: bool, zdict: bytes = None):
         self.decodeMsgs = {}
         self.skipBad = skipBad
+        self.zdict = zdict
+        self.heap = []
+        # The last message created, yet to be pushed.
+        self.fresh = None
+        # Tie breaker in heap entries, keys and messages don't compare.
+        self.n = 0
 
-    # Find existing MUDPBuildMsg, or creates a new one. Key is IP, port, rid
+    # Find existing MUDPBuildMsg, or creates a new one. Key is a MUDPKey, or
+    # the tuple (IP, port, rid), see MUDPKey.
     def getDecodeMsg(self, key: MUDPKey) -> MUDPDecodeMsg:
         decodeMsg = self.decodeMsgs.get(key)
         if decodeMsg is None:
-            decodeMsg = MUDPDecodeMsg(requestId=key.getRequestId(), skipBad=self.skipBad)
+            if key.__class__ is not MUDPKey:
+                key = MUDPKey(key[:-1], key[-1])
+            decodeMsg = MUDPDecodeMsg(requestId=key.getRequestId(), skipBad=self.skipBad, zdict=self.zdict, remotekey=key)
             self.decodeMsgs[key] = decodeMsg
+            if self.fresh is not None:
+                self._pushFresh()
+            self.fresh = decodeMsg
         return decodeMsg
 
+    def _pushFresh(self) -> None:
+        v = self.fresh
+        self.fresh = None
+        if self.decodeMsgs.get(v.remotekey) is v:
+            self._push(v.remotekey, v)
+
+    def _push(self, key: MUDPKey, decodeMsg: MUDPDecodeMsg) -> None:
+        self.n += 1
+        heapq.heappush(self.heap, (decodeMsg.expiration, self.n, key, decodeMsg))
+
     def getAllTimeout(self) -> (MUDPKey, MUDPDecodeMsg):
-        toDelete = []
         t = time.time()
-        for k, v in self.decodeMsgs.items():
-            if v.isExpired(t):
-                toDelete.append(k)
-                yield k, v
-        for k in toDelete:
+        if self.fresh is not None:
+            self._pushFresh()
+        heap = self.heap
+        while heap and heap[0][0] <= t:
+            (expiration, n, k, v) = heapq.heappop(heap)
+            if self.decodeMsgs.get(k) is not v:
+                continue  # Deleted.
+            if not v.isExpired(t):
+                self._push(k, v)  # Progressed since it was pushed.
+                continue
             del self.decodeMsgs[k]
+            yield k, v
 
     def delete(self, key: MUDPKey) -> None:
         if key in self.decodeMsgs:
             del self.decodeMsgs[key]
+            if len(self.heap) > 64 and len(self.heap) > 2 * len(self.decodeMsgs):
+                self.heap = [e for e in self.heap if self.decodeMsgs.get(e[2]) is e[3]]
+                heapq.heapify(self.heap)
+
+    def __len__(self) -> int:
+        return len(self.decodeMsgs)
 
     def __str__(self) -> str:
         if len(self.decodeMsgs)==0:
@@ -287,72 +1023,529 @@ class MUDPDecodeMsgs():
 # The chunks are assembled to make Content which is published to the
 # consumer threads.
 #
-# The communication between the Reader-thread and Consumer-thread is using a
-# principle used by device-drivers which does not need a mutex. There is a
-# single variable, called self.content. When None, it is assigned a list of
-# new content by the Reader-thread. When not None, the Consumer-thread
-# starts consuming the new content but first self.content is set back to None.
-# Using a variable in this way does not require a mutex.
+# The communication between the Reader-thread and Consumer-threads is using a
+# condition variable. The Reader-thread assembles a batch of new content in
+# self.newContent, a list of (MUDPKey, content, eom) records, and publish()
+# routes the records, without copying them, into queues while holding
+# the condition, and notifies the Consumer-threads. Content for a registered
+# MUDPKey goes into the bounded queue for that key, see register(), other
+# content (i.e. unsolicited requests) goes into the wildcard queue. A
+# Consumer-thread waits on the condition until its queue has content, and
+# takes all of the content in its queue. The Reader-thread never waits for a
+# Consumer-thread.
 class MUDPReader(threading.Thread):
-    def __init__(self, socket: any, maxPayload: int, skip: int, skipBad: bool):
+    # Most datagrams read in one wakeup, before checking timeouts.
+    batchSize: int = 256
+    # Seconds without progress before NACK, and NACKs before giving up.
+    nackSeconds: float = 0.2
+    # ACK after this many datagrams in sequence, below MUDPPacer.minWindow.
+    ackEvery: int = 4
+    maxNacks: int = 3
+    # Most content held for one registered key, and for the wildcard queue.
+    queueSize: int = 1024
+    wildcardSize: int = 65536
+
+    def __init__(self, socket: any, maxPayload: int, skip: int, skipBad: bool, caps: int = 0, window: int = 0, zdict: bytes = None, probeSocket: any = None):
+        # Socket that PROBE is sent from, and PROBEACK arrives on, see
+        # MUDP._probe().
+        self.probeSocket = probeSocket
+        # Rings from peers on this host, keyed by name, see MUDPRing.
+        self.rings = {}
+        # Peer -> (ring, doorbell) names, of the ring that the peer attached
+        # to and of the peer's doorbell.
+        self.shmAcked = {}
+        # Probe round per peer, set by the sender, and (round, size) of the
+        # largest PROBEACK in the round, see MUDP._payload().
+        self.probing = {}
+        self.pmtu = {}
+        self.doorbell = None
+        self.doorbellName = None
+        self.doorbellPath = None
+        if caps & MUDPFrame.CAP_SHM:
+            # Named for this reader rather than the port, the readers of
+            # SO_REUSEPORT shards share the port.
+            while self.doorbellPath is None:
+                name = "mudp-%d-%d-%08x" % (
+                    os.getpid(), socket.getsockname()[1], random.getrandbits(32))
+                try:
+                    os.mkfifo(MUDPFrame.doorbell(name))
+                except FileExistsError:
+                    continue
+                self.doorbellName = name
+                self.doorbellPath = MUDPFrame.doorbell(name)
+            # Read and write, so the FIFO has a writer and is never at EOF.
+            self.doorbell = os.open(self.doorbellPath, os.O_RDWR | os.O_NONBLOCK)
         threading.Thread.__init__(self)
         self.s = socket
         if self.s is None:
             raise Exception("None")
         self.stop = False
-        self.newContent = {}
-        self.newContentEOM = {}
-        self.content = None
-        self.contentEOM = None
+        self.newContent = []
+        self.cond = threading.Condition()
+        # Queues of (MUDPKey, content, eom) keyed by MUDPKey.
+        self.queues = {}
+        # Queue of (MUDPKey, content, eom) for unregistered keys.
+        self.wildcard = deque()
+        # Cancelled keys and when to forget them, their content is dropped.
+        self.cancelled = {}
+        # Content dropped because a queue was full.
+        self.overflows = 0
+        # Time content was published, for latency measurements.
+        self.published = 0.0
         self.maxPayload = maxPayload
-        self.decodeMsgs = MUDPDecodeMsgs(skipBad)
+        self.decodeMsgs = MUDPDecodeMsgs(skipBad, zdict)
         self.skip = skip
         self.packetCount = 0
+        # Wakeups that received at least one datagram.
+        self.batchCount = 0
+        # Capabilities of this reader, zero when binary framing is disabled.
+        self.caps = caps
+        # Id of the preset dictionary for compression.
+        self.dictId = MUDPFrame.zdictId(zdict)
+        # Capabilities negotiated with each peer, keyed by (ip, port).
+        self.peers = {}
+        # Datagrams sent, for NACK from peers.
+        self.retransmits = MUDPRetransmit()
+        # Window of datagrams sent to peers that ACK.
+        self.pacer = MUDPPacer(window)
+        # Messages received in sequence (FLAG_SEQ) that are in progress, and
+        # messages that completed recently, and when to forget them.
+        self.sequenced = {}
+        self.completed = {}
+        self.nackCount = 0
+        # Metrics of the reader thread, see MUDP.metrics().
+        self.metrics = MMetrics()
+        self.reassembly = self.metrics.histogram("reassemblyMicroseconds")
+        self.chunksPerMessage = self.metrics.histogram("chunksPerMessage")
 
     def __str__(self) -> str:
         s="MUDPReader\n"
-        for k,v in self.newContent.items():
-            s+="New content from "+str(k)+"="+str(v)+"\n"
-            s+="New EOM "+str(self.newContentEOM[k])+"\n"
-        if self.content is not None:
-            for k,v in self.content.items():
-                s+="Content from "+str(k)+"="+str(v)+"\n"
-                s+="EOM "+str(self.contentEOM[k])+"\n"
+        for k,c,eom in self.newContent:
+            s+="New content from "+str(k)+"="+str(c)+" EOM "+str(eom)+"\n"
+        for k,q in list(self.queues.items()):
+            s+="Queue for "+str(k)+"="+str(list(q))+"\n"
+        for k,c,eom in list(self.wildcard):
+            s+="Content from "+str(k)+"="+str(c)+" EOM "+str(eom)+"\n"
         s+=str(self.decodeMsgs)
         return s
 
     def getDecodeMsg(self, key: MUDPKey) -> MUDPDecodeMsg:
         return self.decodeMsgs.getDecodeMsg(key)
 
-    def _decodeRequestId(self, txt: str) -> int:
+    # Return frame type, request id, flags, and True when data is a binary
+    # frame.
+    def _decodeHeader(self, data: bytes) -> (int, int, int, bool):
+        if MUDPFrame.isBinary(data):
+            (magic, version, frameType, flags,
+             requestId) = MUDPFrame.header.unpack_from(data)
+            if version != MUDPFrame.VERSION:
+                return (frameType, -1, 0, True)
+            return (frameType, requestId, flags, True)
         try:
-            return int(txt[0:4],16), txt[4]
+            return (MUDPFrame.DATA, int(bytes(data[0:4]),16), 0, False)
         except Exception:
             traceback.print_exc()
-            return -1
+            return (MUDPFrame.DATA, -1, 0, False)
+
+    # Negotiation of capabilities, and retransmission, see MUDPFrame.
+    def control(self, frameType: int, reqId: int, data: bytes, remote_ip_port: (str, int)) -> None:
+        if frameType == MUDPFrame.HELLO:
+            if self.caps:
+                self.peers[remote_ip_port] = self._commonCaps(data)
+                self.s.sendto(
+                    MUDPFrame.hello(MUDPFrame.HELLOACK, self.caps, self.dictId),
+                    remote_ip_port)
+        elif frameType == MUDPFrame.HELLOACK:
+            self.peers[remote_ip_port] = self._commonCaps(data)
+        elif frameType == MUDPFrame.NACK:
+            frames = self.retransmits.get(
+                remote_ip_port, reqId, MUDPFrame.nackSeqs(data))
+            if frames:  # Not a probe for datagrams that are yet to be sent.
+                self.pacer.loss(remote_ip_port, reqId)
+            for frame in frames:
+                self.s.sendto(frame, remote_ip_port)
+            self.metrics.countPeer(remote_ip_port, "retransmitted", len(frames))
+        elif frameType == MUDPFrame.ACK:
+            self.pacer.ack(remote_ip_port, reqId, MUDPFrame.getSeq(data))
+        elif frameType == MUDPFrame.SHM:
+            if not (self.caps & MUDPFrame.CAP_SHM):
+                return
+            names = MUDPFrame.shmNames(data)
+            if names is None:
+                return
+            name = names[0]
+            if name not in self.rings:
+                try:
+                    ring = MUDPRing(name, False)
+                except (OSError, ValueError):
+                    return  # Not on this host.
+                # A new ring from the peer replaces the one it dropped.
+                for n, (r, addr) in list(self.rings.items()):
+                    if addr == remote_ip_port:
+                        self._dropRing(n)
+                self.rings[name] = (ring, remote_ip_port)
+            self.s.sendto(
+                MUDPFrame.shm(MUDPFrame.SHMACK, name, self.doorbellName),
+                remote_ip_port)
+        elif frameType == MUDPFrame.SHMACK:
+            names = MUDPFrame.shmNames(data)
+            if names is not None and names[1] is not None:
+                self.shmAcked[remote_ip_port] = names
+        elif frameType == MUDPFrame.PROBE:
+            if self.caps & MUDPFrame.CAP_PMTU:
+                self.s.sendto(
+                    MUDPFrame.probe(MUDPFrame.PROBEACK, reqId, len(data)),
+                    remote_ip_port)
+        elif frameType == MUDPFrame.PROBEACK:
+            if self.probing.get(remote_ip_port) != reqId:
+                return  # Late, from an earlier round.
+            size = MUDPFrame.probeSize(data)
+            acked = self.pmtu.get(remote_ip_port)
+            if acked is None or acked[0] != reqId or acked[1] < size:
+                self.pmtu[remote_ip_port] = (reqId, size)
+
+    # Capabilities in common with the peer's HELLO or HELLOACK.
+    def _commonCaps(self, data: bytes) -> int:
+        caps = MUDPFrame.peerCaps(data) & self.caps
+        if MUDPFrame.peerDictId(data) != self.dictId:
+            caps &= ~MUDPFrame.CAP_ZLIB
+        return caps
+
+    def _ack(self, remotekey: MUDPKey, decodeMsg: MUDPDecodeMsg) -> None:
+        decodeMsg.acked = decodeMsg.nextSeq
+        self.s.sendto(
+            MUDPFrame.ack(remotekey.getRequestId(), decodeMsg.nextSeq),
+            remotekey.getAddr())
 
-    # Publish new content when (past) content has been consumed (i.e. content
-    # is None).
+    def _nack(self, remotekey: MUDPKey, decodeMsg: MUDPDecodeMsg) -> None:
+        decodeMsg.nacks += 1
+        self.nackCount += 1
+        self.s.sendto(
+            MUDPFrame.nack(remotekey.getRequestId(), decodeMsg.missing()),
+            remotekey.getAddr())
+
+    # Resend NACK for messages that are missing datagrams, or have not
+    # progressed for nackSeconds. After maxNacks without progress, give up
+    # and decode what has arrived.
+    def retransmitTimeout(self, t: float) -> None:
+        for remotekey, decodeMsg in list(self.sequenced.items()):
+            if decodeMsg.progress + self.nackSeconds > t:
+                continue
+            if decodeMsg.nacks < self.maxNacks:
+                self._nack(remotekey, decodeMsg)
+                decodeMsg.progress = t
+            else:
+                del self.sequenced[remotekey]
+                for d in decodeMsg.flush():
+                    self._decode(remotekey, decodeMsg, d, MUDPFrame.header.size + MUDPFrame.seq.size, True)
+
+    # Publish new content into the queues, and wake the consumers.
     def publish(self) -> None:
-        if self.content is None and len(self.newContent)>0:
-            self.content = self.newContent
-            self.contentEOM = self.newContentEOM
-            self.newContent = {}
-            self.newContentEOM = {}
+        if not self.newContent:
+            return
+        with self.cond:
+            queues = self.queues
+            for r in self.newContent:
+                q = queues.get(r[0]) if queues else None
+                if q is not None:
+                    self._enqueue(q, r)
+                elif self.cancelled and r[0] in self.cancelled:
+                    continue
+                elif len(self.wildcard) >= self.wildcardSize:
+                    self.overflows += 1
+                else:
+                    self.wildcard.append(r)
+            self.published = time.time()
+            self.cond.notify_all()
+        self.newContent.clear()
+
+    # A full queue loses content, the consumer gets None content and eom, the
+    # same as any other loss; and further content is dropped until consumed.
+    def _enqueue(self, q: deque, r: tuple) -> None:
+        if q and q[-1][1] is None and q[-1][2]:
+            self.overflows += 1
+            return
+        if len(q) >= self.queueSize:
+            self.overflows += len(q) + 1
+            q.clear()
+            q.append((r[0], None, True))
+            return
+        q.append(r)
+
+    # Put back content that the consumer took and did not consume, ahead of
+    # the content published since, see MUDP.recv().
+    def unread(self, content: deque) -> None:
+        if not content:
+            return
+        with self.cond:
+            content.extend(self.wildcard)
+            self.wildcard = content
+
+    # Register key so its content is queued for recvRequestId(). Content
+    # for key that is already in the wildcard queue is moved to its queue.
+    def register(self, key: MUDPKey) -> None:
+        with self.cond:
+            if key in self.queues:
+                return
+            self.cancelled.pop(key, None)
+            q = deque()
+            self.queues[key] = q
+            if any(k == key for k, c, eom in self.wildcard):
+                wildcard = deque()
+                for r in self.wildcard:
+                    if r[0] == key:
+                        q.append(r)
+                    else:
+                        wildcard.append(r)
+                self.wildcard = wildcard
+
+    # Remove the queue for key. When cancel(True), content that arrives
+    # later for key is dropped rather than queued in the wildcard queue.
+    def release(self, key: MUDPKey, cancel: bool = False) -> None:
+        with self.cond:
+            self.queues.pop(key, None)
+            if cancel:
+                self.cancelled[key] = time.time() + MUDPDecodeMsg.expiredSeconds
+            self.cond.notify_all()
+
+    # Consumer waits for content in the wildcard queue, or timeout. Return
+    # the queue of (key, content, eom) and the time it was published, or None
+    # when there is no content. Content is left in the queue when take(False).
+    def waitContent(self, timeout: float, take: bool = True) -> (deque, float):
+        with self.cond:
+            if not self.wildcard and timeout > 0.0:
+                self.cond.wait_for(
+                    lambda: self.wildcard or self.stop, timeout)
+            if not self.wildcard:
+                return (None, 0.0)
+            content = self.wildcard
+            if take:
+                self.wildcard = deque()
+            return (content, self.published)
+
+    # Consumer waits for content for key, or timeout. Return list of
+    # (key, content, eom), or None when there is no content or key is not
+    # registered.
+    def waitQueue(self, key: MUDPKey, timeout: float) -> list:
+        with self.cond:
+            q = self.queues.get(key)
+            if q is None:
+                return None
+            if not q and timeout > 0.0:
+                self.cond.wait_for(
+                    lambda: q or self.stop or key not in self.queues, timeout)
+            if not q:
+                return None
+            content = list(q)
+            q.clear()
+            return content
 
     # Expired message builders are indicated by eom(True) and content(None).
     def timeout(self, t: float):
         for key, decodeMsg in self.decodeMsgs.getAllTimeout():
-            self.newContentEOM.setdefault(key,[]).append(True)
-            self.newContent.setdefault(key,[]).append(None)
+            self.metrics.count("expired")
+            self.sequenced.pop(key, None)
+            self.newContent.append((key, None, True))
+        expired = []
+        for key, expiration in self.completed.items():
+            if expiration > t: # Dict maintains order of insert.
+                break
+            expired.append(key)
+        for key in expired:
+            del self.completed[key]
+        # Rings of producers that closed them, or exited, once read.
+        for name, (ring, addr) in list(self.rings.items()):
+            if ring.isClosed() and ring.peek() is None:
+                self._dropRing(name)
+        if self.cancelled:
+            with self.cond:
+                expired = []
+                for key, expiration in self.cancelled.items():
+                    if expiration > t: # Dict maintains order of insert.
+                        break
+                    expired.append(key)
+                for key in expired:
+                    del self.cancelled[key]
 
+    # Decode one datagram, the content is added to newContent. data is a
+    # view of the receive buffer, and is only valid during this call.
+    # A key is created once per message, see MUDPDecodeMsgs.getDecodeMsg().
+    def receive(self, data: memoryview, remote_ip_port: (str, int)) -> None:
+        if data and data[0] == MUDPFrame.MAGIC:
+            (magic, version, frameType, flags,
+             reqId) = MUDPFrame.header.unpack_from(data)
+            if version != MUDPFrame.VERSION:
+                reqId = -1
+            binary = True
+        else:
+            (frameType, reqId, flags, binary) = self._decodeHeader(data)
+        if frameType != MUDPFrame.DATA:
+            self.control(frameType, reqId, data, remote_ip_port)
+            return
+        if self.skip > 0:
+            self.skip -= 1
+            if self.skip == 0:
+                print("MUDPReader, causing problems; skipping " + str(bytes(data)))
+                self.metrics.count("skipped")
+                return
+        self.packetCount += 1
+        self.metrics.countPeer(remote_ip_port, "packetsRecv")
+        self.metrics.countPeer(remote_ip_port, "bytesRecv", len(data))
+        if reqId == -1:
+            return
+        if binary:
+            # A peer sending binary frames reads binary frames.
+            if self.caps and remote_ip_port not in self.peers:
+                self.peers[remote_ip_port] = MUDPFrame.CAP_BINARY
+            start = MUDPFrame.header.size
+        else:
+            start = 4
+        decodeMsg = self.decodeMsgs.getDecodeMsg(remote_ip_port + (reqId,))
+        remotekey = decodeMsg.remotekey
+        # print(str(time.time())+" Recv "+str(bytes(data))+" from "+str(remotekey)+"\n",,flush=True)
+        if not (flags & MUDPFrame.FLAG_SEQ):
+            self._decode(remotekey, decodeMsg, data, start, binary)
+            return
+        start += MUDPFrame.seq.size
+        seq = MUDPFrame.getSeq(data)
+        if seq == 0:
+            # A new message, e.g. a retransmitted request with its request id.
+            self.completed.pop(remotekey, None)
+        elif remotekey in self.completed:
+            self.decodeMsgs.delete(remotekey)
+            return  # A late retransmission.
+        windowed = (self.peers.get(remote_ip_port, 0) & MUDPFrame.CAP_WINDOW) != 0
+        gaps = decodeMsg.gaps
+        ready = decodeMsg.order(seq, data)
+        for d in ready:
+            if self._decode(remotekey, decodeMsg, d, start, True):
+                self.completed[remotekey] = time.time() + MUDPDecodeMsg.expiredSeconds
+                if windowed:
+                    self._ack(remotekey, decodeMsg)
+                return
+        self.sequenced[remotekey] = decodeMsg
+        if decodeMsg.gaps > gaps:  # New gap.
+            self._nack(remotekey, decodeMsg)
+        elif windowed and ((decodeMsg.nextSeq - decodeMsg.acked) & 0xffff) >= self.ackEvery:
+            self._ack(remotekey, decodeMsg)
+
+    # Return True at the end of message.
+    def _decode(self, remotekey: MUDPKey, decodeMsg: MUDPDecodeMsg, data: memoryview, start: int, binary: bool) -> bool:
+        done = False
+        try:
+            for content, eom in decodeMsg.decode(data, start, binary):
+                if eom:
+                    # Don't need decodeMsg beyond end of message.
+                    self.decodeMsgs.delete(remotekey)
+                    self.sequenced.pop(remotekey, None)
+                    done = True
+                    if content is not None:
+                        self.reassembly.add(
+                            int((time.time() - decodeMsg.started) * 1000000))
+                        self.chunksPerMessage.add(decodeMsg.chunkCount)
+                self.newContent.append((remotekey, content, eom))
+        finally:
+            if decodeMsg.error is not None:
+                self.metrics.count(decodeMsg.error)
+                decodeMsg.error = None
+        return done
+
+    # Each wakeup drains the datagrams that are ready, up to batchSize, into
+    # a preallocated buffer. Content is published once per batch.
+    # The reader has its own socket object on a duplicate of the socket's
+    # file descriptor. A socket with a timeout waits for the timeout even
+    # with MSG_DONTWAIT, whereas the duplicate has no timeout.
     def run(self):
+        # Room for any datagram, a peer's payload may be larger than ours.
+        buffer = bytearray(MUDPFrame.maxDatagram)
+        view = memoryview(buffer)
+        rs = socket.socket(fileno=os.dup(self.s.fileno()))
+        try:
+            self._run(rs, buffer, view)
+        finally:
+            rs.close()
+            self.close()
+
+    def _dropRing(self, name: str) -> None:
+        (ring, addr) = self.rings.pop(name)
+        ring.close()
+        self.metrics.count("shmDropped")
+
+    # PROBEACK from the peers that were probed, other frames are not read
+    # from the probe socket.
+    def _readProbes(self) -> None:
+        while True:
+            try:
+                (data, addr) = self.probeSocket.recvfrom(64, socket.MSG_DONTWAIT)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                return  # Closed.
+            if (MUDPFrame.isBinary(data)
+                    and len(data) >= MUDPFrame.header.size + MUDPFrame.length.size):
+                (magic, version, frameType, flags,
+                 reqId) = MUDPFrame.header.unpack_from(data)
+                if version == MUDPFrame.VERSION and frameType == MUDPFrame.PROBEACK:
+                    self.control(frameType, reqId, data, addr)
+
+    # Release the rings, the doorbell and the probe socket.
+    def close(self) -> None:
+        for ring, addr in self.rings.values():
+            ring.close()
+        self.rings = {}
+        if self.doorbell is not None:
+            os.close(self.doorbell)
+            os.unlink(self.doorbellPath)
+            self.doorbell = None
+        if self.probeSocket is not None:
+            self.probeSocket.close()
+
+    # Drain the doorbell, and decode the datagrams in the rings. Datagrams
+    # are decoded in place, the ring's record is released after decode.
+    def _readRings(self) -> int:
+        try:
+            while os.read(self.doorbell, 4096):
+                pass
+        except BlockingIOError:
+            pass
+        received = 0
+        for name, (ring, addr) in list(self.rings.items()):
+            while received < self.batchSize * 16:
+                data = ring.peek()
+                if data is None:
+                    break
+                received += 1
+                try:
+                    self.receive(data, addr)
+                except Exception as e:
+                    traceback.print_exc()
+                    print("Failed to parse cmds " + str(e) + " from " + str(addr))
+                finally:
+                    data.release()
+                    ring.pop()
+            else:
+                os.write(self.doorbell, b"\0")  # More, on the next wakeup.
+                break
+        if received:
+            self.metrics.count("shmRecv", received)
+        return received
+
+    def _run(self, rs: socket.socket, buffer: bytearray, view: memoryview):
         ticking = time.time() + 1
+        rl = [rs]
+        if self.doorbell is not None:
+            rl.append(self.doorbell)
+        if self.probeSocket is not None:
+            rl.append(self.probeSocket)
         while not self.stop:
             ip_port = None
-            txt = None
+            data = None
             try:
-                ready = select.select([self.s], [], [], 1)
+                if self.sequenced:
+                    ready = select.select(rl, [], [], self.nackSeconds)
+                    self.retransmitTimeout(time.time())
+                else:
+                    ready = select.select(rl, [], [], 1)
                 t = time.time()
                 if t > ticking:
                     ticking = t + 1
@@ -360,36 +1553,40 @@ class MUDPReader(threading.Thread):
                     self.publish()
                 if not ready[0]:
                     continue
-                ret = self.s.recvfrom( self.maxPayload )
-                if ret is None:  # Socket closed.
-                    self.stop = True
-                    break
-                (data, remote_ip_port) = ret
-                txt = data.decode('utf-8')
-                if self.skip > 0:
-                    self.skip -= 1
-                    if self.skip == 0:
-                        print("MUDPReader, causing problems; skipping " + txt)
-                        continue
-                self.packetCount += 1
-                reqId, cmd = self._decodeRequestId(txt)
-                if reqId == -1:
+                if self.probeSocket is not None and self.probeSocket in ready[0]:
+                    self._readProbes()
+                if self.doorbell in ready[0]:
+                    # The ring may have more than a batch, _readRings()
+                    # then rings its own doorbell for the next wakeup.
+                    if self._readRings():
+                        self.batchCount += 1
                     self.publish()
-                    continue
-                remotekey = MUDPKey(remote_ip_port,reqId)
-                # print(str(time.time())+" Recv "+str(data)+" from "+str(remotekey)+"\n",,flush=True)
-                decodeMsg = self.decodeMsgs.getDecodeMsg(remotekey)
-                for content, eom in decodeMsg.decode(txt):
-                    if eom:
-                        # Don't need decodeMsg beyond end of message.
-                        self.decodeMsgs.delete(remotekey)
-                    self.newContentEOM.setdefault(remotekey,[]).append(eom)
-                    self.newContent.setdefault(remotekey,[]).append(content)
+                    if rs not in ready[0]:
+                        continue
+                received = 0
+                while received < self.batchSize:
+                    try:
+                        (nbytes, remote_ip_port) = rs.recvfrom_into(
+                            buffer, len(buffer), socket.MSG_DONTWAIT)
+                    except (BlockingIOError, InterruptedError):
+                        break
+                    received += 1
+                    ip_port = remote_ip_port
+                    data = view[:nbytes]
+                    try:
+                        self.receive(data, remote_ip_port)
+                    except Exception as e:
+                        traceback.print_exc()
+                        print("Failed to parse cmds " + str(e) + " from " + str(ip_port))
+                        print(bytes(data))
+                if received:
+                    self.batchCount += 1
                 self.publish()
-            except Exception as e:
+            except OSError:
+                if self.s.fileno() == -1:  # Socket closed.
+                    self.stop = True
+                    break
                 traceback.print_exc()
-                print("Failed to parse cmds " + str(e) + " from " + str(ip_port))
-                print(txt)
             except Exception:
                 traceback.print_exc()
                 self.stop = True
@@ -398,8 +1595,13 @@ class MUDPReader(threading.Thread):
 # Response and Request messages have the same structure (see header comments)
 # and MUDPBuildMsg creates both.
 class MUDPBuildMsg():
+    __slots__ = (
+        "remotekey", "firstContent", "buffer", "view", "i", "maxPayload",
+        "contentId", "chunkId", "binary", "sequenced", "seq", "hdrLen",
+        "zdict", "compressMin", "ring", "unsent", "restarting", "lost")
     # <Label><content id><label><chunk id><chunk len><content>
     # <label><content id><chunk id><chunk len><content>
+    # Lengths are for the ascii format, the binary format is shorter.
     ContentHdrLen = len("B11b223333".encode('utf-8'))
     sensibleSpaceForContent = ContentHdrLen + (ContentHdrLen * 2)
     ChunkHdrLen = len("f11223333".encode('utf-8'))
@@ -407,34 +1609,126 @@ class MUDPBuildMsg():
     def __init__(self, remotekey: MUDPKey):
         self.remotekey = remotekey
         self.firstContent = True
-        self.buffer = "".encode('utf-8')
+        # Datagram is built in buffer, see setMaxPayload().
+        self.buffer = bytearray()
+        self.view = memoryview(self.buffer)
         self.i = 0
         self.maxPayload = -1
         self.contentId = 0
         self.chunkId = 0
+        self.binary = False
+        self.sequenced = False
+        self.seq = 0
+        self.hdrLen = 4
+        # Preset dictionary when content is compressed, see setCompress().
+        self.zdict = None
+        self.compressMin = 0
+        # Ring to a peer on this host, see MUDP._ring().
+        self.ring = None
+        # (content, eom) of the message until its first datagram is sent,
+        # and True to start the message again with its request id, or while
+        # the rest of the message is dropped, see MUDP.send().
+        self.unsent = None
+        self.restarting = False
+        self.lost = False
 
     def _reset(self) -> None:
-        self.buffer = "".encode('utf-8')
         self.i = 0
 
     def __str__(self) -> str:
         s="MUDPBuildMsg\n"
-        s+=self.buffer
+        s+=str(bytes(self.view[:self.i]))
         return s
 
+    # The buffer is allocated once, and reused for each datagram.
     def setMaxPayload(self, maxPayload: int) -> None:
         self.maxPayload = maxPayload
+        if len(self.buffer) != maxPayload and (self.i == 0 or self.firstContent):
+            self.buffer = bytearray(maxPayload)
+            self.view = memoryview(self.buffer)
+
+    # Binary(True) for MUDPFrame, or False for ascii. Sequenced(True) adds
+    # sequence numbers for retransmission. The format changes in between
+    # packets, never within a packet; and sequencing changes only in between
+    # messages.
+    def setBinary(self, binary: bool, sequenced: bool = False) -> None:
+        if self.firstContent or self.i == 0:
+            if not self.firstContent and self.sequenced:
+                sequenced = binary
+            elif not self.firstContent:
+                sequenced = False
+            self.binary = binary
+            self.sequenced = binary and sequenced
+            if not binary:
+                self.hdrLen = 4
+            elif self.sequenced:
+                self.hdrLen = MUDPFrame.header.size + MUDPFrame.seq.size
+            else:
+                self.hdrLen = MUDPFrame.header.size
+
+    # Compress content of compressMin bytes and more with the preset
+    # dictionary zdict, or don't compress when zdict is None. Binary only.
+    def setCompress(self, zdict: bytes, compressMin: int) -> None:
+        self.zdict = zdict
+        self.compressMin = compressMin
+
+    # Return compressed content, or None when content is not compressed.
+    def _compress(self, b: bytes) -> bytes:
+        if self.zdict is None or not self.binary or len(b) < self.compressMin:
+            return None
+        if self.zdict:
+            c = zlib.compressobj(zdict=self.zdict)
+        else:
+            c = zlib.compressobj()
+        z = c.compress(b) + c.flush()
+        if len(z) >= len(b):
+            return None
+        return z
 
     def _appendBytes(self, b: bytes) -> None:
-        self.buffer += b
-        self.i += len(b)
+        nxtI = self.i + len(b)
         # print("_append " + self.buffer + " " + str(self.i) +" " +s)
-        if self.i > self.maxPayload:
+        if nxtI > self.maxPayload:
             raise Exception("Beyond the pale")
+        self.view[self.i:nxtI] = b
+        self.i = nxtI
+
+    def _appendStruct(self, st: struct.Struct, *v) -> None:
+        if self.i + st.size > self.maxPayload:
+            raise Exception("Beyond the pale")
+        st.pack_into(self.buffer, self.i, *v)
+        self.i += st.size
 
     def _appendStr(self, s: str) -> None:
         self._appendBytes(s.encode('utf-8'))
 
+    def _appendHeader(self) -> None:
+        self.i = 0
+        if self.binary:
+            flags = MUDPFrame.FLAG_SEQ if self.sequenced else 0
+            self._appendStruct(
+                MUDPFrame.header, MUDPFrame.MAGIC, MUDPFrame.VERSION,
+                MUDPFrame.DATA, flags, self.remotekey.getRequestId())
+            if self.sequenced:
+                self._appendStruct(MUDPFrame.seq, self.seq)
+                self.seq = (self.seq + 1) & 0xffff
+        else:
+            self._appendStr("%04x" % self.remotekey.getRequestId())
+
+    # Label and id e.g. O<content id>, flag is or'ed with a binary label.
+    def _appendLabel(self, label: str, i: int, flag: int = 0) -> None:
+        if self.binary:
+            self._appendStruct(MUDPFrame.idlabel, ord(label) | flag, i)
+        else:
+            self._appendStr("%s%02x" % (label, i))
+
+    # Chunk id and length.
+    def _appendChunk(self, chunkId: int, chunkLen: int) -> None:
+        if self.binary:
+            self._appendStruct(MUDPFrame.chunk, chunkId, chunkLen)
+        else:
+            self._appendStr("%02x%04x" % (chunkId, chunkLen))
+
     def room(self) -> int:
         return self.maxPayload - self.i
 
@@ -445,48 +1739,70 @@ class MUDPBuildMsg():
         return self.room() >= MUDPBuildMsg.sensibleSpaceForContent
 
     def hasContent(self) -> bool:
-        return self.i > 4
+        return self.i > self.hdrLen
 
-    def getBytes(self) -> bytes:
-        b = self.buffer
-        return b
+    # A view of the buffer, valid until the next call to addContent().
+    def getBytes(self) -> memoryview:
+        return self.view[:self.i]
     
     def getRemoteKey(self) -> MUDPKey:
         return self.remotekey
+
+    # The next content starts a message, with the request id of this message
+    # when keepId(True).
+    def restart(self, keepId: bool) -> None:
+        self.firstContent = True
+        self.restarting = keepId
+        self._reset()
     
-    # Add content to msg. Return bytes to send when msg is full or eom.
+    # Add content to msg. Return the datagram to send when msg is full or
+    # eom, see getBytes().
     # Call nextRequestId() on first content, it will get create a new id
     # for requests; otherwise, for repsonses, use the key's requestid.
-    def addContent(self, content: str, eom: bool) -> bytes:
+    # Content is str or bytes, str is encoded as utf-8.
+    def addContent(self, content: any, eom: bool) -> memoryview:
+        if isinstance(content, str):
+            b = content.encode('utf-8')
+        else:
+            b = content
         if self.firstContent:  # First content, use O and B.
-            self.remotekey.nextRequestId()
-            self.buffer = ("%04x" % self.remotekey.getRequestId()).encode('utf-8')
-            self.i = 4
+            if self.restarting:
+                self.restarting = False
+            else:
+                self.remotekey.nextRequestId()
+            self.seq = 0
+            self._appendHeader()
+        elif self.i == 0:
+            self._appendHeader()
+        z = self._compress(b)
+        if z is None:
+            flag = 0
+        else:
+            b = z
+            flag = MUDPFrame.FLAG_ZLIB
+        if self.firstContent:
             if eom:
                 self.firstContent = True
                 self.contentId = 0
-                self._appendStr("O%02x"%self.contentId)
+                self._appendLabel("O", self.contentId, flag)
             else:
                 self.firstContent = False
                 self.contentId = 0
-                self._appendStr("B%02x"%self.contentId)
+                self._appendLabel("B", self.contentId, flag)
         else:  # Next content, use F or C.
-            if self.i == 0:
-                self.buffer = ("%04x" % self.remotekey.getRequestId()).encode('utf-8')
-                self.i = 4
             if eom:
                 self.firstContent = True
                 self.contentId = ( self.contentId + 1 ) & 0xff
-                self._appendStr("F%02x"%self.contentId)
+                self._appendLabel("F", self.contentId, flag)
             else:
                 self.firstContent = False
                 self.contentId = ( self.contentId + 1 ) & 0xff
-                self._appendStr("C%02x"%self.contentId)
+                self._appendLabel("C", self.contentId, flag)
         self.chunkId = 0
-        b = content.encode('utf-8')
         contentLen = len(b)
         if self.hasRoom(contentLen + 7):
-            self._appendStr("o%02x%04x"%(self.chunkId, contentLen))
+            self._appendBytes(b"o")
+            self._appendChunk(self.chunkId, contentLen)
             self._appendBytes(b)
             if eom or not self.hasSpaceForMoreContent():
                 yield self.getBytes()
@@ -494,28 +1810,30 @@ class MUDPBuildMsg():
             return
         firstChunkId = True
         contentIdx = 0
+        b = memoryview(b)  # Chunks are slices without a copy.
         remainingContentLen = contentLen - contentIdx
         while remainingContentLen:
             if self.i == 0:
-                self.buffer = ("%04x" % self.remotekey.getRequestId()).encode('utf-8')
-                self.i = 4
+                self._appendHeader()
             r = self.room() - self.ChunkHdrLen
             if firstChunkId:
                 firstChunkId = False
-                self._appendStr("b")
+                self._appendBytes(b"b")
             else:
                 if remainingContentLen > r:
-                    self._appendStr("c")
+                    self._appendBytes(b"c")
                 else:
-                    self._appendStr("f%02x"%self.contentId)
+                    self._appendLabel("f", self.contentId)
             if remainingContentLen > r:
                 nxtContentIdx = contentIdx + r
             else:
                 nxtContentIdx = contentIdx + remainingContentLen
-            chunk = content[contentIdx:nxtContentIdx].encode('utf-8')
+            # Chunks are split on bytes, the reader joins the bytes before
+            # decoding utf-8.
+            chunk = b[contentIdx:nxtContentIdx]
             contentIdx = nxtContentIdx
             chunkLen = len(chunk)
-            self._appendStr("%02x%04x" % (self.chunkId, chunkLen))
+            self._appendChunk(self.chunkId, chunkLen)
             self.chunkId = ( self.chunkId + 1) & 0xff
             self._appendBytes(chunk)
             yield self.getBytes()
@@ -525,6 +1843,22 @@ class MUDPBuildMsg():
 
 # See file header comments.
 class MUDP:
+    # Seconds to wait for room in a full ring.
+    ringSeconds: float = 5.0
+    # Seconds before a ring is offered again to a peer that did not attach,
+    # or after a ring was dropped or could not be created, see _ring().
+    shmSeconds: float = 30.0
+    # Seconds in between probe rounds to a peer, and seconds to wait for the
+    # round's PROBEACK before using maxPayload, see _payload().
+    probeSeconds: float = 60.0
+    probeWait: float = 1.0
+    # Linux socket options that set the don't fragment bit, which the socket
+    # module does not name, for the probe socket, see _probeSocket().
+    dontFragment: dict = {
+        socket.AF_INET: (socket.IPPROTO_IP, 10, 3),  # IP_PMTUDISC_PROBE
+        socket.AF_INET6: (socket.IPPROTO_IPV6, 23, 3)  # IPV6_PMTUDISC_PROBE
+    }
+
     @staticmethod
     def nextId(i: int) -> int:
         return (i + 1) & 0xff
@@ -551,7 +1885,30 @@ class MUDP:
         # is 8 bytes; 65527=65535-8 and is the default for maxPayload. But,
         # maxPayload must be the smallest MTU value found in the network that
         # is used by the database and the applications connecting to the db.
-        maxPayload: int=65527
+        # With pmtu=True, maxPayload is used until the peer's path is probed.
+        maxPayload: int=65527,
+        # Negotiate binary framing with peers (True), or ascii only (False).
+        binary: bool=True,
+        # Negotiate NACK retransmission of lost datagrams with peers (True),
+        # requires binary framing.
+        retransmit: bool=False,
+        # Datagrams in flight to a peer before waiting for its ACK, zero to
+        # send without pacing. Requires retransmit, the window adapts to
+        # loss, see MUDPPacer.
+        window: int=0,
+        # Negotiate compression with peers using this preset dictionary, b""
+        # for no dictionary, or None to not compress. Peers compress content
+        # of compressMin bytes and more when their dictionaries are equal.
+        zdict: bytes=None,
+        compressMin: int=512,
+        # Negotiate shared memory rings with peers on the same host (True),
+        # see MUDPRing.
+        shm: bool=False,
+        # Probe the path MTU to peers (True), and size datagrams per peer
+        # rather than by maxPayload, see _payload().
+        pmtu: bool=False,
+        # recv() yields content as str (True), or as bytes (False).
+        text: bool=True
     ):
         self.maxPayload = maxPayload
         if maxPayload > 65527:
@@ -561,106 +1918,483 @@ class MUDP:
                 "maxPayload too small at "+str(maxPayload)
                 +" smallest="+str(MUDPBuildMsg.sensibleSpaceForContent))
         self.s = socket
-        self.reader = MUDPReader(socket,maxPayload,skip,skipBad)
-        self.reader.start()
+        self.binary = binary
+        self.text = text
+        self.zdict = zdict
+        self.compressMin = compressMin
+        # HELLO attempts per peer, and peer addresses resolved to ip.
+        self.hellos = {}
+        self.resolved = {}
+        caps = 0
+        if binary:
+            caps |= MUDPFrame.CAP_BINARY
+            if retransmit:
+                caps |= MUDPFrame.CAP_NACK
+                if window > 0:
+                    caps |= MUDPFrame.CAP_WINDOW
+            if zdict is not None:
+                caps |= MUDPFrame.CAP_ZLIB
+            if shm:
+                caps |= MUDPFrame.CAP_SHM
+            if pmtu:
+                caps |= MUDPFrame.CAP_PMTU
+        # Probe (round, time, attempts) per peer, see _payload().
+        self.probes = {}
+        self.probeRound = int(random.random()*0xffff)
+        probeSocket = None
+        if binary and pmtu:
+            probeSocket = self._probeSocket(socket)
+        # Rings to peers on this host, and their doorbells, SHM attempts,
+        # and when to offer a ring again, see _ring().
+        self.rings = {}
+        self.doorbells = {}
+        self.shmAttempts = {}
+        self.shmRetry = {}
+        self.ringCount = 0
+        self.reader = MUDPReader(socket,maxPayload,skip,skipBad,caps,window,zdict,probeSocket)
+        self._startReader()
         self.stop = False
+        # Seconds the consumer waited for content.
         self.slept = 0
+        # Seconds from publish to consume, and the number of handovers.
+        self.latency = 0.0
+        self.latencyCount = 0
+        # Metrics of the sending thread, see metrics().
+        self.sendMetrics = MMetrics()
 
     def __str__(self) -> str:
         s="MUDP\n"
         s+=str(self.reader)
         return s
 
-    def shutdown(self):
-        self.stop = True
+    # The reader thread, see MUDPAsync for the asyncio reader.
+    def _startReader(self) -> None:
+        self.reader.start()
+
+    def _stopReader(self) -> None:
         self.reader.stop = True
+        with self.reader.cond:
+            self.reader.cond.notify_all()
         self.reader.join()
 
-    # Return remote key
-    def send(self, content: str, eom: bool, msg: MUDPBuildMsg) -> MUDPKey:
+    def shutdown(self):
+        self.stop = True
+        self._stopReader()
+        for ring in self.rings.values():
+            ring.close()
+        self.rings = {}
+        for fd in self.doorbells.values():
+            os.close(fd)
+        self.doorbells = {}
+
+    # Average seconds from the reader publishing content to the consumer
+    # taking the content.
+    def avgLatency(self) -> float:
+        if self.latencyCount == 0:
+            return 0.0
+        return self.latency / self.latencyCount
+
+    # Snapshot of the transport metrics, a dict that is serializable as json:
+    # counters, counters by peer, histograms, and the current queue depths.
+    # Counters of lost content are by reason, see MUDPDecodeMsg.error.
+    def metrics(self) -> dict:
+        r = self.reader
+        m = MMetrics.merge(r.metrics.snapshot(), self.sendMetrics.snapshot())
+        m["counters"].update({
+            "packets": r.packetCount,
+            "batches": r.batchCount,
+            "nacks": r.nackCount,
+            "retransmitted": r.retransmits.retransmitted,
+            "overflows": r.overflows,
+            "acks": r.pacer.acks,
+            "losses": r.pacer.losses,
+            "paceWaits": r.pacer.waits,
+            "socketDrops": MMetrics.udpDrops(self.s.getsockname()[1])
+        })
+        with r.cond:
+            queued = sum(len(q) for q in r.queues.values())
+            m["queues"] = {
+                "wildcard": len(r.wildcard),
+                "registered": len(r.queues),
+                "queued": queued,
+                "cancelled": len(r.cancelled)
+            }
+        m["queues"].update({
+            "reassembling": len(r.decodeMsgs),
+            "sequenced": len(r.sequenced),
+            "retransmits": len(r.retransmits),
+            "windows": len(r.pacer)
+        })
+        m["slept"] = self.slept
+        m["latency"] = self.avgLatency()
+        return m
+
+    def _waitContent(self, timeout: float) -> deque:
+        t = time.time()
+        (content, published) = self.reader.waitContent(timeout)
+        now = time.time()
+        self.slept += now - t
+        if content is not None:
+            self.latency += now - published
+            self.latencyCount += 1
+        return content
+
+    # Wait for content to arrive, or timeout. Return True when content has
+    # arrived. Content is left for recv().
+    def wait(self, timeout: float) -> bool:
+        t = time.time()
+        (content, published) = self.reader.waitContent(timeout, take=False)
+        self.slept += time.time() - t
+        return content is not None
+
+    # Peers are keyed by the address the reader sees, which is an ip.
+    def _peerAddr(self, addr: (str, int)) -> (str, int):
+        peer = self.resolved.get(addr)
+        if peer is None:
+            try:
+                peer = (socket.gethostbyname(addr[0]), addr[1])
+            except Exception:
+                peer = addr
+            self.resolved[addr] = peer
+        return peer
+
+    # Capabilities negotiated with the peer, HELLO is sent to new peers.
+    def peerCaps(self, addr: (str, int)) -> int:
+        if not self.binary:
+            return 0
+        peer = self._peerAddr(addr)
+        caps = self.reader.peers.get(peer)
+        if caps is None:
+            attempts = self.hellos.get(peer, 0)
+            if attempts < MUDPFrame.helloAttempts:
+                self.hellos[peer] = attempts + 1
+                self.s.sendto(
+                    MUDPFrame.hello(
+                        MUDPFrame.HELLO, self.reader.caps, self.reader.dictId),
+                    addr)
+            return 0
+        return caps
+
+    # Datagram size for a message to addr: the largest size acked by the peer
+    # in the last probe round, or maxPayload when the peer does not probe,
+    # or has not replied. Rounds repeat every probeSeconds, so a path with a
+    # smaller MTU falls back, and a send that fails with EMSGSIZE starts a
+    # round.
+    def _payload(self, addr: (str, int), caps: int) -> int:
+        if not caps & MUDPFrame.CAP_PMTU:
+            return self.maxPayload
+        peer = self._peerAddr(addr)
+        t = time.time()
+        probe = self.probes.get(peer)
+        acked = self.reader.pmtu.get(peer)
+        if probe is None or t > probe[1] + self.probeSeconds:
+            probe = self._probe(addr, peer, t, 1)
+        elif acked is None or acked[0] != probe[0]:
+            if t > probe[1] + self.probeWait:
+                if probe[2] < MUDPFrame.helloAttempts:
+                    self._probe(addr, peer, t, probe[2] + 1)
+                return self.maxPayload
+        if acked is None:
+            return self.maxPayload
+        return acked[1]
+
+    # Socket for PROBE, on the address of s, with the don't fragment bit set
+    # for its lifetime. Other sends are on s, which fragments, rather than
+    # fail while a round is sent.
+    def _probeSocket(self, s: any) -> socket.socket:
+        ps = socket.socket(s.family, socket.SOCK_DGRAM)
+        ps.setblocking(False)
+        ps.bind((s.getsockname()[0], 0))
+        opt = self.dontFragment.get(s.family)
+        if opt is not None:
+            try:
+                ps.setsockopt(opt[0], opt[1], opt[2])
+            except OSError:
+                pass  # Not Linux, probes may be fragmented.
+        return ps
+
+    def _probe(self, addr: (str, int), peer: (str, int), t: float, attempts: int) -> tuple:
+        r = self.probeRound
+        self.probeRound = (r + 1) & 0xffff
+        probe = (r, t, attempts)
+        self.probes[peer] = probe
+        self.reader.probing[peer] = r
+        for size in MUDPFrame.probeSizes:
+            try:
+                self.reader.probeSocket.sendto(
+                    MUDPFrame.probe(MUDPFrame.PROBE, r, size), addr)
+            except OSError:
+                pass  # EMSGSIZE, above the interface's MTU.
+        self.sendMetrics.countPeer(peer, "probes")
+        return probe
+
+    # True when peer is on this host.
+    def _isLocal(self, peer: (str, int)) -> bool:
+        try:
+            ip = ipaddress.ip_address(peer[0])
+        except ValueError:
+            return False
+        return ip.is_loopback or peer[0] == self.s.getsockname()[0]
+
+    # Ring to peer, or None when the message is sent on the socket. A ring is
+    # created for a peer on this host with CAP_SHM, and used once the peer
+    # has attached to it. The ring is dropped when the peer has gone, or
+    # does not attach, and offered again after shmSeconds.
+    def _ring(self, addr: (str, int), caps: int) -> MUDPRing:
+        if not caps & MUDPFrame.CAP_SHM:
+            return None
+        peer = self._peerAddr(addr)
+        ring = self.rings.get(peer)
+        if ring is None:
+            t = time.time()
+            if not self._isLocal(peer) or self.shmRetry.get(peer, 0.0) > t:
+                return None
+            self.ringCount += 1
+            try:
+                ring = MUDPRing("mudp-%d-%d-%d-%d" % (
+                    os.getpid(), self.s.getsockname()[1], peer[1],
+                    self.ringCount), True)
+            except OSError:  # /dev/shm is full.
+                self.shmRetry[peer] = t + self.shmSeconds
+                self.sendMetrics.count("shmFailed")
+                return None
+            self.rings[peer] = ring
+            self.shmAttempts[peer] = 0
+        acked = self.reader.shmAcked.get(peer)
+        if acked is None or acked[0] != ring.name:
+            attempts = self.shmAttempts.get(peer, 0)
+            if attempts < MUDPFrame.helloAttempts:
+                self.shmAttempts[peer] = attempts + 1
+                self.s.sendto(MUDPFrame.shm(MUDPFrame.SHM, ring.name), addr)
+            else:
+                self._dropRing(peer)  # Not attached.
+            return None
+        if peer not in self.doorbells:
+            try:
+                fd = os.open(
+                    MUDPFrame.doorbell(acked[1]), os.O_WRONLY | os.O_NONBLOCK)
+            except OSError:
+                self._dropRing(peer)
+                return None
+            if not stat.S_ISFIFO(os.fstat(fd).st_mode):
+                os.close(fd)
+                self._dropRing(peer)
+                return None
+            self.doorbells[peer] = fd
+        return ring
+
+    def _dropRing(self, peer: (str, int)) -> None:
+        ring = self.rings.pop(peer, None)
+        if ring is not None:
+            ring.close()
+        fd = self.doorbells.pop(peer, None)
+        if fd is not None:
+            os.close(fd)
+        self.shmAttempts.pop(peer, None)
+        self.shmRetry[peer] = time.time() + self.shmSeconds
+
+    # Write datagram to the ring, and ring the doorbell. A full ring is
+    # waited on for up to ringSeconds, and then dropped. False when the
+    # ring was dropped, and the datagram is for the socket.
+    def _put(self, b: memoryview, peer: (str, int), ring: MUDPRing) -> bool:
+        until = None
+        while self.rings.get(peer) is ring:
+            if ring.put(b):
+                self._doorbell(peer)
+                return self.rings.get(peer) is ring  # Or the peer has gone.
+            t = time.time()
+            if until is None:
+                until = t + self.ringSeconds
+            elif t > until:
+                self.sendMetrics.count("shmFull")
+                self._dropRing(peer)
+                break
+            self._doorbell(peer)
+            sleep(0.0005)
+        return False
+
+    def _doorbell(self, peer: (str, int)) -> None:
+        try:
+            os.write(self.doorbells[peer], b"\0")
+        except BlockingIOError:
+            pass  # Full of wakeups already.
+        except (BrokenPipeError, KeyError):
+            self._dropRing(peer)  # Peer has gone.
+
+    # True when the peer reads binary frames.
+    def isBinaryPeer(self, addr: (str, int)) -> bool:
+        return (self.peerCaps(addr) & MUDPFrame.CAP_BINARY) != 0
+
+    # Send datagram, keeping sequenced datagrams for retransmission. When
+    # paced(True), waits for room in the window.
+    def _sendto(self, b: memoryview, remotekey: MUDPKey, msg: MUDPBuildMsg, paced: bool) -> None:
+        addr = remotekey.getAddr()
+        peer = self._peerAddr(addr)
+        if msg.ring is not None:
+            if self._put(b, peer, msg.ring):
+                msg.unsent = None
+                self.sendMetrics.countPeer(peer, "shmSent")
+                return
+            msg.ring = None  # Dropped, this and the rest go on the socket.
+        if msg.sequenced:
+            if paced:
+                self.reader.pacer.wait(
+                    peer, remotekey.getRequestId(), MUDPFrame.getSeq(b))
+            self.reader.retransmits.add(peer, remotekey.getRequestId(), bytes(b))
+        try:
+            self.s.sendto(b, addr)
+        except OSError as e:
+            if e.errno == errno.EMSGSIZE and peer in self.probes:
+                # The path's MTU is smaller than probed, probe again and
+                # use maxPayload meanwhile.
+                self.reader.pmtu.pop(peer, None)
+                self.probes[peer] = (-1, 0.0, 0)
+                self.sendMetrics.countPeer(peer, "msgSize")
+            raise
+        msg.unsent = None
+        self.sendMetrics.countPeer(peer, "packetsSent")
+        self.sendMetrics.countPeer(peer, "bytesSent", len(b))
+
+    # The key the reader uses for content from remotekey.
+    def _demuxKey(self, remotekey: MUDPKey) -> MUDPKey:
+        return MUDPKey(self._peerAddr(remotekey.getAddr()), remotekey.getRequestId())
+
+    # Return remote key. When demux(True), the response is queued for
+    # recvRequestId() with the returned key, rather than yielded by recv().
+    # A datagram above the path's MTU (EMSGSIZE) is sent again in datagrams
+    # of maxPayload, with the message's request id, when none of the message
+    # was sent; otherwise the rest of the message is dropped, and the peer
+    # expires it.
+    def send(self, content: any, eom: bool, msg: MUDPBuildMsg, demux: bool=False) -> MUDPKey:
+        if msg.lost:
+            if eom:
+                msg.lost = False
+                msg.restart(False)
+            return None
+        if msg.firstContent:
+            msg.unsent = []
+        if msg.unsent is not None:
+            msg.unsent.append((content, eom))
+        try:
+            return self._send(content, eom, msg, demux)
+        except OSError as e:
+            if e.errno != errno.EMSGSIZE or msg.maxPayload <= self.maxPayload:
+                raise
+        if msg.unsent is None:
+            self.sendMetrics.countPeer(
+                self._peerAddr(msg.getRemoteKey().getAddr()), "msgSizeLost")
+            msg.lost = not eom
+            msg.restart(False)
+            return None
+        unsent = msg.unsent
+        msg.restart(True)
+        ret = None
+        for c, e in unsent:
+            ret = self.send(c, e, msg, demux) or ret
+        return ret
+
+    def _send(self, content: any, eom: bool, msg: MUDPBuildMsg, demux: bool) -> MUDPKey:
         sent = False
         remotekey = msg.getRemoteKey()
-        msg.setMaxPayload(self.maxPayload)
+        caps = self.peerCaps(remotekey.getAddr())
+        if msg.firstContent:  # Datagram size changes in between messages.
+            msg.setMaxPayload(self._payload(remotekey.getAddr(), caps))
+        msg.setBinary(
+            (caps & MUDPFrame.CAP_BINARY) != 0,
+            (caps & MUDPFrame.CAP_NACK) != 0)
+        if msg.firstContent:  # Transport changes in between messages.
+            msg.ring = self._ring(remotekey.getAddr(), caps)
+        if msg.ring is not None:
+            msg.setBinary(True)
+        paced = msg.sequenced and (caps & MUDPFrame.CAP_WINDOW) != 0
+        if caps & MUDPFrame.CAP_ZLIB:
+            msg.setCompress(self.zdict, self.compressMin)
+        else:
+            msg.setCompress(None, 0)
         for b in msg.addContent(content,eom):
             # print("sent (content) "+str(len(b))+":"+str(b)+" to "+str(remotekey))
+            if demux and not sent:  # Register before the response can arrive.
+                self.reader.register(self._demuxKey(remotekey))
             sent = True
-            self.s.sendto(b, remotekey.getAddr())
+            self._sendto(b, remotekey, msg, paced)
         if eom and msg.hasContent():
             b = msg.getBytes()
             # print("sent (eom) "+str(len(b))+":"+b+" to "+str(remotekey))
+            if demux and not sent:
+                self.reader.register(self._demuxKey(remotekey))
             sent = True
-            self.s.sendto(b, remotekey.getAddr())
+            self._sendto(b, remotekey, msg, paced)
+        if eom and sent and paced:
+            self.reader.pacer.finish(
+                self._peerAddr(remotekey.getAddr()), remotekey.getRequestId())
         if sent:
+            if demux:
+                return self._demuxKey(remotekey)
             return remotekey
         else:
             return None
 
     # Return ((ip:str, port:int, requestId:int), .content:str, eom:bool)
+    # for content that is not queued for a registered key, i.e. requests.
     # When an error occcurs, and skipBad is False, content=None
     # and eom=True.
-    def recv(self) -> (MUDPKey, str, bool):
-        countDown = 30
-        while countDown > 0:
-            self.reader.publish()
-            content = self.reader.content
+    # Waits for up to timeout seconds for content to arrive, and then yields
+    # all of the content that has arrived without waiting again. Content that
+    # is not yielded when the consumer stops early is left in the reader, for
+    # the next recv().
+    def recv(self, timeout: float=0.03) -> (MUDPKey, str, bool):
+        while True:
+            content = self._waitContent(timeout)
             if content is None:
-                # Wait for something to arrive via the reader thread.
-                countDown -= 1
-                self.slept += 0.001
-                sleep(0.001)
-                continue
-            contentEOM = self.reader.contentEOM
-            # Let the reader thread publish more content while we process
-            # what has already been published.
-            self.reader.contentEOM = None
-            self.reader.content = None
-            countDown = 10
-            for remotekey, lst in content.items():
-                eomlst = contentEOM[remotekey]
-                for i, txt in enumerate(lst):
-                    eom= eomlst[i]
-                    if eom and txt is None:
-                        # Unrecoverable error, shutdown the request.
-                        yield remotekey, None, True
-                        return
-                    yield remotekey, txt, eomlst[i]
+                return
+            timeout = 0.0
+            try:
+                while content:
+                    (remotekey, txt, eom) = content.popleft()
+                    if self.text and txt is not None:
+                        txt = txt.decode('utf-8')
+                    yield remotekey, txt, eom
+            finally:
+                self.reader.unread(content)
+
+    # Yield (content, eom) for the request that was sent with remotekey, see
+    # send(demux=True). Waits for up to timeout seconds for content to arrive,
+    # and then yields all of the content that has arrived without waiting
+    # again. The key is released after the eom.
+    # When an error occcurs, and skipBad is False, content=None
+    # and eom=True.
+    def recvRequestId(self, remotekey: MUDPKey, timeout: float=0.0) -> (str, bool):
+        key = self._demuxKey(remotekey)
+        self.reader.register(key)
+        while True:
+            t = time.time()
+            content = self.reader.waitQueue(key, timeout)
+            if timeout > 0.0:
+                self.slept += time.time() - t
+            if content is None:
+                return
+            timeout = 0.0
+            for k, txt, eom in content:
+                if self.text and txt is not None:
+                    txt = txt.decode('utf-8')
+                if eom:
+                    self.reader.release(key)
+                yield txt, eom
+                if eom:
+                    return
+
+    # No longer interested in the response to remotekey, content that has
+    # arrived or arrives later is dropped.
+    def cancelRequestId(self, remotekey: MUDPKey) -> None:
+        self.reader.release(self._demuxKey(remotekey), cancel=True)
 
     # Wait for the response to a specific request.
     # Will wait(30 x >0.0) if needed, default is no wait(0.0) and check for new response and yield response and then reuturn.
-    # Will flush(True) other content, default is to flush all other responses received on other keys.
+    # flush is ignored, content for other keys is kept in their queues.
     def recvResponse(
         self, remotekey: MUDPKey, wait:float=0.0, flush: bool=True
     ) -> (str, bool):
-        countDown = 30
-        while countDown > 0:
-            if self.reader.content is not None:
-                l = self.reader.content.get(remotekey)
-                eoml = self.reader.contentEOM.get(remotekey)
-                # Release content rightaway, so reader can publish
-                # more while processing the recent content.
-                if flush:
-                    self.reader.contentEOM = None
-                    self.reader.content = None
-                else:
-                    del self.reader.contentEOM[remotekey]
-                    del self.reader.content[remotekey]
-                    if len(self.reader.content)==0:
-                        self.reader.contentEOM = None
-                        self.reader.content = None
-            else:
-                l = None
-            if l is None:
-                if wait > 0.0:
-                    countDown -= 1
-                    self.slept += wait
-                    # print(str(self),flush=True)
-                    sleep(wait)
-                    continue
-                else:
-                    return
-            countDown = 10
-            for i, txt in enumerate(l):
-                yield txt, eoml[i]
+        yield from self.recvRequestId(remotekey, timeout=wait * 30)
 
     # Runs the testcases found in the list. The List is tuples of content and
     # a boolean value. True means last content for the message, False
@@ -728,10 +2462,8 @@ class MUDP:
                 print(" PASS ", end="")
             print(" Server receiving \""+txt+"\" from="+str(clientkey)+" eom="+str(eom))
             if failed:
-                print(server.reader.content)
-                print(server.reader.contentEOM)
+                print(server.reader)
                 print(server.reader.newContent)
-                print(server.reader.newContentEOM)
                 raise Exception("STOPPING due to failure")
             if eom:
                 serverKeys.append(MUDPKey(serverS.getsockname(),clientkey.getRequestId()))
@@ -759,12 +2491,41 @@ class MUDP:
                     sleep(0.5)
                     print("Client slept (0.5) waiting for Ack from "+str(serverkey))
                     print(str(client))
-        print("Slept count client=%.5f"%client.slept+" server=%.5f"%server.slept)
+        print("Slept client=%.5f"%client.slept+" server=%.5f"%server.slept)
+        print("Latency client=%.6f"%client.avgLatency()+" server=%.6f"%server.avgLatency())
         client.shutdown()
         recvPacketCount = server.reader.packetCount
         server.shutdown()
         return recvPacketCount
 
+    # Packets per second, and garbage collections, of the reader decoding n
+    # datagrams of single content messages, without a socket.
+    @staticmethod
+    def bench(n: int=200000, size: int=100, binary: bool=True) -> (float, int):
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        s.bind(("127.0.0.1", 0))
+        reader = MUDPReader(s, 1472, 0, False, MUDPFrame.CAP_BINARY if binary else 0)
+        addr = ("127.0.0.1", 9)
+        msg = MUDPBuildMsg(MUDPKey(addr))
+        msg.setMaxPayload(1472)
+        msg.setBinary(binary)
+        views = []
+        for i in range(1024):
+            for b in msg.addContent(b"x" * size, True):
+                views.append(memoryview(bytes(b)))
+        collections = sum(st["collections"] for st in gc.get_stats())
+        t = time.perf_counter()
+        for i in range(n):
+            reader.receive(views[i & 1023], addr)
+            if i % reader.batchSize == 0:
+                reader.publish()
+                reader.wildcard.clear()
+        reader.publish()
+        t = time.perf_counter() - t
+        collections = sum(st["collections"] for st in gc.get_stats()) - collections
+        s.close()
+        return (n / t, collections)
+
     @staticmethod
     def main():
         maxPayload=30
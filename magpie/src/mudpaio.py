@@ -0,0 +1,228 @@
+# This file is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This file is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# See the GNU General Public License, <https://www.gnu.org/licenses/>.
+#
+# MUDPAsync is MUDP for asyncio. The event loop reads the socket through an
+# asyncio.DatagramProtocol, instead of the reader thread, and the consumer
+# awaits content instead of waiting on the condition. Decoding, queues and
+# negotiation are MUDPReader's, which is not started as a thread.
+# Datagrams received in one iteration of the loop are published together,
+# the same as a batch of the reader thread. Timeouts and retransmission run
+# from loop.call_later().
+# Sending is MUDP.send(), which does not wait: a full ring is dropped, and
+# the datagram is sent on the socket, see MUDPAsync._put(); window pacing
+# waits, and is not available. Names are resolved by RootHAsync, on the loop.
+import asyncio
+import errno
+import time
+import traceback
+from magpie.src.mlogger import MLogger, mlogger
+from magpie.src.mudp import MUDP, MUDPKey, MUDPRing
+
+
+class MUDPAioSocket():
+    """
+    MUDPAioSocket is the socket for MUDP and MUDPReader, sendto() is through
+    the datagram transport once started, so a send that would block is
+    queued by the transport rather than failing. While nothing is queued the
+    socket is sent to directly, so errors such as EMSGSIZE are raised to
+    MUDP.send(), rather than given to error_received().
+    """
+    def __init__(self, s: any):
+        self.s = s
+        self.transport = None
+
+    def sendto(self, data: bytes, addr: (str, int)) -> None:
+        if self.transport is None:
+            self.s.sendto(data, addr)
+            return
+        if self.transport.get_write_buffer_size() == 0:
+            try:
+                self.s.sendto(data, addr)
+                return
+            except (BlockingIOError, InterruptedError):
+                pass
+        self.transport.sendto(data, addr)
+
+    def __getattr__(self, name: str) -> any:
+        return getattr(self.s, name)
+
+
+class MUDPProtocol(asyncio.DatagramProtocol):
+    def __init__(self, mudp: 'MUDPAsync'):
+        self.mudp = mudp
+
+    def datagram_received(self, data: bytes, addr: (str, int)) -> None:
+        self.mudp._received(data, addr)
+
+    def error_received(self, exc: Exception) -> None:
+        if getattr(exc, "errno", None) != errno.EMSGSIZE:  # Lost, once queued.
+            if MLogger.isError():
+                mlogger.error("MUDPAsync error " + str(exc))
+
+
+class MUDPAsync(MUDP):
+    """
+    MUDPAsync: MUDP with the reader on the running event loop, see start().
+    The parameters are MUDP's, except window.
+    """
+    def __init__(self, socket: any, skipBad: bool, **kwargs):
+        if kwargs.get("window"):
+            raise Exception("MUDPAsync does not pace, window waits")
+        self.loop = None
+        self.transport = None
+        self.timer = None
+        self.publishing = False
+        self.ticking = 0.0
+        # Replaced when set, so each wakeup is seen by the consumers that
+        # were waiting, see _wakeup().
+        self.arrived = None
+        super().__init__(MUDPAioSocket(socket), skipBad, **kwargs)
+
+    def _startReader(self) -> None:
+        pass  # See start().
+
+    async def start(self) -> None:
+        """ Read the socket on the running loop. """
+        self.loop = asyncio.get_running_loop()
+        self.arrived = asyncio.Event()
+        (self.transport, protocol) = await self.loop.create_datagram_endpoint(
+            lambda: MUDPProtocol(self), sock=self.s.s)
+        self.s.transport = self.transport
+        if self.reader.doorbell is not None:
+            self.loop.add_reader(self.reader.doorbell, self._readRings)
+        if self.reader.probeSocket is not None:
+            self.loop.add_reader(self.reader.probeSocket, self.reader._readProbes)
+        self._tick()
+
+    # The transport closes the socket.
+    def _stopReader(self) -> None:
+        self.reader.stop = True
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if self.loop is not None and not self.loop.is_closed():
+            if self.reader.doorbell is not None:
+                self.loop.remove_reader(self.reader.doorbell)
+            if self.reader.probeSocket is not None:
+                self.loop.remove_reader(self.reader.probeSocket)
+            if self.transport is not None:
+                self.transport.close()
+        self.reader.close()
+        self.wakeup()
+
+    def _received(self, data: bytes, addr: (str, int)) -> None:
+        try:
+            self.reader.receive(memoryview(data), addr)
+        except Exception as e:
+            if MLogger.isError():
+                mlogger.error("Failed to parse cmds " + str(e) + " from "
+                              + str(addr) + "\n" + traceback.format_exc())
+        self._publishSoon()
+
+    def _readRings(self) -> None:
+        self.reader._readRings()
+        self._publishSoon()
+
+    # MUDP._put(), without waiting for room: the loop would stall, and the
+    # consumer may be waiting on the loop. A full ring is dropped, and the
+    # datagram, and the rest of the message, are sent on the socket.
+    def _put(self, b: memoryview, peer: (str, int), ring: MUDPRing) -> bool:
+        if self.rings.get(peer) is not ring:
+            return False
+        if ring.put(b):
+            self._doorbell(peer)
+            return self.rings.get(peer) is ring
+        self.sendMetrics.count("shmFull")
+        self._dropRing(peer)
+        return False
+
+    def _publishSoon(self) -> None:
+        if not self.publishing:
+            self.publishing = True
+            self.loop.call_soon(self._publish)
+
+    def _publish(self) -> None:
+        self.publishing = False
+        if self.reader.newContent:
+            self.reader.publish()
+            self.wakeup()
+
+    def wakeup(self) -> None:
+        """ Wake the consumers, e.g. to see stop. """
+        if self.arrived is not None:
+            arrived = self.arrived
+            self.arrived = asyncio.Event()
+            arrived.set()
+
+    # Retransmission every nackSeconds, and expiry every second, as the
+    # reader thread does.
+    def _tick(self) -> None:
+        t = time.time()
+        if self.reader.sequenced:
+            self.reader.retransmitTimeout(t)
+        if t > self.ticking:
+            self.ticking = t + 1
+            self.reader.timeout(t)
+        self._publish()
+        self.timer = self.loop.call_later(self.reader.nackSeconds, self._tick)
+
+    async def _arrival(self, timeout: float) -> None:
+        try:
+            await asyncio.wait_for(self.arrived.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def recv(self, timeout: float=0.03) -> (MUDPKey, str, bool):
+        """ MUDP.recv(), awaiting content rather than waiting. """
+        while True:
+            t = time.time()
+            (content, published) = self.reader.waitContent(0.0)
+            if content is None and timeout > 0.0 and not self.stop:
+                await self._arrival(timeout)
+                now = time.time()
+                self.slept += now - t
+                (content, published) = self.reader.waitContent(0.0)
+            if content is None:
+                return
+            self.latency += time.time() - published
+            self.latencyCount += 1
+            timeout = 0.0
+            for remotekey, txt, eom in content:
+                if self.text and txt is not None:
+                    txt = txt.decode('utf-8')
+                yield remotekey, txt, eom
+
+    async def recvRequestId(self, remotekey: MUDPKey, timeout: float=0.0) -> (str, bool):
+        """ MUDP.recvRequestId(), awaiting content rather than waiting. """
+        key = self._demuxKey(remotekey)
+        self.reader.register(key)
+        until = time.time() + timeout
+        while True:
+            content = self.reader.waitQueue(key, 0.0)
+            while content is None and not self.stop:
+                t = time.time()
+                if t >= until:
+                    break
+                await self._arrival(until - t)
+                self.slept += time.time() - t
+                content = self.reader.waitQueue(key, 0.0)
+            if content is None:
+                return
+            until = 0.0
+            for k, txt, eom in content:
+                if self.text and txt is not None:
+                    txt = txt.decode('utf-8')
+                if eom:
+                    self.reader.release(key)
+                yield txt, eom
+                if eom:
+                    return
@@ -733,6 +733,16 @@ class MWorksheets:
                 del ws["cmds"][cmdidx]
                 return
 
+    def cmdUuidsAfter(self, cmduuid: str) -> str:
+        """ Yield the cmd UUIDs after cmduuid, all of them when it is None. """
+        found = not cmduuid
+        for ws in self:
+            for cmd in ws["cmds"]:
+                if found:
+                    yield cmd["uuid"]
+                else:
+                    found = (cmd["uuid"] == cmduuid)
+
     def nextCmdUuid(self, cmduuid: str) -> str:
         """ Return the next cmd UUID after the previous cmd UUID. """
         found = False
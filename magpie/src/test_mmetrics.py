@@ -0,0 +1,52 @@
+# This file is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This file is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# See the GNU General Public License, <https://www.gnu.org/licenses/>.
+#
+import os
+import socket
+import unittest
+from magpie.src.mmetrics import MHistogram, MMetrics
+
+
+class TestMMetrics(unittest.TestCase):
+
+    def test_histogram(self):
+        h = MHistogram()
+        for v in [0, 1, 2, 3, 100, 1000]:
+            h.add(v)
+        s = h.snapshot()
+        self.assertEqual(s["count"], 6)
+        self.assertEqual(s["sum"], 1106)
+        self.assertEqual(s["max"], 1000)
+        self.assertEqual(s["buckets"], [1, 1, 2, 0, 0, 0, 0, 1, 0, 0, 1])
+        self.assertEqual(s["p50"], 3)
+        self.assertEqual(s["p99"], 1023)
+
+    def test_merge(self):
+        a = MMetrics()
+        b = MMetrics()
+        a.count("expired")
+        a.countPeer(("127.0.0.1", 1), "packetsRecv", 2)
+        b.countPeer(("127.0.0.1", 1), "packetsSent", 3)
+        b.histogram("chunksPerMessage").add(4)
+        m = MMetrics.merge(a.snapshot(), b.snapshot())
+        self.assertEqual(m["counters"], {"expired": 1})
+        self.assertEqual(m["peers"], {"127.0.0.1:1": {"packetsRecv": 2, "packetsSent": 3}})
+        self.assertEqual(m["histograms"]["chunksPerMessage"]["count"], 1)
+
+    @unittest.skipUnless(os.path.exists("/proc/net/udp"), "Linux only")
+    def test_udpDrops(self):
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        s.bind(("127.0.0.1", 0))
+        try:
+            self.assertEqual(MMetrics.udpDrops(s.getsockname()[1]), 0)
+        finally:
+            s.close()
@@ -0,0 +1,444 @@
+# This file is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This file is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# See the GNU General Public License, <https://www.gnu.org/licenses/>.
+#
+import unittest
+from unittest.mock import patch
+import socket
+import threading
+import time
+import json
+from copy import copy
+from magpie.src.mudp import MUDP, MUDPBuildMsg, MUDPKey, MUDPFrame, MUDPPacer, MUDPDecodeMsg, MUDPDecodeMsgs
+
+
+class TestMUDP(unittest.TestCase):
+
+    @staticmethod
+    def udpSocket() -> socket.socket:
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        s.settimeout(5)
+        s.bind(("127.0.0.1", 0))
+        return s
+
+    def setUp(self):
+        self.clientS = self.udpSocket()
+        self.serverS = self.udpSocket()
+        self.mudps = []
+
+    def tearDown(self):
+        for m in self.mudps:
+            m.shutdown()
+        self.clientS.close()
+        self.serverS.close()
+
+    def mudp(self, s: socket.socket, **kwargs) -> MUDP:
+        m = MUDP(s, **kwargs)
+        self.mudps.append(m)
+        return m
+
+    @staticmethod
+    def recvAll(m: MUDP, n: int, timeout: float = 5.0) -> list:
+        """ Receive until n eom, or timeout. """
+        ret = []
+        eoms = 0
+        until = time.time() + timeout
+        while eoms < n and time.time() < until:
+            for key, content, eom in m.recv():
+                ret.append((key, content, eom))
+                if eom:
+                    eoms += 1
+        return ret
+
+    def negotiate(self, client: MUDP) -> int:
+        """ Send HELLO to the server, and wait for HELLOACK. """
+        serverAddr = self.serverS.getsockname()
+        client.peerCaps(serverAddr)
+        until = time.time() + 5.0
+        while client.peerCaps(serverAddr) == 0 and time.time() < until:
+            time.sleep(0.01)
+        return client.peerCaps(serverAddr)
+
+    def sendAll(self, m: MUDP, l: list) -> MUDPKey:
+        msg = MUDPBuildMsg(MUDPKey(self.serverS.getsockname()))
+        for content, eom in l:
+            key = m.send(content, eom, msg)
+        return key
+
+    l = [
+        ("abcdefghijklmnopqrstuvwxyz", True),
+        ("__samples", False),
+        ("12345678901234567", False),
+        ("123456789012345678", False),
+        ("1234567890123456", True)
+    ]
+
+    def check(self, client: MUDP, server: MUDP) -> None:
+        self.sendAll(client, self.l)
+        got = self.recvAll(server, 2)
+        self.assertEqual([(c, e) for k, c, e in got], self.l)
+
+    def test_ascii(self):
+        client = self.mudp(self.clientS, skipBad=False, maxPayload=30, binary=False)
+        server = self.mudp(self.serverS, skipBad=False, maxPayload=30, binary=False)
+        self.check(client, server)
+        self.assertEqual(server.reader.peers, {})
+
+    def test_binary(self):
+        client = self.mudp(self.clientS, skipBad=False, maxPayload=30)
+        server = self.mudp(self.serverS, skipBad=False, maxPayload=30)
+        self.check(client, server)
+        self.negotiate(client)
+        self.assertTrue(client.isBinaryPeer(self.serverS.getsockname()))
+        # Second round is sent in binary frames.
+        self.check(client, server)
+
+    def test_oldPeer(self):
+        client = self.mudp(self.clientS, skipBad=False, maxPayload=30)
+        server = self.mudp(self.serverS, skipBad=False, maxPayload=30, binary=False)
+        self.check(client, server)
+        self.check(client, server)
+        self.assertFalse(client.isBinaryPeer(self.serverS.getsockname()))
+
+    def test_utf8(self):
+        client = self.mudp(self.clientS, skipBad=False, maxPayload=30)
+        server = self.mudp(self.serverS, skipBad=False, maxPayload=30)
+        txt = "été à la plage, " * 5
+        self.sendAll(client, [(txt, True)])
+        got = self.recvAll(server, 1)
+        self.assertEqual([c for k, c, e in got], [txt])
+
+    def test_frame(self):
+        hello = MUDPFrame.hello(MUDPFrame.HELLO, MUDPFrame.CAP_BINARY)
+        self.assertTrue(MUDPFrame.isBinary(hello))
+        self.assertFalse(MUDPFrame.isBinary(b"00ffO00o000001a"))
+        self.assertEqual(MUDPFrame.peerCaps(hello), MUDPFrame.CAP_BINARY)
+
+    def test_batch(self):
+        server = self.mudp(self.serverS, skipBad=False, maxPayload=30)
+        # Hold the reader so the datagrams queue in the socket.
+        server.reader.batchSize = 0
+        client = self.mudp(self.clientS, skipBad=False, maxPayload=30, binary=False)
+        for i in range(20):
+            self.sendAll(client, [("msg%d" % i, True)])
+        time.sleep(0.2)
+        server.reader.batchSize = 256
+        got = self.recvAll(server, 20)
+        self.assertEqual([c for k, c, e in got], ["msg%d" % i for i in range(20)])
+        self.assertEqual(server.reader.packetCount, 20)
+        self.assertLess(server.reader.batchCount, 20)
+
+    def test_wakeup(self):
+        client = self.mudp(self.clientS, skipBad=False, maxPayload=30)
+        server = self.mudp(self.serverS, skipBad=False, maxPayload=30)
+        self.assertFalse(server.wait(0.05))
+        self.sendAll(client, [("wake", True)])
+        t = time.time()
+        got = [c for k, c, e in server.recv(timeout=5.0)]
+        self.assertEqual(got, ["wake"])
+        self.assertLess(time.time() - t, 1.0)
+        self.assertEqual(server.latencyCount, 1)
+
+    def test_demux(self):
+        client = self.mudp(self.clientS, skipBad=False, maxPayload=30)
+        server = self.mudp(self.serverS, skipBad=False, maxPayload=30)
+        serverAddr = self.serverS.getsockname()
+        keys = []
+        for i in range(3):
+            msg = MUDPBuildMsg(MUDPKey(serverAddr))
+            keys.append(client.send("req%d" % i, True, msg, demux=True))
+        got = self.recvAll(server, 3)
+        self.assertEqual([c for k, c, e in got], ["req0", "req1", "req2"])
+        for key, content, eom in got:
+            server.send("rsp" + content, True, MUDPBuildMsg(key))
+        # An unsolicited request to the client goes to the wildcard queue.
+        server.send("unsolicited", True, MUDPBuildMsg(MUDPKey(self.clientS.getsockname())))
+        client.cancelRequestId(keys[1])
+        self.assertEqual(list(client.recvRequestId(keys[2], timeout=5.0)), [("rspreq2", True)])
+        self.assertEqual(list(client.recvRequestId(keys[0], timeout=5.0)), [("rspreq0", True)])
+        got = self.recvAll(client, 1)
+        self.assertEqual([c for k, c, e in got], ["unsolicited"])
+        self.assertEqual(list(client.recvRequestId(keys[1])), [])
+
+    def test_retransmit(self):
+        client = self.mudp(self.clientS, skipBad=False, maxPayload=30, retransmit=True)
+        # The server loses the third datagram, and NACKs for it.
+        server = self.mudp(self.serverS, skipBad=False, maxPayload=30, retransmit=True, skip=3)
+        serverAddr = self.serverS.getsockname()
+        self.negotiate(client)
+        self.assertEqual(client.peerCaps(serverAddr), MUDPFrame.CAP_BINARY | MUDPFrame.CAP_NACK)
+        self.sendAll(client, self.l)
+        got = self.recvAll(server, 2)
+        # The first message completes after the second, once retransmitted.
+        self.assertEqual([(c, e) for k, c, e in got], self.l[1:] + self.l[:1])
+        self.assertEqual(client.reader.retransmits.retransmitted, 1)
+        self.assertGreater(server.reader.nackCount, 0)
+
+    def test_sameRequestId(self):
+        client = self.mudp(self.clientS, skipBad=False, maxPayload=30, retransmit=True)
+        server = self.mudp(self.serverS, skipBad=False, maxPayload=30, retransmit=True)
+        self.negotiate(client)
+        # A retransmission has the request id of the request it repeats.
+        key = MUDPKey(self.serverS.getsockname(), requestId=7)
+        l = [("abcdefghijklmnopqrstuvwxyz" * 3, True)]
+        for i in range(2):
+            client.send(l[0][0], True, MUDPBuildMsg(copy(key)))
+            got = self.recvAll(server, 1)
+            self.assertEqual([(c, e) for k, c, e in got], l)
+            self.assertEqual(got[0][0].getRequestId(), 7)
+
+    def test_window(self):
+        client = self.mudp(self.clientS, skipBad=False, maxPayload=1400, retransmit=True, window=8)
+        server = self.mudp(self.serverS, skipBad=False, maxPayload=1400, retransmit=True, window=8)
+        serverAddr = self.serverS.getsockname()
+        self.negotiate(client)
+        self.assertTrue(client.peerCaps(serverAddr) & MUDPFrame.CAP_WINDOW)
+        txt = "".join("%08d" % i for i in range(100000))
+        self.sendAll(client, [(txt, True)])
+        got = self.recvAll(server, 1)
+        self.assertEqual("".join(c for k, c, e in got), txt)
+        pacer = client.reader.pacer
+        self.assertGreater(pacer.acks, 0)
+        until = time.time() + 1.0
+        while len(pacer) and time.time() < until:
+            time.sleep(0.01)
+        self.assertEqual(len(pacer), 0)
+        self.assertGreaterEqual(pacer.learned[serverAddr][0], MUDPPacer.minWindow)
+
+    def test_pacer(self):
+        pacer = MUDPPacer(8)
+        pacer.ackSeconds = 5.0
+        pacer.initialRtt = 0.0  # Not spaced.
+        peer = ("127.0.0.1", 1)
+        for seq in range(8):
+            pacer.wait(peer, 1, seq)
+        w = pacer.windows[(peer, 1)]
+        self.assertEqual(w.inflight(), 8)
+        self.assertEqual(pacer.waits, 0)
+        # The window is full, the ninth waits for ACK.
+        t = threading.Thread(target=pacer.wait, args=(peer, 1, 8))
+        t.start()
+        until = time.time() + 5.0
+        while pacer.waits == 0 and time.time() < until:
+            time.sleep(0.01)
+        self.assertEqual(pacer.waits, 1)
+        self.assertTrue(t.is_alive())
+        pacer.ack(peer, 1, 4)
+        t.join(5.0)
+        self.assertFalse(t.is_alive())
+        self.assertEqual(w.cwnd, 12)  # Slow start.
+        self.assertEqual(w.inflight(), 5)
+        pacer.loss(peer, 1)
+        self.assertEqual(w.cwnd, 8)
+        self.assertEqual(pacer.losses, 1)
+        pacer.finish(peer, 1)
+        pacer.ack(peer, 1, 9)
+        self.assertEqual(len(pacer), 0)
+
+    def test_compress(self):
+        zdict = b'{"cmd": "", "params": {"routing": '
+        client = self.mudp(self.clientS, skipBad=False, maxPayload=100, zdict=zdict, compressMin=64)
+        server = self.mudp(self.serverS, skipBad=False, maxPayload=100, zdict=zdict, compressMin=64)
+        serverAddr = self.serverS.getsockname()
+        self.negotiate(client)
+        self.assertTrue(client.peerCaps(serverAddr) & MUDPFrame.CAP_ZLIB)
+        big = '{"cmd": "_ConCfm_", "params": {"routing": ' + '"Congregation", ' * 50 + '}}'
+        l = [("small", False), (big, False), (big, True)]
+        self.sendAll(client, l)
+        got = self.recvAll(server, 1)
+        self.assertEqual([(c, e) for k, c, e in got], l)
+        # Fewer datagrams than the uncompressed content needs.
+        self.assertLess(server.reader.packetCount, len(big) // 100)
+
+    def test_compressOtherDict(self):
+        client = self.mudp(self.clientS, skipBad=False, maxPayload=100, zdict=b"abc", compressMin=64)
+        server = self.mudp(self.serverS, skipBad=False, maxPayload=100, zdict=b"xyz", compressMin=64)
+        self.check(client, server)
+        self.negotiate(client)
+        self.assertTrue(client.isBinaryPeer(self.serverS.getsockname()))
+        self.assertFalse(client.peerCaps(self.serverS.getsockname()) & MUDPFrame.CAP_ZLIB)
+        self.check(client, server)
+
+    def test_reassembly(self):
+        # Messages of many datagrams, built in the one buffer, and decoded
+        # with their datagrams out of order.
+        msg = MUDPBuildMsg(MUDPKey(("127.0.0.1", 1)))
+        msg.setMaxPayload(200)
+        msg.setBinary(True, sequenced=True)
+        buffer = msg.buffer
+        start = MUDPFrame.header.size + MUDPFrame.seq.size
+        for n in range(3):
+            content = bytes(range(256)) * 4 + bytes([n])
+            # Copies, each datagram is a view of the reused buffer.
+            datagrams = [bytes(d) for d in msg.addContent(content, True)]
+            self.assertIs(msg.buffer, buffer)
+            self.assertGreater(len(datagrams), 5)
+            self.assertEqual([MUDPFrame.getSeq(d) for d in datagrams],
+                             list(range(len(datagrams))))
+            decodeMsg = MUDPDecodeMsg(msg.getRemoteKey().getRequestId(), skipBad=False)
+            # The last first, then every other, and the first last.
+            seqs = list(range(len(datagrams)))
+            seqs = seqs[-1:] + seqs[1:-1:2] + seqs[2:-1:2] + seqs[:1]
+            got = []
+            for seq in seqs:
+                ready = decodeMsg.order(seq, memoryview(datagrams[seq]))
+                if seq != 0:
+                    self.assertEqual(ready, [])  # Held until the first.
+                for d in ready:
+                    got.extend(decodeMsg.decode(d, start, True))
+            self.assertEqual(got, [(content, True)])
+            self.assertEqual(decodeMsg.chunkCount, len(datagrams))
+            self.assertEqual(decodeMsg.chunks, [])
+
+    def test_key(self):
+        key = MUDPKey(("127.0.0.1", 1), 7)
+        self.assertEqual(key, ("127.0.0.1", 1, 7))
+        self.assertNotEqual(key, None)
+        self.assertEqual({key: 1}.get(("127.0.0.1", 1, 7)), 1)
+        msgs = MUDPDecodeMsgs(skipBad=False)
+        decodeMsg = msgs.getDecodeMsg(("127.0.0.1", 1, 7))
+        self.assertEqual(decodeMsg.remotekey, key)
+        self.assertIs(msgs.getDecodeMsg(key), decodeMsg)
+
+    def test_expiry(self):
+        msgs = MUDPDecodeMsgs(skipBad=False)
+        keys = [MUDPKey(("127.0.0.1", 1), i) for i in range(4)]
+        for key in keys:
+            msgs.getDecodeMsg(key)
+        self.assertEqual(list(msgs.getAllTimeout()), [])
+        msgs = MUDPDecodeMsgs(skipBad=False)
+        with patch.object(MUDPDecodeMsg, "expiredSeconds", -1):  # Expired when created.
+            for key in keys:
+                msgs.getDecodeMsg(key)
+        msgs.getDecodeMsg(keys[1]).expiration = time.time() + 60  # Progressed.
+        msgs.delete(keys[2])
+        self.assertEqual([k for k, v in msgs.getAllTimeout()], [keys[0], keys[3]])
+        self.assertEqual(len(msgs), 1)
+        self.assertEqual(len(msgs.heap), 1)  # keys[1] pushed again.
+        self.assertEqual(list(msgs.getAllTimeout()), [])
+        # Deleted messages don't hold the heap.
+        for i in range(1000):
+            key = MUDPKey(("127.0.0.1", 2), i)
+            msgs.getDecodeMsg(key)
+            msgs.delete(key)
+        self.assertLess(len(msgs.heap), 100)
+
+    def test_shm(self):
+        client = self.mudp(self.clientS, skipBad=False, maxPayload=30, shm=True)
+        server = self.mudp(self.serverS, skipBad=False, maxPayload=30, shm=True)
+        self.assertTrue(self.negotiate(client) & MUDPFrame.CAP_SHM)
+        # On the socket while SHM is acked, the messages that follow are on
+        # the ring, and may overtake them.
+        self.sendAll(client, self.l)
+        got = self.recvAll(server, 2)
+        self.assertCountEqual([(c, e) for k, c, e in got], self.l)
+        serverAddr = self.serverS.getsockname()
+        until = time.time() + 5.0
+        while client.reader.shmAcked.get(serverAddr) is None and time.time() < until:
+            time.sleep(0.01)
+        self.check(client, server)
+        self.assertIn(serverAddr, client.rings)
+        self.assertEqual(len(server.reader.rings), 1)
+        self.assertGreater(server.reader.metrics.counters["shmRecv"], 0)
+        # The peer has gone, messages fall back to the socket.
+        server.shutdown()
+        self.mudps.remove(server)
+        server = self.mudp(self.serverS, skipBad=False, maxPayload=30)
+        self.check(client, server)
+        self.assertNotIn(serverAddr, client.rings)
+
+    def test_shmAgain(self):
+        client = self.mudp(self.clientS, skipBad=False, maxPayload=30, shm=True)
+        server = self.mudp(self.serverS, skipBad=False, maxPayload=30, shm=True)
+        self.negotiate(client)
+        serverAddr = self.serverS.getsockname()
+
+        def attach() -> None:
+            until = time.time() + 5.0
+            while serverAddr not in client.doorbells and time.time() < until:
+                # May overtake each other, while SHMACK arrives.
+                self.sendAll(client, self.l)
+                got = self.recvAll(server, 2)
+                self.assertCountEqual([(c, e) for k, c, e in got], self.l)
+            self.assertIn(serverAddr, client.doorbells)
+
+        attach()
+        ring = client.rings[serverAddr]
+        # The doorbell is named for the server's reader, not its port.
+        self.assertEqual(client.reader.shmAcked[serverAddr],
+                         (ring.name, server.reader.doorbellName))
+        self.assertNotEqual(server.reader.doorbellName, "mudp-%d" % serverAddr[1])
+        # The server releases a ring that the client dropped.
+        client._dropRing(serverAddr)
+        self.assertGreater(client.shmRetry[serverAddr], time.time())
+        self.check(client, server)  # On the socket.
+        until = time.time() + 5.0
+        while server.reader.rings and time.time() < until:
+            time.sleep(0.01)
+        self.assertEqual(server.reader.rings, {})
+        # And attaches to the next ring.
+        client.shmRetry[serverAddr] = 0.0
+        attach()
+        self.assertNotEqual(client.rings[serverAddr].name, ring.name)
+        self.check(client, server)
+        self.assertEqual(len(server.reader.rings), 1)
+
+    def test_pmtu(self):
+        client = self.mudp(self.clientS, skipBad=False, maxPayload=1400, pmtu=True)
+        server = self.mudp(self.serverS, skipBad=False, maxPayload=1400, pmtu=True)
+        caps = self.negotiate(client)
+        self.assertTrue(caps & MUDPFrame.CAP_PMTU)
+        serverAddr = self.serverS.getsockname()
+        self.assertEqual(client._payload(serverAddr, caps), 1400)  # Probing.
+        until = time.time() + 5.0
+        while client._payload(serverAddr, caps) == 1400 and time.time() < until:
+            time.sleep(0.01)
+        # Loopback takes the IPv4 maximum in one datagram.
+        self.assertEqual(client._payload(serverAddr, caps), 65507)
+        # Probes are from the probe socket, the socket fragments.
+        self.assertNotEqual(client.reader.probeSocket.getsockname(), self.clientS.getsockname())
+        l = [("x" * 5000, True)]
+        self.sendAll(client, l)
+        self.assertEqual([(c, e) for k, c, e in self.recvAll(server, 1)], l)
+        self.assertEqual(client.sendMetrics.peers[serverAddr]["packetsSent"], 1)
+        # A path with a smaller MTU than probed, the message is sent again
+        # at maxPayload, with its request id.
+        r = client.reader.pmtu[serverAddr][0]
+        client.reader.pmtu[serverAddr] = (r, 65527)
+        l = [("y" * 100, False), ("x" * 65600, True)]
+        key = self.sendAll(client, l)
+        got = self.recvAll(server, 1)
+        self.assertEqual([(c, e) for k, c, e in got], l)
+        self.assertEqual(got[0][0].getRequestId(), key.getRequestId())
+        self.assertEqual(client.sendMetrics.peers[serverAddr]["msgSize"], 1)
+        self.assertNotEqual(client.probes[serverAddr][0], r)  # Probed again.
+        self.check(client, server)
+
+    def test_metrics(self):
+        client = self.mudp(self.clientS, skipBad=False, maxPayload=30)
+        server = self.mudp(self.serverS, skipBad=False, maxPayload=30, binary=False)
+        self.check(client, server)
+        m = server.metrics()
+        json.dumps(m)
+        clientName = "%s:%d" % self.clientS.getsockname()
+        self.assertEqual(m["peers"][clientName]["packetsRecv"], m["counters"]["packets"])
+        self.assertGreater(m["peers"][clientName]["bytesRecv"], 0)
+        self.assertEqual(m["histograms"]["reassemblyMicroseconds"]["count"], 2)
+        self.assertEqual(m["histograms"]["chunksPerMessage"]["count"], 2)
+        self.assertEqual(m["queues"]["wildcard"], 0)
+        serverName = "%s:%d" % self.serverS.getsockname()
+        m = client.metrics()
+        self.assertGreater(m["peers"][serverName]["packetsSent"], 0)
+        # A message with a missing chunk.
+        self.clientS.sendto(b"0007B00c000001a", self.serverS.getsockname())
+        got = self.recvAll(server, 1)
+        self.assertEqual([(c, e) for k, c, e in got], [(None, True)])
+        self.assertEqual(server.metrics()["counters"]["missingChunk"], 1)
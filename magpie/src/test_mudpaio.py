@@ -0,0 +1,119 @@
+# This file is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This file is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# See the GNU General Public License, <https://www.gnu.org/licenses/>.
+#
+import asyncio
+import socket
+import time
+import unittest
+from unittest.mock import patch
+from magpie.src.mudp import MUDP, MUDPBuildMsg, MUDPKey
+from magpie.src.mudpaio import MUDPAsync
+
+
+class TestMUDPAsync(unittest.TestCase):
+
+    @staticmethod
+    def udpSocket() -> socket.socket:
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        s.bind(("127.0.0.1", 0))
+        return s
+
+    def setUp(self):
+        self.clientS = self.udpSocket()
+        self.clientS.settimeout(5)
+        self.serverS = self.udpSocket()
+        self.client = MUDP(self.clientS, skipBad=False, maxPayload=30, retransmit=True)
+
+    def tearDown(self):
+        self.client.shutdown()
+        self.clientS.close()
+        self.serverS.close()
+
+    l = [
+        ("abcdefghijklmnopqrstuvwxyz", True),
+        ("__samples", False),
+        ("12345678901234567", False),
+        ("1234567890123456", True)
+    ]
+
+    async def serve(self, server: MUDPAsync, n: int) -> list:
+        """ Receive until n eom, and respond to each. """
+        got = []
+        until = time.time() + 5.0
+        while n > 0 and time.time() < until:
+            async for key, content, eom in server.recv(timeout=1.0):
+                got.append((content, eom))
+                if eom:
+                    n -= 1
+                    server.send("ack", True, MUDPBuildMsg(key))
+        return got
+
+    def test_recv(self):
+        async def run():
+            server = MUDPAsync(self.serverS, skipBad=False, maxPayload=30, retransmit=True)
+            await server.start()
+            try:
+                serverAddr = self.serverS.getsockname()
+                msg = MUDPBuildMsg(MUDPKey(serverAddr))
+                keys = []
+                for content, eom in self.l:
+                    key = self.client.send(content, eom, msg, demux=eom)
+                    if eom:
+                        keys.append(key)
+                got = await self.serve(server, 2)
+                self.assertEqual(got, self.l)
+                for key in keys:
+                    rsp = await asyncio.to_thread(
+                        lambda: list(self.client.recvRequestId(key, timeout=5.0)))
+                    self.assertEqual(rsp, [("ack", True)])
+                # A request from the server, and its response.
+                clientAddr = self.clientS.getsockname()
+                key = server.send("req", True, MUDPBuildMsg(MUDPKey(clientAddr)), demux=True)
+                for rkey, content, eom in await asyncio.to_thread(
+                        lambda: list(self.client.recv(timeout=5.0))):
+                    self.client.send("rsp", True, MUDPBuildMsg(rkey))
+                rsp = [r async for r in server.recvRequestId(key, timeout=5.0)]
+                self.assertEqual(rsp, [("rsp", True)])
+            finally:
+                server.shutdown()
+        asyncio.run(run())
+
+    def test_fullRing(self):
+        async def run():
+            self.client.shutdown()
+            self.client = MUDP(self.clientS, skipBad=False, maxPayload=30, shm=True)
+            server = MUDPAsync(self.serverS, skipBad=False, maxPayload=30, shm=True)
+            await server.start()
+            try:
+                clientAddr = self.clientS.getsockname()
+                until = time.time() + 5.0
+                while clientAddr not in server.doorbells and time.time() < until:
+                    server.send("hello", True, MUDPBuildMsg(MUDPKey(clientAddr)))
+                    await asyncio.sleep(0.05)
+                self.assertIn(clientAddr, server.doorbells)
+                # The loop does not wait for room, the datagram is sent on
+                # the socket.
+                with patch.object(server.rings[clientAddr], "put", return_value=False):
+                    t = time.time()
+                    server.send("full", True, MUDPBuildMsg(MUDPKey(clientAddr)))
+                    self.assertLess(time.time() - t, 1.0)
+                self.assertNotIn(clientAddr, server.rings)
+                self.assertEqual(server.sendMetrics.counters["shmFull"], 1)
+                got = []
+                until = time.time() + 5.0
+                while "full" not in got and time.time() < until:
+                    got += [c for k, c, e in await asyncio.to_thread(
+                        lambda: list(self.client.recv(timeout=1.0)))]
+                self.assertIn("full", got)
+            finally:
+                server.shutdown()
+        asyncio.run(run())
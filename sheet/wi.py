@@ -29,7 +29,7 @@ except Exception:
     print("pip3 install -U -f https://extras.wxpython.org/wxPython4/extras/linux/gtk3/ubuntu-18.04 wxPython")
     sys.exit(1)
 from magpie.src.musage import MUsage
-from magpie.src.mudp import MUDP, MUDPBuildMsg
+from magpie.src.mudp import MUDP, MUDPBuildMsg, MUDPKey
 from magpie.src.mworksheets import MCmd
 from sheet.QueryParams import QueryParams
 from sheet.Grid import WiGrid
@@ -56,8 +56,8 @@ class WiSampleGrid(wx.Frame):
         self.requestId = self.mudp.send(
             content=json.dumps({"_sample_":{"feed":title, "N":100}}),
             eom=True,
-            msg=MUDPBuildMsg(remoteAddr=remoteAddr,
-                             requestId=MUDPBuildMsg.nextId())
+            msg=MUDPBuildMsg(MUDPKey(remoteAddr)),
+            demux=True
         )
         self.timer = wx.PyTimer(self.timerTick)
         self.timer.Start(100)